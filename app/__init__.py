@@ -2,11 +2,49 @@ from flask import Flask
 from config import Config
 from flask_bootstrap import Bootstrap
 from datetime import timedelta
+from app.pool import ConnectionPool
+from app.cache import ResultCache, LRUCache, PageCache
+from app.writer import WriteBehind
+from app.hashing import Hasher
+from app.bitmaps import GenreIndex
+from app.graph import SocialGraph
+from app.tracing import QueryTracer
+import atexit
 import sqlite3
 
 app = Flask(__name__)
 app.config.from_object(Config)
 bootstrap = Bootstrap(app)
+tracer = QueryTracer(slow_ms=app.config['SQL_SLOW_MS'])
+pool = ConnectionPool(app.config['DATABASE'],
+                      size=app.config['DB_POOL_SIZE'],
+                      timeout=app.config['DB_POOL_TIMEOUT'],
+                      pragmas=app.config['DB_PRAGMAS'],
+                      factory=tracer.factory())
+leaderboards = ResultCache(app.config['DATABASE'],
+                           ttl=app.config['LEADERBOARD_TTL'])
+film_details = LRUCache(app.config['FILM_CACHE_SIZE'],
+                        ttl=app.config['FILM_CACHE_TTL'])
+writer = WriteBehind(pool, interval=app.config['WRITE_BEHIND_INTERVAL'],
+                     max_batch=app.config['WRITE_BEHIND_MAX_BATCH'])
+user_ids = LRUCache(app.config['USER_ID_CACHE_SIZE'])
+pages = PageCache(app.config['PAGE_CACHE_BYTES'],
+                  ttl=app.config['PAGE_CACHE_TTL'],
+                  stale=app.config['PAGE_CACHE_STALE'])
+fragments = PageCache(app.config['FRAGMENT_CACHE_BYTES'],
+                      ttl=app.config['FRAGMENT_CACHE_TTL'],
+                      stale=app.config['PAGE_CACHE_STALE'])
+genre_index = GenreIndex()
+social_graph = SocialGraph(ttl=app.config['SOCIAL_GRAPH_TTL'])
+hasher = Hasher(workers=app.config['HASH_WORKERS'],
+                queue=app.config['HASH_QUEUE'],
+                iterations=app.config['PASSWORD_ITERATIONS'],
+                timeout=app.config['HASH_TIMEOUT'],
+                legacy_salt=app.config['SALT'])
+if app.config['WRITE_BEHIND']:
+    writer.start()
+    atexit.register(writer.stop)
 
-from app import routes, models, error
+from app import (metrics, identity, assets, compression, routes, models, api,
+                 error, commands)
 
@@ -0,0 +1,189 @@
+import asyncio
+import contextvars
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from app import app, pool
+from app.models import (borrowed, Film, Person, User, Search, Watchlist,
+                        Favorites, Watchlater, Feed)
+
+
+# Async counterparts of the models. SQLite has no non-blocking API, so
+# each call runs on a thread of a dedicated pool with a connection of its
+# own, and independent lookups of one request can be awaited together:
+#
+#   detail, names = await asyncio.gather(
+#       AsyncFilm().get_film(film_id), AsyncWatchlist().watchlist_names(me))
+#
+# The calling context (request, g, the SQL recorder) is copied into the
+# thread. Release the request's own connection before waiting on several
+# calls, or a busy process can run the pool dry.
+#
+# asgi() serves the app over ASGI (uvicorn asgi:application). Each request
+# runs on one of ASGI_WORKERS threads, so no more than that many are
+# handled at once.
+
+
+class DBExecutor:
+    def __init__(self, pool, workers):
+        self.pool = pool
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='db')
+
+    def _call(self, fn, args, kwargs):
+        db = self.pool.acquire()
+        token = borrowed.set(db)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            borrowed.reset(token)
+            self.pool.release(db)
+
+    async def run(self, fn, *args, **kwargs):
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(context.run, self._call, fn, args,
+                                    kwargs))
+
+
+executor = DBExecutor(pool, app.config['ASYNC_DB_THREADS'])
+
+
+class AsyncModel:
+    # AsyncFilm().get_film(id) is a coroutine running Film().get_film(id)
+    # on the executor.
+    model = None
+
+    def __getattr__(self, name):
+        if not callable(getattr(self.model, name, None)):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            return await executor.run(
+                lambda: getattr(self.model(), name)(*args, **kwargs))
+        return call
+
+
+def counterpart(model):
+    return type(f"Async{model.__name__}", (AsyncModel,), {'model': model})
+
+
+AsyncFilm = counterpart(Film)
+AsyncPerson = counterpart(Person)
+AsyncUser = counterpart(User)
+AsyncSearch = counterpart(Search)
+AsyncWatchlist = counterpart(Watchlist)
+AsyncFavorites = counterpart(Favorites)
+AsyncWatchlater = counterpart(Watchlater)
+AsyncFeed = counterpart(Feed)
+
+
+class WsgiAdapter:
+    # Serves a WSGI app to an ASGI server. The request body is read on the
+    # event loop; the app then runs on one of `workers` threads, which
+    # hands each response chunk back to the loop and waits until it is
+    # sent.
+    def __init__(self, wsgi_app, workers):
+        from asgiref.sync import sync_to_async
+        self.wsgi_app = wsgi_app
+        self._run = sync_to_async(self._respond, thread_sensitive=False,
+                                  executor=ThreadPoolExecutor(
+                                      workers, thread_name_prefix='asgi'))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                kind = message['type'].rsplit('.', 1)[-1]
+                await send({'type': f"lifespan.{kind}.complete"})
+                if kind == 'shutdown':
+                    return
+        if scope['type'] != 'http':
+            raise ValueError(f"cannot serve {scope['type']} over WSGI")
+        body = SpooledTemporaryFile(max_size=65536)
+        with body:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            await self._run(environ(scope, body), send,
+                            asyncio.get_running_loop())
+
+    def _respond(self, environ, send, loop):
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {'sent': False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response['sent']:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers]}
+
+        def begin():
+            if not response['sent']:
+                response['sent'] = True
+                emit(response['start'])
+
+        output = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in output:
+                begin()
+                if chunk:
+                    emit({'type': 'http.response.body', 'body': chunk,
+                          'more_body': True})
+            begin()
+            emit({'type': 'http.response.body'})
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+
+
+def environ(scope, body):
+    # The WSGI environ for an ASGI http scope, as in PEP 3333.
+    root = scope.get('root_path', '')
+    path = scope['path']
+    if root and path.startswith(root):
+        path = path[len(root):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        value = value.decode('latin-1')
+        if name in environ:
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE'
+                                     else ',') + value
+        environ[name] = value
+    return environ
+
+
+def asgi(wsgi_app, workers):
+    return WsgiAdapter(wsgi_app, workers)
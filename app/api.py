@@ -0,0 +1,217 @@
+import base64
+import binascii
+import json
+from flask import Blueprint, g, jsonify, request
+from app import app
+from app.models import Film, Person, Search, Watchlist
+
+
+# JSON over the same models as the pages. Every endpoint takes
+# ?fields=a,b,c, which becomes the SELECT list (id is always included),
+# and the batch endpoints take ?ids=1,2,3 in place of one request per
+# film. Lists are paged with an opaque ?cursor= from the previous page's
+# "next"; a page is read in full and its JSON streamed in chunks:
+#
+#   GET /api/v1/films?ids=1,2,3&fields=title,year,rate
+#   GET /api/v1/films?sort=value&limit=500&cursor=...
+#   GET /api/v1/films/<id>          GET /api/v1/persons?ids=4,5
+#   GET /api/v1/lists/<username>/<list_name>
+#   GET /api/v1/search/films?q=dark+kni
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+FILM_DEFAULT = ('id', 'title', 'year', 'rate', 'img')
+PERSON_DEFAULT = ('id', 'name', 'img')
+SORTS = ('id', 'value')
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    return jsonify(error=str(error)), error.status
+
+
+def requested_fields(model, default):
+    text = request.args.get('fields')
+    if not text:
+        return default
+    fields = ['id'] + [field for field in text.split(',') if field]
+    unknown = [field for field in fields if field not in model.FIELDS]
+    if unknown:
+        raise ApiError(f"unknown fields: {', '.join(unknown)}; "
+                       f"choose from {', '.join(model.FIELDS)}")
+    return tuple(dict.fromkeys(fields))
+
+
+def requested_ids():
+    try:
+        ids = [int(id) for id in request.args['ids'].split(',') if id]
+    except ValueError:
+        raise ApiError("ids must be comma-separated integers")
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > app.config['API_BATCH_LIMIT']:
+        raise ApiError(f"ask for 1 to {app.config['API_BATCH_LIMIT']} ids")
+    return ids
+
+
+def requested_limit():
+    limit = request.args.get('limit', '')
+    if not limit:
+        return app.config['API_PAGE_SIZE']
+    if not limit.isdigit() or not 0 < int(limit) <= app.config[
+            'API_MAX_PAGE_SIZE']:
+        raise ApiError(f"limit must be 1 to "
+                       f"{app.config['API_MAX_PAGE_SIZE']}")
+    return int(limit)
+
+
+def encode_cursor(key):
+    raw = json.dumps(key, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor():
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ApiError("invalid cursor")
+
+
+def row_encoder(fields, json_fields):
+    # Serializes one row to a JSON object. Relation columns already hold
+    # JSON text from SQLite and are spliced in as they are.
+    keys = [(field, json.dumps(field) + ':', field in json_fields)
+            for field in fields]
+
+    def encode(row):
+        return '{' + ','.join(
+            key + (row[field] if raw else json.dumps(row[field]))
+            for field, key, raw in keys) + '}'
+    return encode
+
+
+def batch(rows, ids, encode):
+    # Rows in the order the ids were asked for, plus the ids not found.
+    by_id = {row['id']: row for row in rows}
+    data = ','.join(encode(by_id[id]) for id in ids if id in by_id)
+    missing = [id for id in ids if id not in by_id]
+    body = f'{{"data":[{data}],"missing":{json.dumps(missing)}}}'
+    return app.response_class(body, mimetype='application/json')
+
+
+def stream(rows, limit, encode, key):
+    # `rows` holds up to limit + 1 rows; the extra one only says there is
+    # a next page, whose cursor is key(last row sent). The page is read
+    # before returning, while the request still holds its connection;
+    # only the encoding is streamed.
+    rows = list(rows)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    cursor = encode_cursor(key(rows[-1])) if more else None
+
+    def generate():
+        yield '{"data":['
+        for start in range(0, len(rows), 100):
+            yield (',' if start else '') + ','.join(
+                encode(row) for row in rows[start:start + 100])
+        yield f'],"next":{json.dumps(cursor)}}}'
+    return app.response_class(generate(), mimetype='application/json')
+
+
+@api.route('/films')
+def films():
+    fields = requested_fields(Film, FILM_DEFAULT)
+    encode = row_encoder(fields, Film.JSON_FIELDS)
+    if 'ids' in request.args:
+        ids = requested_ids()
+        return batch(Film().films_by_ids(ids, fields), ids, encode)
+    sort = request.args.get('sort', 'id')
+    if sort not in SORTS:
+        raise ApiError(f"sort must be one of {', '.join(SORTS)}")
+    limit = requested_limit()
+    after = decode_cursor()
+    if after is not None and not (
+            isinstance(after, int) if sort == 'id' else
+            isinstance(after, list) and len(after) == 2):
+        raise ApiError("invalid cursor")
+    if sort == 'value':
+        # The cursor holds the last (value, id), so value is selected.
+        select = fields + (('value',) if 'value' not in fields else ())
+        return stream(Film().film_page(select, sort, after, limit + 1),
+                      limit, encode, lambda row: [row['value'], row['id']])
+    return stream(Film().film_page(fields, sort, after, limit + 1), limit,
+                  encode, lambda row: row['id'])
+
+
+@api.route('/films/<int:film_id>')
+def film(film_id):
+    fields = requested_fields(Film, tuple(Film.FIELDS))
+    rows = Film().films_by_ids([film_id], fields)
+    if not rows:
+        raise ApiError("no such film", 404)
+    body = row_encoder(fields, Film.JSON_FIELDS)(rows[0])
+    return app.response_class(body, mimetype='application/json')
+
+
+@api.route('/persons')
+def persons():
+    if 'ids' not in request.args:
+        raise ApiError("ids is required")
+    fields = requested_fields(Person, PERSON_DEFAULT)
+    ids = requested_ids()
+    return batch(Person().persons_by_ids(ids, fields), ids,
+                 row_encoder(fields, Person.JSON_FIELDS))
+
+
+@api.route('/persons/<int:person_id>')
+def person(person_id):
+    fields = requested_fields(Person, tuple(Person.FIELDS))
+    rows = Person().persons_by_ids([person_id], fields)
+    if not rows:
+        raise ApiError("no such person", 404)
+    body = row_encoder(fields, Person.JSON_FIELDS)(rows[0])
+    return app.response_class(body, mimetype='application/json')
+
+
+@api.route('/lists/<username>/<list_name>')
+def list_films(username, list_name):
+    # Private lists are only visible to their owner, as on the site.
+    db = Watchlist()
+    list_id = db.get_list_id(g.username, username, list_name)
+    if list_id is None:
+        raise ApiError("no such list", 404)
+    fields = requested_fields(Film, FILM_DEFAULT)
+    limit = requested_limit()
+    after = decode_cursor()
+    if after is not None and not isinstance(after, int):
+        raise ApiError("invalid cursor")
+    return stream(db.film_page(list_id, fields, after, limit + 1), limit,
+                  row_encoder(fields, Film.JSON_FIELDS),
+                  lambda row: row['entry'])
+
+
+@api.route('/search/films')
+def search_films():
+    fields = requested_fields(Film, FILM_DEFAULT)
+    limit = requested_limit()
+    offset = decode_cursor() or 0
+    if not isinstance(offset, int) or offset < 0:
+        raise ApiError("invalid cursor")
+    rows = Search().film_matches(request.args.get('q', ''), fields, offset,
+                                 limit + 1)
+    if rows is None:
+        raise ApiError("q needs at least one word")
+    return stream(rows, limit, row_encoder(fields, Film.JSON_FIELDS),
+                  lambda row: offset + limit)
+
+
+app.register_blueprint(api)
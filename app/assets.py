@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from flask import request, url_for
+from markupsafe import Markup, escape
+from app import app
+from app.compression import SUFFIXES, TEXT_EXTENSIONS, available, encode
+
+
+# `flask build-assets` writes resized, content-hashed copies of everything
+# in app/static into app/static/build, plus manifest.json mapping each
+# source file to them:
+#
+#   {"background.jpg": {"source": <sha256>, "file": "build/....jpg",
+#                       "width": 1920,
+#                       "variants": {"avif": [[480, "build/..."], ...],
+#                                    "webp": [...], "jpeg": [...]}}}
+#
+# Templates go through asset_url(), picture() and background_image(),
+# which fall back to the plain static URL when there is no manifest.
+# Text files also get .br and .gz siblings at the highest levels, which
+# app.compression serves to clients that accept them.
+
+IMAGE_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png'}
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp',
+              'jpeg': 'image/jpeg', 'png': 'image/png'}
+EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg', 'png': 'png'}
+BUILD_DIR = 'build'
+LEVELS = {'br': 11, 'gzip': 9}
+YEAR = 365 * 24 * 3600
+
+
+def build_root():
+    return os.path.join(app.static_folder, BUILD_DIR)
+
+
+def manifest_path():
+    return os.path.join(build_root(), 'manifest.json')
+
+
+class Manifest:
+    # Reloaded whenever the file's mtime changes, so a rebuild is picked
+    # up without a restart.
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def entries(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return {}
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    with open(self.path) as file:
+                        self._entries = json.load(file)
+                    self._mtime = mtime
+        return self._entries
+
+    def get(self, filename):
+        return self.entries().get(filename)
+
+
+manifest = Manifest(manifest_path())
+
+
+def _static(path):
+    return url_for('static', filename=path)
+
+
+@app.template_global()
+def asset_url(filename, width=None):
+    # Fingerprinted URL of a static file; for images, the fallback-format
+    # variant closest to `width` (the largest one without it).
+    entry = manifest.get(filename)
+    if entry is None:
+        return _static(filename)
+    if width and entry.get('variants'):
+        fallback = entry['variants'][entry['fallback']]
+        path = next((path for size, path in fallback if size >= width),
+                    fallback[-1][1])
+        return _static(path)
+    return _static(entry['file'])
+
+
+def srcset(entry, format):
+    return ', '.join(f"{_static(path)} {size}w"
+                     for size, path in entry['variants'][format])
+
+
+@app.template_global()
+def picture(filename, alt='', sizes='100vw', **attrs):
+    # <picture> with an AVIF and a WebP source and a JPEG/PNG <img>, each
+    # listing every width so the browser picks the smallest that fits.
+    attributes = ''.join(f' {name.rstrip("_")}="{escape(value)}"'
+                         for name, value in attrs.items())
+    entry = manifest.get(filename)
+    if entry is None or not entry.get('variants'):
+        return Markup(f'<img src="{escape(asset_url(filename))}" '
+                      f'alt="{escape(alt)}"{attributes}>')
+    sources = ''.join(
+        f'<source type="{MIME_TYPES[format]}" '
+        f'srcset="{escape(srcset(entry, format))}" '
+        f'sizes="{escape(sizes)}">'
+        for format in entry['variants'] if format != entry['fallback'])
+    return Markup(f'<picture>{sources}'
+                  f'<img src="{escape(asset_url(filename))}"'
+                  f' srcset="{escape(srcset(entry, entry["fallback"]))}"'
+                  f' sizes="{escape(sizes)}" alt="{escape(alt)}"'
+                  f'{attributes}></picture>')
+
+
+@app.template_global()
+def background_image(filename, width=1920):
+    # CSS declarations for a background: a plain url() for old browsers,
+    # then an image-set() offering every format at about `width` pixels.
+    entry = manifest.get(filename)
+    fallback = asset_url(filename, width)
+    css = f"background-image: url('{fallback}');"
+    if entry is None or not entry.get('variants'):
+        return Markup(css)
+    options = []
+    # Browsers take the first type they support, so the fallback goes last.
+    for format in sorted(entry['variants'],
+                         key=lambda format: format == entry['fallback']):
+        sizes = entry['variants'][format]
+        path = next((path for size, path in sizes if size >= width),
+                    sizes[-1][1])
+        options.append(f"url('{_static(path)}') "
+                       f"type('{MIME_TYPES[format]}')")
+    return Markup(f"{css} background-image: "
+                  f"image-set({', '.join(options)});")
+
+
+@app.after_request
+def cache_fingerprinted(response):
+    # Hashed names never change content, so browsers and CDNs may keep
+    # them for a year without revalidating.
+    if (request.endpoint == 'static' and response.status_code == 200
+            and request.view_args.get('filename', '').startswith(
+                BUILD_DIR + '/')):
+        response.cache_control.public = True
+        response.cache_control.max_age = YEAR
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _slug(filename):
+    stem = os.path.splitext(filename)[0]
+    return re.sub(r'[^A-Za-z0-9_]+', '-', stem).strip('-').lower()
+
+
+def _write(out, name, data, ext):
+    path = f"{BUILD_DIR}/{name}.{_digest(data)[:12]}.{ext}"
+    target = os.path.join(out, os.path.basename(path))
+    if not os.path.exists(target):
+        with open(target, 'wb') as file:
+            file.write(data)
+    return path
+
+
+def _precompress(out, path, data, encodings):
+    # {encoding: compressed size} for the siblings worth keeping.
+    sizes = {}
+    for encoding in encodings:
+        body = encode(data, encoding, LEVELS[encoding])
+        if len(body) < len(data) * 0.9:
+            with open(os.path.join(out, os.path.basename(path))
+                      + SUFFIXES[encoding], 'wb') as file:
+                file.write(body)
+            sizes[encoding] = len(body)
+    return sizes
+
+
+def _encode(image, format, quality):
+    from io import BytesIO
+
+    buffer = BytesIO()
+    if format == 'jpeg':
+        image.convert('RGB').save(buffer, 'JPEG', quality=quality,
+                                  optimize=True, progressive=True)
+    elif format == 'png':
+        image.save(buffer, 'PNG', optimize=True)
+    else:
+        image.save(buffer, format.upper(), quality=quality)
+    return buffer.getvalue()
+
+
+def _build_image(source, filename, out, widths, formats, quality):
+    from PIL import Image
+
+    with Image.open(source) as original:
+        original.load()
+    alpha = original.mode in ('RGBA', 'LA') or (
+        original.mode == 'P' and 'transparency' in original.info)
+    fallback = 'png' if alpha else 'jpeg'
+    image = original.convert('RGBA' if alpha else 'RGB')
+    largest = min(image.width, max(widths))
+    sizes = sorted({w for w in widths if w < largest} | {largest})
+    name = _slug(filename)
+    variants = {format: [] for format in formats + (fallback,)}
+    for width in sizes:
+        height = round(image.height * width / image.width)
+        resized = (image if width == image.width else
+                   image.resize((width, height), Image.LANCZOS))
+        for format in variants:
+            data = _encode(resized, format, quality)
+            path = _write(out, f"{name}-{width}w", data, EXTENSIONS[format])
+            variants[format].append([width, path])
+    return {'file': variants[fallback][-1][1], 'width': largest,
+            'fallback': fallback, 'variants': variants}
+
+
+def build(widths, formats, quality):
+    # Returns (manifest entries, files built, files reused). Sources whose
+    # content and format list are unchanged keep their previous outputs.
+    from PIL import features
+
+    formats = tuple(format for format in formats
+                    if format != 'avif' or features.check('avif'))
+    encodings = list(available())
+    static, out = app.static_folder, build_root()
+    os.makedirs(out, exist_ok=True)
+    previous = manifest.entries()
+    entries, built, reused = {}, 0, 0
+    for root, dirs, files in os.walk(static):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != out]
+        for file in sorted(files):
+            source = os.path.join(root, file)
+            filename = os.path.relpath(source, static).replace(os.sep, '/')
+            with open(source, 'rb') as handle:
+                data = handle.read()
+            digest = _digest(data)
+            old = previous.get(filename)
+            ext = os.path.splitext(file)[1].lower()
+            if (old and old['source'] == digest
+                    and (ext not in IMAGE_FORMATS
+                         or old.get('formats') == list(formats))
+                    and (ext not in TEXT_EXTENSIONS
+                         or old.get('encodings') == encodings)
+                    and os.path.exists(os.path.join(static, old['file']))):
+                entries[filename] = old
+                reused += 1
+                continue
+            if ext in IMAGE_FORMATS:
+                entry = _build_image(source, filename, out, widths, formats,
+                                     quality)
+                entry['formats'] = list(formats)
+            else:
+                entry = {'file': _write(out, _slug(filename), data,
+                                        ext.lstrip('.'))}
+                if ext in TEXT_EXTENSIONS:
+                    entry['encodings'] = encodings
+                    entry['encoded'] = _precompress(out, entry['file'],
+                                                    data, encodings)
+            entry['source'] = digest
+            entry['bytes'] = len(data)
+            entries[filename] = entry
+            built += 1
+    keep = {os.path.basename(path) for entry in entries.values()
+            for path in _paths(entry)}
+    for file in os.listdir(out):
+        if file not in keep and file != 'manifest.json':
+            os.remove(os.path.join(out, file))
+    temporary = manifest_path() + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(entries, file, indent=1, sort_keys=True)
+    os.replace(temporary, manifest_path())
+    return entries, built, reused
+
+
+def _paths(entry):
+    yield entry['file']
+    for encoding in entry.get('encoded', {}):
+        yield entry['file'] + SUFFIXES[encoding]
+    for sizes in entry.get('variants', {}).values():
+        for _, path in sizes:
+            yield path
+
@@ -0,0 +1,144 @@
+import threading
+
+
+BLOCK = 4096
+BLOCK_MASK = (1 << BLOCK) - 1
+
+
+def from_positions(positions, size):
+    packed = bytearray((size + 7) // 8)
+    for position in positions:
+        packed[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(packed, 'little')
+
+
+def select(bits, skip, limit):
+    # Positions of the set bits of `bits`, lowest first, after skipping
+    # `skip` of them. Whole blocks are skipped using their popcount.
+    found, base = [], 0
+    while bits and len(found) < limit:
+        block = bits & BLOCK_MASK
+        count = block.bit_count()
+        if skip >= count:
+            skip -= count
+        else:
+            while block and len(found) < limit:
+                low = block & -block
+                if skip:
+                    skip -= 1
+                else:
+                    found.append(base + low.bit_length() - 1)
+                block ^= low
+        bits >>= BLOCK
+        base += BLOCK
+    return found
+
+
+class GenreBitmaps:
+    # One bitset per genre over every film, bit i standing for the i-th
+    # film in (year DESC, value DESC, id DESC) order, so intersections
+    # come out already sorted for paging. Python ints are the bit arrays.
+    # Never modified once built; updates make a new one.
+    def __init__(self, seq, order, position, bits, names):
+        self.seq = seq
+        self.order = order
+        self.position = position
+        self.bits = bits
+        self.names = names
+
+    def genre_ids(self, names):
+        return [self.names[name.lower()][0] for name in names
+                if name.lower() in self.names]
+
+    def matching(self, genre_ids):
+        result = None
+        for id in genre_ids:
+            bits = self.bits[id]
+            result = bits if result is None else result & bits
+        return result or 0
+
+    def page(self, matching, offset, limit):
+        return [self.order[i] for i in select(matching, offset, limit)]
+
+    def facets(self, matching):
+        # (genre, films in `matching` that also have it) for every genre.
+        counts = []
+        for id, genre in sorted(self.names.values(),
+                                key=lambda item: item[1]):
+            count = (matching & self.bits[id]).bit_count()
+            if count:
+                counts.append((genre, count))
+        return counts
+
+
+class GenreIndex:
+    # films_genres edits reach genre_index_log through triggers and are
+    # applied bit by bit. New, deleted or re-ranked films change every
+    # position, as does a new genre, so those rebuild the whole index.
+    def __init__(self, max_changes=10000):
+        self.max_changes = max_changes
+        self._lock = threading.Lock()
+        self._current = None
+        self._stats = {'rebuilds': 0, 'applied': 0}
+
+    def _rebuild(self, db, seq):
+        order = [row[0] for row in db.execute("""SELECT id FROM films
+                 ORDER BY year DESC, value DESC, id DESC""")]
+        position = {id: i for i, id in enumerate(order)}
+        members = {}
+        for genre_id, film_id in db.execute("""SELECT genre_id, film_id
+                                            FROM films_genres
+                                            ORDER BY genre_id"""):
+            if film_id in position:
+                members.setdefault(genre_id, []).append(position[film_id])
+        names = {}
+        for id, genre in db.execute("SELECT id, genre FROM genres"):
+            names[genre.lower()] = (id, genre)
+        bits = {id: from_positions(members.get(id, ()), len(order))
+                for id, _ in names.values()}
+        self._stats['rebuilds'] += 1
+        return GenreBitmaps(seq, order, position, bits, names)
+
+    def _apply(self, db, seq):
+        current = self._current
+        changes = db.execute("""SELECT film_id, genre_id, added
+                             FROM genre_index_log WHERE seq > ?
+                             ORDER BY seq LIMIT ?""",
+                             (current.seq, self.max_changes + 1)).fetchall()
+        if len(changes) > self.max_changes:
+            return None
+        bits = dict(current.bits)
+        for film_id, genre_id, added in changes:
+            position = current.position.get(film_id)
+            if added is None or position is None or genre_id not in bits:
+                return None
+            if added:
+                bits[genre_id] |= 1 << position
+            else:
+                bits[genre_id] &= ~(1 << position)
+        self._stats['applied'] += len(changes)
+        return GenreBitmaps(seq, current.order, current.position, bits,
+                            current.names)
+
+    def refresh(self, db):
+        # Returns bitmaps that include every change logged so far. The log
+        # is read after its high-water mark, so a change landing in between
+        # is applied twice; setting and clearing bits is idempotent.
+        seq = db.execute("SELECT MAX(seq) FROM genre_index_log").fetchone()[0]
+        seq = seq or 0
+        with self._lock:
+            current = self._current
+            if current is None or current.seq != seq:
+                current = None if current is None else self._apply(db, seq)
+                self._current = current or self._rebuild(db, seq)
+            return self._current
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            current = self._current
+        if current is not None:
+            stats['films'] = len(current.order)
+            stats['genres'] = len(current.bits)
+            stats['seq'] = current.seq
+        return stats
@@ -0,0 +1,282 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class FrozenRow(tuple):
+    # Immutable stand-in for sqlite3.Row: indexable by position or by
+    # case-insensitive column name, as the templates expect.
+    __slots__ = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._index[key.lower()]
+            except KeyError:
+                raise IndexError(f"No item with that key: {key}")
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self._index)
+
+
+def row_class(columns):
+    index = {name.lower(): i for i, name in enumerate(columns)}
+    return type('FrozenRow', (FrozenRow,), {'__slots__': (),
+                                            '_index': index})
+
+
+def freeze(cursor):
+    cls = row_class([column[0] for column in cursor.description])
+    return tuple(cls(row) for row in cursor.fetchall())
+
+
+class ResultCache:
+    def __init__(self, path, ttl=60.0):
+        self.path = path
+        self.ttl = ttl
+        self._entries = {}
+        self._version = 0
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _data_version(self):
+        # data_version only moves when *another* connection commits, so a
+        # private read-only connection sees writes from every pool
+        # connection and from every other worker process.
+        if self._watcher is None:
+            self._watcher = sqlite3.connect(self.path,
+                                            check_same_thread=False)
+        return self._watcher.execute("PRAGMA data_version").fetchone()[0]
+
+    def bump(self):
+        with self._lock:
+            self._version += 1
+            self._stats['invalidations'] += 1
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            stamp = (self._version, self._data_version())
+            entry = self._entries.get(key)
+            if entry and entry[0] == stamp and entry[1] > now:
+                self._stats['hits'] += 1
+                return entry[2]
+            self._stats['misses'] += 1
+        value = loader()
+        with self._lock:
+            self._entries[key] = (stamp, now + self.ttl, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['version'] = self._version
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+class Stamps:
+    # When each key or tag was last invalidated, on a counter. A value
+    # loaded from token() on is stale if one of its names was bumped
+    # since; bumping other names leaves it alone. Past `limit` names the
+    # stamps are folded into one floor that holds back every load in
+    # flight. Not locked: the owning cache holds its lock.
+    def __init__(self, limit=10000):
+        self.limit = limit
+        self._clock = 0
+        self._floor = 0
+        self._stamps = {}
+
+    def token(self):
+        return self._clock
+
+    def bump(self, name):
+        self._clock += 1
+        if len(self._stamps) >= self.limit:
+            self.bump_all()
+        self._stamps[name] = self._clock
+
+    def bump_all(self):
+        self._clock += 1
+        self._stamps.clear()
+        self._floor = self._clock
+
+    def stale(self, token, names):
+        return token < self._floor or any(
+            self._stamps.get(name, 0) > token for name in names)
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._stamps = Stamps()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'invalidations': 0}
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (entry[0] is None or entry[0] > now):
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
+            token = self._stamps.token()
+        value = loader()
+        if value is None:
+            return None
+        expires = now + self.ttl if self.ttl else None
+        with self._lock:
+            # Don't store a value loaded before its key was invalidated.
+            if self._stamps.stale(token, (key,)):
+                return value
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._stamps.bump(key)
+            if self._entries.pop(key, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._stamps.bump_all()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['maxsize'] = self.maxsize
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+class PageCache:
+    # Rendered pages or template fragments, bounded by their total size
+    # and evicted least recently used first. Each entry lists the entity
+    # tags it was built from (such as 'film:42') and invalidating a tag
+    # drops them. After `ttl` seconds an entry goes stale: for `stale`
+    # more seconds the first caller to see it rebuilds it while everyone
+    # else is still served the stale copy. A value built while one of its
+    # own tags was invalidated is not stored.
+    def __init__(self, max_bytes=64 << 20, ttl=60.0, stale=300.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale = stale
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._bytes = 0
+        self._stamps = Stamps()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0,
+                       'refreshes': 0, 'evictions': 0, 'invalidations': 0}
+
+    def lookup(self, key):
+        # (value, None) to serve, or (None, token) when the caller should
+        # build the value and pass the token on to store().
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['stale_until'] <= now:
+                self._stats['misses'] += 1
+                return None, self._stamps.token()
+            self._entries.move_to_end(key)
+            if entry['fresh_until'] > now:
+                self._stats['hits'] += 1
+                return entry['value'], None
+            if entry['refreshing']:
+                self._stats['stale_hits'] += 1
+                return entry['value'], None
+            entry['refreshing'] = True
+            self._stats['refreshes'] += 1
+            return None, self._stamps.token()
+
+    def store(self, key, value, size, tags, token):
+        now = time.monotonic()
+        with self._lock:
+            # Don't store a value built before one of its tags was
+            # invalidated; the stale copy, if any, is refreshed again.
+            if size > self.max_bytes or self._stamps.stale(token, tags):
+                self._abandon(key)
+                return
+            self._drop(key)
+            self._entries[key] = {'value': value, 'size': size,
+                                  'tags': tuple(tags),
+                                  'fresh_until': now + self.ttl,
+                                  'stale_until': now + self.ttl + self.stale,
+                                  'refreshing': False}
+            self._bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def _abandon(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry['refreshing'] = False
+
+    def abandon(self, key):
+        # For a caller that got a token from lookup() but has nothing to
+        # store, so that the next lookup tries to refresh again.
+        with self._lock:
+            self._abandon(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry['size']
+        for tag in entry['tags']:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tag):
+        with self._lock:
+            self._stamps.bump(tag)
+            for key in list(self._tags.get(tag, ())):
+                self._drop(key)
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._stamps.bump_all()
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+            stats['max_bytes'] = self.max_bytes
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_ratio'] = ((stats['hits'] + stats['stale_hits']) / lookups
+                              if lookups else 0.0)
+        return stats
@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+import click
+from app import app, pool, leaderboards, film_details, pages, fragments
+from app.schema import migrate, schema_version, MIGRATIONS
+from app.models import Film, User
+from app.similarity import refresh
+from app.assets import build
+from app.importer import (CatalogLoader, FORMATS, detect_format,
+                          read_records, defer_schema, restore_schema,
+                          relaxed, restore, timed)
+
+
+@app.cli.command('upgrade-db')
+@click.option('--to', 'target', type=int, default=None,
+              help='Schema version to stop at.')
+def upgrade_db(target):
+    """Create the schema or upgrade it to the latest version."""
+    db = pool.acquire()
+    try:
+        before = schema_version(db)
+        applied = migrate(db, target)
+        click.echo(f"schema version {before} -> {schema_version(db)} "
+                   f"(latest {len(MIGRATIONS)})")
+        for version in applied:
+            click.echo(f"  applied migration {version}")
+    finally:
+        pool.release(db)
+
+
+@app.cli.command('repair-ratings')
+def repair_ratings():
+    """Rebuild every rating histogram and average from films_rates."""
+    histograms, films = Film().repair_ratings()
+    click.echo(f"rebuilt {histograms} histogram rows, "
+               f"refreshed {films} films")
+
+
+@app.cli.command('check-counters')
+@click.option('--repair', is_flag=True,
+              help='Recompute the counters that are off.')
+def check_counters(repair):
+    """Compare denormalized counters with the rows they count."""
+    drift = User().check_counters(repair)
+    for counter, rows in drift.items():
+        status = 'ok' if not rows else ('repaired' if repair else 'DRIFT')
+        click.echo(f"{counter:<24} {status} ({rows} rows off)")
+    if any(drift.values()) and not repair:
+        sys.exit(1)
+
+
+@app.cli.command('build-similar')
+@click.option('--full', is_flag=True,
+              help='Recompute every film, not just the changed ones.')
+def build_similar(full):
+    """Refresh films_similar from films_rates (needs numpy and scipy)."""
+    try:
+        import numpy  # noqa: F401
+        import scipy.sparse  # noqa: F401
+    except ImportError as error:
+        click.echo(f"build-similar needs numpy and scipy: {error}")
+        sys.exit(2)
+    db = pool.acquire()
+    try:
+        mode, films, pairs, elapsed = refresh(
+            db, full=full, k=app.config['SIMILAR_NEIGHBOURS'],
+            chunk=app.config['SIMILAR_CHUNK'],
+            shrink=app.config['SIMILAR_SHRINK'])
+    finally:
+        pool.release(db)
+    click.echo(f"{mode} build: {films} films, {pairs} neighbours "
+               f"in {elapsed:.1f} s")
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Write resized, fingerprinted static files and their manifest."""
+    try:
+        import PIL  # noqa: F401
+    except ImportError as error:
+        click.echo(f"build-assets needs Pillow: {error}")
+        sys.exit(2)
+    entries, built, reused = build(app.config['ASSET_WIDTHS'],
+                                   app.config['ASSET_FORMATS'],
+                                   app.config['ASSET_QUALITY'])
+    before = after = text = encoded = 0
+    for entry in entries.values():
+        if entry.get('encoded'):
+            text += entry['bytes']
+            encoded += min(entry['encoded'].values())
+        if entry.get('variants'):
+            # Original size against the smallest encoding at full width.
+            before += entry['bytes']
+            after += min(os.path.getsize(os.path.join(app.static_folder,
+                                                      sizes[-1][1]))
+                         for sizes in entry['variants'].values())
+    click.echo(f"{built} files built, {reused} unchanged; images "
+               f"{before / 1e6:.1f} MB -> {after / 1e6:.1f} MB "
+               f"at full width in the smallest format; text "
+               f"{text / 1e3:.1f} kB -> {encoded / 1e3:.1f} kB precompressed")
+
+
+@app.cli.command('import-catalog')
+@click.argument('kind', type=click.Choice(['films', 'persons']))
+@click.argument('path')
+@click.option('--format', 'format', type=click.Choice(FORMATS),
+              help='Input format when the extension does not tell.')
+@click.option('--batch', type=int, default=None,
+              help='Records per transaction.')
+@click.option('--drop-indexes', 'deferred', is_flag=True,
+              help='Drop the ranking indexes and search triggers for the '
+                   'load and build them once at the end; listings and '
+                   'search are slow or stale until then.')
+def import_catalog(kind, path, format, batch, deferred):
+    """Upsert films or persons from a TSV, CSV or JSONL dump ('-' for
+    stdin). Load persons first so that film casts can find them."""
+    format = format or detect_format(path)
+    if format is None:
+        click.echo(f"cannot tell the format of {path}, use --format")
+        sys.exit(2)
+    db = pool.acquire()
+    saved = relaxed(db, app.config['IMPORT_CACHE_KIB'])
+    start = time.perf_counter()
+    try:
+        # Left over from an interrupted --drop-indexes run.
+        if restore_schema(db):
+            click.echo("restored indexes dropped by an earlier load")
+        if deferred:
+            defer_schema(db)
+        loader = CatalogLoader(db, batch or app.config['IMPORT_BATCH'])
+        load = loader.films if kind == 'films' else loader.persons
+        for stats in load(read_records(path, format)):
+            elapsed, rate = timed(stats, start)
+            click.echo(f"\r{stats['read']} records, {rate:.0f}/s",
+                       nl=False)
+        click.echo()
+    finally:
+        if deferred:
+            click.echo("rebuilding indexes")
+        restore_schema(db)
+        db.execute("PRAGMA optimize")
+        restore(db, saved)
+        pool.release(db)
+    leaderboards.bump()
+    film_details.clear()
+    pages.clear()
+    fragments.clear()
+    elapsed, rate = timed(loader.stats, start)
+    click.echo(f"{kind}: {loader.stats['read']} read, "
+               f"{loader.stats['written']} inserted or updated, "
+               f"{loader.stats['unchanged']} unchanged, "
+               f"{loader.stats['relinked']} relinked, "
+               f"{loader.stats['skipped']} skipped, "
+               f"{loader.stats['unknown_persons']} unknown cast members "
+               f"in {elapsed:.1f} s ({rate:.0f} records/s)")
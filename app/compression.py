@@ -0,0 +1,148 @@
+import gzip
+import mimetypes
+import os
+import threading
+from flask import request
+from app import app
+
+
+# Dynamic responses of a text type and at least COMPRESS_MIN_SIZE bytes
+# are compressed per request with brotli (when the module is installed)
+# or gzip, whichever the client prefers. Pages from the page cache keep
+# their compressed bodies next to the plain one, so a cache hit is
+# compressed once per encoding rather than once per request.
+#
+# Static files are never compressed here: `flask build-assets` writes
+# .br and .gz siblings of the fingerprinted text files and send_static
+# serves those as they are. Images are already compressed and skipped.
+
+ENCODINGS = ('br', 'gzip')
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+TEXT_EXTENSIONS = ('.css', '.js', '.json', '.svg', '.txt', '.xml', '.ico')
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def encode(data, encoding, level):
+    if encoding == 'br':
+        return _brotli().compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def available():
+    return ENCODINGS if _brotli() is not None else ('gzip',)
+
+
+class Compressor:
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=4,
+                 mimetypes=()):
+        self.min_size = min_size
+        self.levels = {'gzip': gzip_level, 'br': brotli_quality}
+        self.mimetypes = frozenset(mimetypes)
+        self.encodings = available()
+        self._lock = threading.Lock()
+        self._stats = {'compressed': 0, 'reused': 0, 'static': 0,
+                       'bytes_in': 0, 'bytes_out': 0, 'static_bytes_in': 0,
+                       'static_bytes_out': 0}
+
+    def negotiate(self, accept):
+        # The supported encoding with the highest q-value, brotli on ties.
+        best, quality = None, 0
+        for encoding in self.encodings:
+            q = accept.quality(encoding)
+            if q > quality:
+                best, quality = encoding, q
+        return best
+
+    def compress(self, data, encoding, cache=None):
+        # `cache` is a dict of bodies by encoding kept with a cached page.
+        body = cache.get(encoding) if cache is not None else None
+        kind = 'reused'
+        if body is None:
+            body = encode(data, encoding, self.levels[encoding])
+            kind = 'compressed'
+            if cache is not None:
+                cache[encoding] = body
+        self.count(kind, len(data), len(body))
+        return body
+
+    def count(self, kind, before, after):
+        prefix = 'static_' if kind == 'static' else ''
+        with self._lock:
+            self._stats[kind] += 1
+            self._stats[prefix + 'bytes_in'] += before
+            self._stats[prefix + 'bytes_out'] += after
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+        stats['static_bytes_saved'] = (stats['static_bytes_in']
+                                       - stats['static_bytes_out'])
+        stats['encodings'] = list(self.encodings)
+        return stats
+
+
+compressor = Compressor(min_size=app.config['COMPRESS_MIN_SIZE'],
+                        gzip_level=app.config['COMPRESS_GZIP_LEVEL'],
+                        brotli_quality=app.config['COMPRESS_BROTLI_QUALITY'],
+                        mimetypes=app.config['COMPRESS_MIMETYPES'])
+
+
+def _vary(response):
+    response.vary.add('Accept-Encoding')
+
+
+@app.after_request
+def compress(response):
+    if (request.method == 'HEAD' or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in compressor.mimetypes):
+        return response
+    data = response.get_data()
+    if len(data) < compressor.min_size:
+        return response
+    _vary(response)
+    encoding = compressor.negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compressor.compress(
+        data, encoding, getattr(response, 'encoded', None)))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed body is a different representation; a weak ETag
+    # still matches the plain one on revalidation.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def send_static(filename):
+    # Serves build/<file>.br or .gz in place of build/<file> when the
+    # client accepts it and the build wrote one.
+    if filename.startswith('build/') and filename.endswith(TEXT_EXTENSIONS):
+        encoding = compressor.negotiate(request.accept_encodings)
+        path = os.path.join(app.static_folder, filename)
+        if encoding and os.path.isfile(path + SUFFIXES[encoding]):
+            response = app.send_static_file(filename + SUFFIXES[encoding])
+            if response.status_code == 200:
+                compressor.count('static', os.path.getsize(path),
+                                 response.content_length or 0)
+            response.mimetype = (mimetypes.guess_type(filename)[0]
+                                 or 'application/octet-stream')
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = app.send_static_file(filename)
+        _vary(response)
+        return response
+    return app.send_static_file(filename)
+
+
+app.view_functions['static'] = send_static
@@ -0,0 +1,77 @@
+import glob
+import hashlib
+import os
+import time
+from functools import wraps
+from flask import g, request, make_response
+from app import app, writer
+from app.models import DataBase
+
+
+def _release():
+    # Newest code or template mtime, so a deploy changes every ETag.
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = (glob.glob(os.path.join(root, '*.py'))
+             + glob.glob(os.path.join(root, 'templates', '*.html')))
+    return int(max(os.path.getmtime(path) for path in paths))
+
+
+RELEASE = _release()
+
+
+class Versions(DataBase):
+    def load(self, entities):
+        cur = self.db.cursor()
+        marks = ','.join('?' * len(entities))
+        return sorted(tuple(row) for row in cur.execute(
+            f"""SELECT entity, version, modified FROM entity_versions
+            WHERE entity IN ({marks})""", entities))
+
+
+def conditional(*entities):
+    # ETag and Last-Modified from the entity_versions of the page's
+    # entities (formatted with the view's arguments, e.g. 'film:{film_id}')
+    # and of the signed-in viewer. A matching If-None-Match, or failing
+    # that If-Modified-Since, gets a 304 before the view runs. ETags also
+    # roll over every ETAG_WINDOW seconds, which bounds how old the
+    # "3 hr ago" labels and CSRF tokens of a revalidated page can get.
+    # Signed-in viewers' write-behind queue is drained first.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(**kwargs)
+            names = [entity.format(**kwargs) for entity in entities]
+            if g.username:
+                names.append(f"user:{g.username}")
+            if g.user_id:
+                # The viewer's own queued writes (a rating just made) must
+                # be in the versions, or the page would revalidate stale.
+                writer.wait_for(g.user_id)
+            rows = Versions().load(names)
+            now = int(time.time())
+            window = now - now % app.config['ETAG_WINDOW']
+            stamp = repr((RELEASE, window, g.user_id, request.full_path,
+                          rows))
+            etag = hashlib.sha1(stamp.encode()).hexdigest()[:24]
+            modified = max([RELEASE, window] + [row[2] for row in rows])
+            since = request.if_modified_since
+            if request.if_none_match:
+                fresh = request.if_none_match.contains_weak(etag)
+            else:
+                fresh = (since is not None
+                         and modified <= int(since.timestamp()))
+            if fresh:
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = modified
+            response.headers['Cache-Control'] = ('private, no-cache'
+                                                 if g.user_id else
+                                                 'public, no-cache')
+            return response
+        return wrapper
+    return decorator
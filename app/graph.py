@@ -0,0 +1,169 @@
+import heapq
+import threading
+import time
+from array import array
+from collections import Counter
+
+
+class Adjacency:
+    # CSR layout: the neighbours of user u are
+    # targets[offsets[u]:offsets[u + 1]], sorted, with user ids as row
+    # numbers.
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def load(cls, rows, size):
+        # `rows` are (source, target) pairs ordered by source then target.
+        counts = array('i', bytes(4 * (size + 2)))
+        targets = array('i')
+        last = None
+        for pair in rows:
+            if pair == last or pair[0] > size:
+                continue
+            last = pair
+            targets.append(pair[1])
+            counts[pair[0] + 1] += 1
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return cls(counts, targets)
+
+    def row(self, id):
+        if not 0 <= id < len(self.offsets) - 1:
+            return self.targets[0:0]
+        return self.targets[self.offsets[id]:self.offsets[id + 1]]
+
+
+class Graph:
+    # Follow edges loaded once into two CSR arrays (who a user follows,
+    # who follows them) plus small per-user overlays for the follows and
+    # unfollows made since.
+    def __init__(self, following, followers):
+        self.following = following
+        self.followers = followers
+        self.changes = 0
+        self._added = ({}, {})
+        self._removed = ({}, {})
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, db):
+        size = db.execute("SELECT MAX(id) FROM users").fetchone()[0] or 0
+        following = Adjacency.load(db.execute("""SELECT is_following,
+            following FROM followed ORDER BY is_following, following"""),
+            size)
+        followers = Adjacency.load(db.execute("""SELECT following,
+            is_following FROM followed ORDER BY following, is_following"""),
+            size)
+        return cls(following, followers)
+
+    def apply(self, user_id, foll_id, added):
+        with self._lock:
+            for side, (a, b) in enumerate(((user_id, foll_id),
+                                           (foll_id, user_id))):
+                grow, shrink = ((self._added, self._removed) if added
+                                else (self._removed, self._added))
+                shrink[side].get(a, set()).discard(b)
+                grow[side].setdefault(a, set()).add(b)
+            self.changes += 1
+
+    def _neighbours(self, side, id):
+        base = (self.following, self.followers)[side].row(id)
+        with self._lock:
+            added = self._added[side].get(id)
+            removed = self._removed[side].get(id)
+            if not added and not removed:
+                return set(base)
+            return (set(base) - (removed or set())) | (added or set())
+
+    def following_of(self, id):
+        return self._neighbours(0, id)
+
+    def followers_of(self, id):
+        return self._neighbours(1, id)
+
+    def mutuals(self, id):
+        # Users that `id` follows and who follow back.
+        return self.following_of(id) & self.followers_of(id)
+
+    def suggestions(self, id, limit=5, fanout=200):
+        # Friends of friends `id` doesn't follow yet, ranked by how many
+        # of the people `id` follows also follow them. Only the first
+        # `fanout` followings of each hop are walked.
+        following = self.following_of(id)
+        shared = Counter()
+        for friend in sorted(following)[:fanout]:
+            for candidate in sorted(self.following_of(friend))[:fanout]:
+                shared[candidate] += 1
+        shared.pop(id, None)
+        for followed in following:
+            shared.pop(followed, None)
+        return heapq.nsmallest(limit, shared.items(),
+                               key=lambda item: (-item[1], item[0]))
+
+
+class SocialGraph:
+    # Loaded on first use and reloaded from followed once it is `ttl`
+    # seconds old or has taken `max_changes` incremental updates, which
+    # also picks up follows made by other processes. Reloads run off the
+    # lock; updates made meanwhile are replayed onto the new graph. Being
+    # up to `ttl` behind is fine for suggestions and mutual follow
+    # counts; whether one user follows another is read from followed.
+    def __init__(self, ttl=300.0, max_changes=10000):
+        self.ttl = ttl
+        self.max_changes = max_changes
+        self._graph = None
+        self._loaded = 0.0
+        self._journal = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._stats = {'loads': 0, 'load_time': 0.0, 'updates': 0}
+
+    def _stale(self, graph):
+        return (graph is None or graph.changes >= self.max_changes
+                or time.monotonic() - self._loaded > self.ttl)
+
+    def refresh(self, db):
+        graph = self._graph
+        if not self._stale(graph):
+            return graph
+        # Only the first caller reloads; the rest keep the current graph.
+        if not self._load_lock.acquire(blocking=graph is None):
+            return graph
+        try:
+            if self._graph is not graph and not self._stale(self._graph):
+                return self._graph
+            with self._lock:
+                self._journal = []
+            start = time.perf_counter()
+            graph = Graph.load(db)
+            with self._lock:
+                for update in self._journal:
+                    graph.apply(*update)
+                self._journal = None
+                self._graph = graph
+                self._loaded = time.monotonic()
+                self._stats['loads'] += 1
+                self._stats['load_time'] = time.perf_counter() - start
+            return graph
+        finally:
+            self._load_lock.release()
+
+    def update(self, user_id, foll_id, added):
+        # Called after a follow or unfollow has committed.
+        with self._lock:
+            if self._graph is not None:
+                self._graph.apply(user_id, foll_id, added)
+            if self._journal is not None:
+                self._journal.append((user_id, foll_id, added))
+            self._stats['updates'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            graph = self._graph
+        if graph is not None:
+            stats['edges'] = len(graph.following.targets)
+            stats['pending_changes'] = graph.changes
+        return stats
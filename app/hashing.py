@@ -0,0 +1,97 @@
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+ALGORITHM = 'pbkdf2_sha256'
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def make_hash(password, iterations, salt=None):
+    salt = os.urandom(16) if salt is None else salt
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf8'),
+                                 salt, iterations)
+    return f"{ALGORITHM}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def check_hash(password, stored, legacy_salt, legacy_iterations=150000):
+    # Returns (matches, iterations the stored hash was made with).
+    # Hashes from before per-user salts are a bare hex digest made with
+    # the global SALT.
+    if stored.startswith(ALGORITHM + '$'):
+        _, iterations, salt, expected = stored.split('$')
+        iterations = int(iterations)
+        candidate = make_hash(password, iterations, bytes.fromhex(salt))
+        return hmac.compare_digest(candidate, stored), iterations
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf8'),
+                                 legacy_salt, legacy_iterations).hex()
+    return hmac.compare_digest(digest, stored), None
+
+
+class Hasher:
+    # PBKDF2 runs in OpenSSL with the GIL released, so a small thread
+    # pool gives real parallelism while capping how many cores login and
+    # registration bursts can take away from page requests. When all
+    # workers and queue slots are taken, callers get HasherBusy at once
+    # instead of piling up behind each other.
+    def __init__(self, workers=2, queue=8, iterations=150000,
+                 timeout=5.0, legacy_salt=b''):
+        self.iterations = iterations
+        self.timeout = timeout
+        self.legacy_salt = legacy_salt
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='hasher')
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._lock = threading.Lock()
+        self._stats = {'hashed': 0, 'verified': 0, 'rejected_busy': 0,
+                       'upgraded': 0}
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected_busy'] += 1
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(func, *args)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+
+    def _verify(self, password, stored):
+        ok, iterations = check_hash(password, stored, self.legacy_salt)
+        upgraded = None
+        if ok and iterations != self.iterations:
+            upgraded = make_hash(password, self.iterations)
+        return ok, upgraded
+
+    def hash(self, password):
+        result = self._run(make_hash, password, self.iterations)
+        with self._lock:
+            self._stats['hashed'] += 1
+        return result
+
+    def verify(self, password, stored):
+        # Returns (matches, new hash to store or None). A new hash is
+        # produced when the stored one uses another iteration count.
+        ok, upgraded = self._run(self._verify, password, stored)
+        with self._lock:
+            self._stats['verified'] += 1
+            if upgraded:
+                self._stats['upgraded'] += 1
+        return ok, upgraded
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['iterations'] = self.iterations
+        return stats
@@ -0,0 +1,35 @@
+from flask import g, session
+from app import app, user_ids
+from app.models import User
+
+
+def user_id(name):
+    # Usernames never change owner, so found ids can be cached across
+    # requests. Unknown names are not cached and are looked up again.
+    return user_ids.get(name, lambda: User().current_user(name))
+
+
+def sign_in(name, id, remember=False):
+    session.permanent = remember
+    session['__auth'] = name
+    session['__uid'] = id
+
+
+def sign_out():
+    session.pop('__auth', None)
+    session.pop('__uid', None)
+
+
+@app.before_request
+def load_identity():
+    g.username = session.get('__auth')
+    g.user_id = None
+    if g.username is None:
+        return
+    if session.get('__uid') is None:
+        # Sessions from before the id was stored at login.
+        session['__uid'] = user_id(g.username)
+    g.user_id = session['__uid']
+    if g.user_id is None:
+        sign_out()
+        g.username = None
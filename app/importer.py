@@ -0,0 +1,375 @@
+import csv
+import gzip
+import io
+import json
+import sqlite3
+import sys
+import time
+from itertools import islice
+
+
+# Streaming catalog loads for `flask import-catalog`. Records are read
+# one at a time from TSV, CSV or JSONL (optionally gzipped) and written
+# `batch` at a time, each batch in its own transaction, so memory stays
+# bounded and other writers get the lock between batches.
+#
+# Films and persons are upserted by their upstream source_id. A row whose
+# columns are all unchanged is not rewritten, so it fires no triggers
+# (full-text index, entity versions, genre log). A film's genres and
+# cast, and a person's types, are only replaced when they differ from
+# what is stored. Persons should be loaded before the films that list
+# them; cast members that are still unknown are skipped and counted.
+#
+# Film records:   source_id, title, original_title, year, premdate,
+#                 body, img, trailer, value, box_office, rate, votes,
+#                 genres, directors, actors
+# Person records: source_id, name, img, body, types
+#
+# genres, directors, actors and types are lists (of genre names, person
+# source_ids and type names); flat files give them comma-separated. A
+# list that is missing from a record leaves the stored one alone.
+
+FORMATS = ('tsv', 'csv', 'jsonl')
+NULLS = ('', '\\N')
+DIRECTOR, ACTOR = 1, 2
+CAST = (('directors', DIRECTOR), ('actors', ACTOR))
+
+FILM_COLUMNS = ('source_id', 'title', 'original_title', 'year', 'premdate',
+                'genres', 'body', 'img', 'trailer', 'value', 'box_office',
+                'imported_votes', 'imported_sum')
+PERSON_COLUMNS = ('source_id', 'name', 'img', 'body')
+
+# What --drop-indexes removes for the load and puts back at the end:
+# the secondary indexes nothing in the load reads, and the triggers
+# keeping the search index in step, whose cost per row grows with the
+# index. The search index is rebuilt in one pass instead.
+DEFERRED_INDEXES = ('films_value', 'films_box_office', 'films_year_value',
+                    'films_genres_genre_film', 'films_casts_person_type')
+SEARCH_TRIGGERS = {
+    'films_fts': ('films_fts_insert', 'films_fts_delete', 'films_fts_update'),
+    'persons_fts': ('persons_fts_insert', 'persons_fts_delete',
+                    'persons_fts_update')}
+
+# Matches Film.REFRESH_RATING: the imported votes plus the site's own.
+LOCAL_VOTES = """COALESCE((SELECT SUM(votes) FROM films_rates_histogram
+    WHERE film_id = films.id), 0)"""
+LOCAL_SUM = """COALESCE((SELECT SUM(score * votes) FROM films_rates_histogram
+    WHERE film_id = films.id), 0)"""
+
+
+def _value(table, column):
+    # A film record without a genres list keeps the stored genres.
+    if column == 'genres':
+        return f"COALESCE(excluded.genres, {table}.genres)"
+    return f"excluded.{column}"
+
+
+def _upsert(table, columns, derived=()):
+    # `derived` are (column, value on insert, expression on update) for
+    # columns computed rather than copied from the record.
+    names = ', '.join(list(columns) + [column for column, _, _ in derived])
+    values = ', '.join([f":{column}" for column in columns]
+                       + [value for _, value, _ in derived])
+    updated = [column for column in columns if column != 'source_id']
+    sets = ', '.join([f"{column} = {_value(table, column)}"
+                      for column in updated]
+                     + [f"{column} = {expression}"
+                        for column, _, expression in derived])
+    changed = ' OR '.join(f"{table}.{column} IS NOT {_value(table, column)}"
+                          for column in updated)
+    return f"""INSERT INTO {table} ({names}) VALUES ({values})
+    ON CONFLICT (source_id) WHERE source_id IS NOT NULL DO UPDATE
+    SET {sets} WHERE {changed}"""
+
+
+UPSERT_FILM = _upsert('films', FILM_COLUMNS, (
+    ('votes', ':imported_votes',
+     f"excluded.imported_votes + {LOCAL_VOTES}"),
+    ('rate', ':rate',
+     f"""COALESCE((excluded.imported_sum + {LOCAL_SUM})
+        / NULLIF(excluded.imported_votes + {LOCAL_VOTES}, 0), 0)""")))
+UPSERT_PERSON = _upsert('persons', PERSON_COLUMNS)
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    extension = name.rsplit('.', 1)[-1].lower()
+    return extension if extension in FORMATS else None
+
+
+def read_records(path, format):
+    # Yields one dict per record; '-' reads standard input.
+    if path == '-':
+        handle = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    elif path.endswith('.gz'):
+        handle = gzip.open(path, 'rt', encoding='utf-8', newline='')
+    else:
+        handle = open(path, encoding='utf-8', newline='')
+    with handle:
+        if format == 'jsonl':
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        reader = csv.DictReader(handle, **(
+            {'delimiter': '\t', 'quoting': csv.QUOTE_NONE}
+            if format == 'tsv' else {}))
+        for row in reader:
+            yield {key: None if value in NULLS else value
+                   for key, value in row.items()}
+
+
+def batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _list(value):
+    if value is None or isinstance(value, list):
+        return value
+    return [item.strip() for item in str(value).split(',') if item.strip()]
+
+
+def _number(value, kind):
+    return None if value in (None, '') else kind(value)
+
+
+def film_row(record):
+    # The films row for a record, or None when it has no key or title.
+    if not record.get('source_id') or not record.get('title'):
+        return None
+    votes = _number(record.get('votes'), int) or 0
+    rate = _number(record.get('rate'), float) or 0.0
+    genres = _list(record.get('genres'))
+    return {'source_id': str(record['source_id']),
+            'title': record['title'],
+            'original_title': record.get('original_title'),
+            'year': _number(record.get('year'), int),
+            'premdate': record.get('premdate'),
+            'genres': ', '.join(genres) if genres is not None else None,
+            'body': record.get('body'), 'img': record.get('img'),
+            'trailer': record.get('trailer'),
+            'value': _number(record.get('value'), float) or 0.0,
+            'box_office': _number(record.get('box_office'), int),
+            'imported_votes': votes, 'imported_sum': rate * votes,
+            'rate': rate if votes else 0.0}
+
+
+def person_row(record):
+    if not record.get('source_id') or not record.get('name'):
+        return None
+    return {'source_id': str(record['source_id']), 'name': record['name'],
+            'img': record.get('img'), 'body': record.get('body')}
+
+
+class CatalogLoader:
+    def __init__(self, db, batch=5000):
+        self.db = db
+        self.batch = batch
+        self.genres = {name.lower(): id for id, name in db.execute(
+            "SELECT id, genre FROM genres")}
+        self.types = {name.lower(): id for id, name in db.execute(
+            "SELECT id, type FROM types")}
+        self.stats = {'read': 0, 'written': 0, 'unchanged': 0,
+                      'relinked': 0, 'skipped': 0, 'unknown_persons': 0}
+
+    def _ids(self, cur, table, keys):
+        # {source_id: id} for the given upstream keys.
+        ids = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            ids.update((source, id) for id, source in cur.execute(
+                f"""SELECT id, source_id FROM {table}
+                WHERE source_id IN ({','.join('?' * len(chunk))})""",
+                chunk))
+        return ids
+
+    def _lookup(self, cur, names, cache, table, column):
+        # Ids of genre or type names, adding the ones not seen before.
+        ids = []
+        for name in names:
+            id = cache.get(name.lower())
+            if id is None:
+                cur.execute(f"INSERT INTO {table} ({column}) VALUES (?)",
+                            (name,))
+                id = cache[name.lower()] = cur.lastrowid
+            ids.append(id)
+        return ids
+
+    def _relink(self, cur, table, owner, columns, wanted, fixed=None):
+        # Replaces the link rows of the owners in `wanted` whose stored
+        # links differ. `wanted` maps owner id to a list of column tuples;
+        # `fixed` (column, value) narrows the links to one kind.
+        where, extra = '', ()
+        if fixed is not None:
+            where, extra = f" AND {fixed[0]} = ?", (fixed[1],)
+        current = {id: [] for id in wanted}
+        ids = list(wanted)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for row in cur.execute(
+                    f"""SELECT {owner}, {', '.join(columns)} FROM {table}
+                    WHERE {owner} IN ({','.join('?' * len(chunk))}){where}
+                    ORDER BY {owner}, id""", chunk + list(extra)):
+                current[row[0]].append(tuple(row)[1:])
+        changed = [id for id in ids if current[id] != wanted[id]]
+        cur.executemany(f"DELETE FROM {table} WHERE {owner} = ?{where}",
+                        [(id,) + extra for id in changed])
+        names = (owner,) + tuple(columns) + ((fixed[0],) if fixed else ())
+        cur.executemany(
+            f"""INSERT INTO {table} ({', '.join(names)})
+            VALUES ({', '.join('?' * len(names))})""",
+            [(id,) + link + extra for id in changed for link in wanted[id]])
+        return len(changed)
+
+    def _write(self, rows, upsert, table, link):
+        cur = self.db.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.executemany(upsert, [row for row, _ in rows])
+            self.stats['written'] += max(cur.rowcount, 0)
+            ids = self._ids(cur, table, [row['source_id'] for row, _ in rows])
+            self.stats['relinked'] += link(cur, ids)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+
+    def _records(self, records, to_row):
+        for batch in batches(records, self.batch):
+            rows = []
+            for record in batch:
+                self.stats['read'] += 1
+                try:
+                    row = to_row(record)
+                except (TypeError, ValueError):
+                    row = None
+                if row is None:
+                    self.stats['skipped'] += 1
+                else:
+                    rows.append((row, record))
+            # The last record for a key wins within a batch.
+            yield list({row['source_id']: (row, record)
+                        for row, record in rows}.values())
+
+    def films(self, records):
+        # Loads film records; yields the running stats after each batch.
+        for rows in self._records(records, film_row):
+            def link(cur, ids):
+                genres, casts, people = {}, {DIRECTOR: {}, ACTOR: {}}, set()
+                for row, record in rows:
+                    for key, _ in CAST:
+                        people.update(_list(record.get(key)) or ())
+                persons = self._ids(cur, 'persons', people)
+                for row, record in rows:
+                    id = ids[row['source_id']]
+                    names = _list(record.get('genres'))
+                    if names is not None:
+                        genres[id] = [(genre,) for genre in dict.fromkeys(
+                            self._lookup(cur, names, self.genres, 'genres',
+                                         'genre'))]
+                    for key, type in CAST:
+                        sources = _list(record.get(key))
+                        if sources is None:
+                            continue
+                        known = [source for source in sources
+                                 if source in persons]
+                        self.stats['unknown_persons'] += (len(sources)
+                                                          - len(known))
+                        casts[type][id] = [(person,) for person in
+                                           dict.fromkeys(persons[source]
+                                                         for source in known)]
+                return (self._relink(cur, 'films_genres', 'film_id',
+                                     ('genre_id',), genres)
+                        + sum(self._relink(cur, 'films_casts', 'film_id',
+                                           ('person_id',), casts[type],
+                                           ('type', type))
+                              for _, type in CAST))
+            self._write(rows, UPSERT_FILM, 'films', link)
+            self.stats['unchanged'] = self.stats['read'] - self.stats[
+                'skipped'] - self.stats['written']
+            yield dict(self.stats)
+
+    def persons(self, records):
+        for rows in self._records(records, person_row):
+            def link(cur, ids):
+                types = {}
+                for row, record in rows:
+                    names = _list(record.get('types'))
+                    if names is not None:
+                        types[ids[row['source_id']]] = [
+                            (type,) for type in dict.fromkeys(self._lookup(
+                                cur, names, self.types, 'types', 'type'))]
+                return self._relink(cur, 'persons_types', 'person_id',
+                                    ('type_id',), types)
+            self._write(rows, UPSERT_PERSON, 'persons', link)
+            self.stats['unchanged'] = self.stats['read'] - self.stats[
+                'skipped'] - self.stats['written']
+            yield dict(self.stats)
+
+
+def defer_schema(db):
+    # Drops the deferred indexes and search triggers, saving their SQL in
+    # deferred_schema. Returns how many were dropped.
+    names = DEFERRED_INDEXES + sum(SEARCH_TRIGGERS.values(), ())
+    cur = db.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        rows = cur.execute(f"""SELECT type, name, sql FROM sqlite_master
+        WHERE name IN ({','.join('?' * len(names))})""", names).fetchall()
+        for type, name, sql in rows:
+            cur.execute("""INSERT OR REPLACE INTO deferred_schema (name, sql)
+            VALUES (?, ?)""", (name, sql))
+            cur.execute(f"DROP {type.upper()} {name}")
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    return len(rows)
+
+
+def restore_schema(db):
+    # Creates what defer_schema dropped, rebuilding a search index whose
+    # triggers were missing. Returns how many were restored.
+    cur = db.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        rows = cur.execute("SELECT name, sql FROM deferred_schema").fetchall()
+        for name, sql in rows:
+            cur.execute(sql)
+        restored = {name for name, _ in rows}
+        for table, triggers in SEARCH_TRIGGERS.items():
+            if restored & set(triggers):
+                cur.execute(f"""INSERT INTO {table} ({table})
+                VALUES ('rebuild')""")
+        cur.execute("DELETE FROM deferred_schema")
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    return len(rows)
+
+
+def relaxed(db, cache_kib):
+    # No fsync per commit and a large page cache for the loading
+    # connection only; returns the settings to restore.
+    saved = {name: db.execute(f"PRAGMA {name}").fetchone()[0]
+             for name in ('synchronous', 'cache_size')}
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute(f"PRAGMA cache_size = {-cache_kib}")
+    return saved
+
+
+def restore(db, saved):
+    for name, value in saved.items():
+        db.execute(f"PRAGMA {name} = {value}")
+
+
+def timed(stats, start):
+    elapsed = time.perf_counter() - start
+    return elapsed, stats['read'] / elapsed if elapsed else 0.0
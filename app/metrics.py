@@ -0,0 +1,181 @@
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request
+from app import (app, tracer, pool, pages, fragments, film_details,
+                 leaderboards, user_ids)
+
+
+# Every statement on a pooled connection is timed by app.tracing and
+# charged to the request that ran it. Per route, /metrics exposes the
+# latency and SQL time histograms and the statement count; the caches and
+# the pool are read from their stats() when it is scraped. With
+# SQL_DEBUG_HEADER on, each response carries its own breakdown:
+#
+#   Server-Timing: db;dur=4.12;desc="9 statements", app;dur=7.80
+#   X-SQL-Top: 2.31ms x1 SELECT films.id, ... WHERE films.id = ?
+#
+# Statements slower than SQL_SLOW_MS go to the app.tracing logger with
+# their query plan.
+
+CACHES = {'pages': pages, 'fragments': fragments,
+          'film_details': film_details, 'leaderboards': leaderboards,
+          'user_ids': user_ids}
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names,
+                                                                values))
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, values, amount):
+        series = self._series.get(values)
+        if series is None:
+            series = [0] * (len(self.buckets) + 1) + [0.0]
+            self._series[values] = series
+        series[bisect_left(self.buckets, amount)] += 1
+        series[-1] += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, series in sorted(self._series.items()):
+            labels = _labels(self.labels, values)
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                total += count
+                yield f'{self.name}_bucket{{{labels},le="{bound}"}} {total}'
+            yield f"{self.name}_sum{{{labels}}} {series[-1]:.6f}"
+            yield f"{self.name}_count{{{labels}}} {total}"
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+
+    def inc(self, values, amount=1):
+        self._series[values] = self._series.get(values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for values, total in sorted(self._series.items()):
+            yield f"{self.name}{{{_labels(self.labels, values)}}} {total}"
+
+
+class Metrics:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.latency = Histogram('movieflow_request_seconds',
+                                 'Time to handle a request.',
+                                 ('route', 'method'), buckets)
+        self.sql_time = Histogram('movieflow_request_sql_seconds',
+                                  'SQL time per request.', ('route',),
+                                  buckets)
+        self.statements = Counter('movieflow_sql_statements_total',
+                                  'SQL statements executed.', ('route',))
+        self.responses = Counter('movieflow_responses_total',
+                                 'Responses sent.', ('route', 'status'))
+
+    def observe(self, route, method, status, seconds, recorder):
+        with self._lock:
+            self.latency.observe((route, method), seconds)
+            self.sql_time.observe((route,), recorder.seconds)
+            self.statements.inc((route,), recorder.count)
+            self.responses.inc((route, status))
+
+    def render(self):
+        with self._lock:
+            lines = [line for metric in (self.latency, self.sql_time,
+                                         self.statements, self.responses)
+                     for line in metric.render()]
+        lines += _snapshots()
+        return '\n'.join(lines) + '\n'
+
+
+def _family(name, help, kind, samples):
+    yield f"# HELP {name} {help}"
+    yield f"# TYPE {name} {kind}"
+    for labels, value in samples:
+        yield f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+
+def _snapshots():
+    caches = {name: cache.stats() for name, cache in CACHES.items()}
+    db_pool = pool.stats()
+    lines = []
+    for name, help, kind, samples in (
+            ('movieflow_cache_hits_total', 'Cache lookups answered, stale '
+             'page cache hits included.', 'counter',
+             [(f'cache="{name}"', stats['hits'] + stats.get('stale_hits', 0))
+              for name, stats in caches.items()]),
+            ('movieflow_cache_misses_total', 'Cache lookups missed.',
+             'counter', [(f'cache="{name}"', stats['misses'])
+                         for name, stats in caches.items()]),
+            ('movieflow_cache_hit_ratio', 'Hits over lookups since start.',
+             'gauge', [(f'cache="{name}"', f"{stats['hit_ratio']:.4f}")
+                       for name, stats in caches.items()]),
+            ('movieflow_db_pool_connections', 'Pooled connections.',
+             'gauge', [('state="in_use"', db_pool['in_use']),
+                       ('state="idle"', db_pool['idle'])]),
+            ('movieflow_db_pool_waits_total', 'Acquires that had to wait.',
+             'counter', [('', db_pool['waits'])]),
+            ('movieflow_db_pool_timeouts_total', 'Acquires that gave up.',
+             'counter', [('', db_pool['timeouts'])]),
+            ('movieflow_sql_slow_total', 'Statements over SQL_SLOW_MS.',
+             'counter', [('', tracer.stats()['slow'])])):
+        lines += _family(name, help, kind, samples)
+    return lines
+
+
+metrics = Metrics(app.config['METRICS_BUCKETS'])
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.before_request
+def start_request():
+    g.metrics_start = time.perf_counter()
+    g.sql, g.sql_token = tracer.start()
+
+
+@app.after_request
+def sql_header(response):
+    # Registered first, so it runs after the other after_request hooks.
+    g.metrics_status = response.status_code
+    # A streamed body is sent after a first teardown; the second one,
+    # once the stream is done, records the request.
+    g.metrics_streamed = response.is_streamed
+    if app.config['SQL_DEBUG_HEADER'] and 'sql' in g:
+        elapsed = (time.perf_counter() - g.metrics_start) * 1000
+        response.headers['Server-Timing'] = (
+            f'db;dur={g.sql.seconds * 1000:.2f};'
+            f'desc="{g.sql.count} statements", app;dur={elapsed:.2f}')
+        for sql, count, seconds in g.sql.top(app.config['SQL_TOP']):
+            response.headers.add(
+                'X-SQL-Top', f"{seconds * 1000:.2f}ms x{count} "
+                f"{sql[:200].encode('latin-1', 'replace').decode('latin-1')}")
+    return response
+
+
+@app.teardown_request
+def finish_request(exception):
+    if 'sql_token' not in g or g.pop('metrics_streamed', False):
+        return
+    tracer.stop(g.pop('sql_token'))
+    status = 500 if exception else g.get('metrics_status', 500)
+    metrics.observe(_route(), request.method, status,
+                    time.perf_counter() - g.metrics_start, g.sql)
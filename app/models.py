@@ -1,41 +1,147 @@
+import re
 import sqlite3
-import hashlib
+import contextvars
+import base64
+import binascii
 from math import ceil
 from functools import wraps
 from flask import g, url_for, session, redirect, flash
-from app import app
-from datetime import datetime
-from dateutil import relativedelta
+import json
+from app import (app, pool, leaderboards, film_details, writer,
+                 hasher, genre_index, social_graph)
+from app.cache import freeze, row_class
+from app.timesince import time_since
+from app.pagecache import invalidate
+import time
+
+
+# Set by app.aio while a model call runs on the DB thread pool, which
+# brings its own connection rather than sharing the request's.
+borrowed = contextvars.ContextVar('borrowed_db', default=None)
 
 
 class DataBase:
     def get_db(self):
+        db = borrowed.get()
+        if db is not None:
+            return db
         db = g.get('db')
         if db is None:
-            db = sqlite3.connect('app.db')
-            db.row_factory = sqlite3.Row
+            db = pool.acquire()
             g.db = db
         return db
 
-    def get_time_after_posting(self, date_time):
-        delta_values = ('years', 'months', 'days',
-                        'hours', 'minutes', 'seconds')
-        mask = {'years': 'yr', 'months': 'mo', 'days': 'd',
-                'hours': 'hr', 'minutes': 'min', 'seconds': 'sec'}
-        current_time = datetime.utcnow()
-        posting_time = datetime.strptime(date_time, "%Y-%m-%d %H:%M:%S")
-        difference = relativedelta.relativedelta(current_time, posting_time)
-        for delta_value in delta_values:
-            res = getattr(difference, delta_value)
-            if res:
-                return f"{res} {mask[delta_value]}"
-        return "0 sec"
+    @property
+    def db(self):
+        # Borrowed from the pool on first use in a request and handed
+        # back on teardown, or earlier through release_db.
+        return self.get_db()
+
+    def release_db(self):
+        if borrowed.get() is not None:
+            return
+        db = g.pop('db', None)
+        if db is not None:
+            pool.release(db)
+
+    def write(self, key, user_id, statements, finalizers=(),
+              on_commit=None):
+        # Small per-user mutations go through the write-behind queue when
+        # it is enabled, otherwise they commit right away.
+        if writer.enabled:
+            writer.submit(key, user_id, statements, finalizers, on_commit)
+            return
+        cur = self.db.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in list(statements) + list(finalizers):
+                cur.execute(sql, params)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        if on_commit is not None:
+            on_commit()
+
+    def encode_cursor(self, direction, review):
+        raw = f"{direction}|{review['review_id']}|{review['posted']}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            direction, id, posted = raw.decode().split('|', 2)
+            if direction in ('next', 'prev'):
+                return direction, int(id), int(posted)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            pass
+        return None, None, None
+
+    def projection(self, fields, columns):
+        # "expression AS field" for each requested field, `columns` being
+        # the model's map of API field names to SQL.
+        return ', '.join(f"{columns[field]} AS {field}" for field in fields)
+
+    def seek_reviews(self, query, params, cursor, total):
+        # Keyset pagination over reviews ordered by (posted, id) descending.
+        # The query must contain {seek} and {order} placeholders and
+        # select reviews.id AS review_id and reviews.posted.
+        cur = self.db.cursor()
+        per_page = app.config['REVIEWS_PER_PAGE']
+        direction, id, posted = self.decode_cursor(cursor or '')
+        if direction == 'prev':
+            seek = '(reviews.posted, reviews.id) > (:Posted, :Review_id)'
+            order = 'reviews.posted ASC, reviews.id ASC'
+        elif direction == 'next':
+            seek = '(reviews.posted, reviews.id) < (:Posted, :Review_id)'
+            order = 'reviews.posted DESC, reviews.id DESC'
+        else:
+            seek = '1'
+            order = 'reviews.posted DESC, reviews.id DESC'
+        params = dict(params, Posted=posted, Review_id=id,
+                      Limit=per_page + 1)
+        rows = cur.execute(query.format(seek=seek, order=order),
+                           params).fetchall()
+        if not rows and direction:
+            return self.seek_reviews(query, params, None, total)
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if direction == 'prev':
+            rows.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = direction == 'next', more
+        pager = {'prev': None, 'next': None, 'total': total,
+                 'pages': ceil(total / per_page)}
+        if has_prev:
+            pager['prev'] = self.encode_cursor('prev', rows[0])
+        if has_next:
+            pager['next'] = self.encode_cursor('next', rows[-1])
+        return rows, pager
 
 
 class Film(DataBase):
-    def __init__(self):
-        with app.app_context():
-            self.db = super().get_db()
+    # What the API can select. The cast lists are JSON arrays from
+    # correlated subqueries and only run when asked for.
+    FIELDS = {
+        'id': 'films.id', 'title': 'films.title',
+        'original_title': 'films.original_title', 'year': 'films.year',
+        'premdate': 'films.premdate', 'genres': 'films.genres',
+        'body': 'films.body', 'img': 'films.img',
+        'trailer': 'films.trailer', 'rate': 'films.rate',
+        'votes': 'films.votes', 'value': 'films.value',
+        'box_office': 'films.box_office',
+        'directors': """(SELECT json_group_array(json_object('id', id,
+            'name', name)) FROM (SELECT persons.id, persons.name
+            FROM films_casts JOIN persons ON persons.id = films_casts.person_id
+            WHERE films_casts.film_id = films.id AND films_casts.type = 1
+            ORDER BY films_casts.id))""",
+        'actors': """(SELECT json_group_array(json_object('id', id,
+            'name', name)) FROM (SELECT persons.id, persons.name
+            FROM films_casts JOIN persons ON persons.id = films_casts.person_id
+            WHERE films_casts.film_id = films.id AND films_casts.type = 2
+            ORDER BY films_casts.id))"""}
+    JSON_FIELDS = ('directors', 'actors')
 
     def check_film(self, id):
         cur = self.db.cursor()
@@ -44,111 +150,206 @@ class Film(DataBase):
         return True if film else False
 
     def get_top_movies(self):
+        return leaderboards.get('top', self.__top_movies)
+
+    def __top_movies(self):
         cur = self.db.cursor()
-        return cur.execute("""SELECT * FROM films
-                           ORDER BY value DESC LIMIT 100""").fetchall()
+        return freeze(cur.execute("""SELECT * FROM films
+                                  ORDER BY value DESC LIMIT 100"""))
 
     def get_popular_movies(self):
-        cur = self.db.cursor()
-        return cur.execute("""SELECT * FROM films WHERE year > 2018
-                           ORDER BY value DESC LIMIT 40""").fetchall()
+        return leaderboards.get('popular', self.__popular_movies)
 
-    def get_film(self, id, page):
+    def __popular_movies(self):
         cur = self.db.cursor()
-        id = {"Id": id}
-        film = cur.execute("SELECT * FROM films WHERE id = :Id",
-                           id).fetchone()
-
-        directors = cur.execute("""SELECT persons.id, persons.name FROM persons
-        LEFT JOIN films_casts ON persons.id = films_casts.person_id
-        WHERE film_id = :Id and films_casts.type = 1""",
-                                id).fetchall()
+        return freeze(cur.execute("""SELECT * FROM films WHERE year > 2018
+                                  ORDER BY value DESC LIMIT 40"""))
 
-        actors = cur.execute("""SELECT persons.id, persons.name FROM persons
-        LEFT JOIN films_casts on persons.id = films_casts.person_id
-        WHERE film_id = :Id and films_casts.type = 2""",
-                             id).fetchall()
-
-        genres = cur.execute("""SELECT genres.genre FROM genres LEFT JOIN
-        films_genres on films_genres.genre_id = genres.id LEFT JOIN films
-        on films.id = films_genres.film_id WHERE films.id = :Id""",
-                             id).fetchall()
-
-        reviews, page, all_pages = self.__get_reviews(id, page)
+    def get_film(self, id, cursor=None):
+        detail = self.get_film_detail(id)
+        if detail is None:
+            return None
+        film, directors, actors, genres = detail
+        reviews, pager = self.__get_reviews({"Id": film['id']}, cursor,
+                                            film['reviews_count'])
+        return film, directors, actors, genres, reviews, pager
 
-        return film, directors, actors, genres, reviews, page, all_pages
+    def similar_films(self, id):
+        return film_details.get(f"similar:{id}", lambda: self.__similar(id))
 
-    def __get_reviews(self, id, page):
+    def __similar(self, id):
         cur = self.db.cursor()
-        reviews = []
-        if not page.isdigit() or page == '0':
-            page = '1'
-        page = int(page) - 1
-        reviews_count = cur.execute("""SELECT COUNT(id) FROM reviews
-        WHERE film_id = :Id""", id).fetchone()[0]
-        all_pages = ceil(reviews_count / app.config['REVIEWS_PER_PAGE'])
-        if page * app.config['REVIEWS_PER_PAGE'] > reviews_count:
-            page = 0
+        return freeze(cur.execute("""SELECT films.id, films.title, films.img,
+        films.rate, films.genres FROM films_similar
+        JOIN films ON films.id = films_similar.similar_id
+        WHERE films_similar.film_id = :Id ORDER BY films_similar.rank
+        LIMIT :Limit""", {"Id": id,
+                          "Limit": app.config['SIMILAR_FILMS_LIMIT']}))
 
-        start_reviews = cur.execute(f"""SELECT users.id, users.name,
-        reviews.body, reviews.date FROM users LEFT JOIN reviews ON
-        users.id = reviews.user_id WHERE film_id = :Id ORDER BY date DESC
-        LIMIT {app.config['REVIEWS_PER_PAGE']} OFFSET
-        {app.config['REVIEWS_PER_PAGE'] * page}""", id).fetchall()
+    def get_film_detail(self, id):
+        return film_details.get(str(id), lambda: self.__load_detail(id))
 
-        for review in start_reviews:
-            date = super().get_time_after_posting(review['date'])
-            reviews.append({'id': review['id'], 'name': review['name'],
-                            'body': review['body'], 'date': date})
-        return reviews, page+1, all_pages
+    def __load_detail(self, id):
+        cur = self.db.cursor()
+        cur.execute("""SELECT films.*,
+        (SELECT json_group_array(json_object('id', id, 'name', name)) FROM
+            (SELECT persons.id, persons.name FROM films_casts
+             JOIN persons ON persons.id = films_casts.person_id
+             WHERE films_casts.film_id = films.id AND films_casts.type = 1
+             ORDER BY films_casts.id)) AS directors_json,
+        (SELECT json_group_array(json_object('id', id, 'name', name)) FROM
+            (SELECT persons.id, persons.name FROM films_casts
+             JOIN persons ON persons.id = films_casts.person_id
+             WHERE films_casts.film_id = films.id AND films_casts.type = 2
+             ORDER BY films_casts.id)) AS actors_json,
+        (SELECT json_group_array(json_object('genre', genres.genre))
+            FROM films_genres JOIN genres ON genres.id = films_genres.genre_id
+            WHERE films_genres.film_id = films.id) AS genres_json
+        FROM films WHERE films.id = :Id""", {"Id": id})
+        row = cur.fetchone()
+        if row is None:
+            return None
+        columns = [column[0] for column in cur.description][:-3]
+        film = row_class(columns)(row[:-3])
+        directors = tuple(json.loads(row['directors_json']))
+        actors = tuple(json.loads(row['actors_json']))
+        genres = tuple(json.loads(row['genres_json']))
+        return film, directors, actors, genres
+
+    def __get_reviews(self, id, cursor, total):
+        start_reviews, pager = super().seek_reviews("""SELECT users.id,
+        users.name, reviews.id AS review_id, reviews.body, reviews.posted
+        FROM reviews JOIN users ON users.id = reviews.user_id
+        WHERE reviews.film_id = :Id AND {seek} ORDER BY {order}
+        LIMIT :Limit""", id, cursor, total)
+        dates = time_since([review['posted'] for review in start_reviews])
+        reviews = [{'id': review['id'], 'name': review['name'],
+                    'body': review['body'], 'date': date}
+                   for review, date in zip(start_reviews, dates)]
+        return reviews, pager
+
+    def films_by_ids(self, ids, fields):
+        cur = self.db.cursor()
+        return cur.execute(f"""SELECT {self.projection(fields, self.FIELDS)}
+        FROM films WHERE films.id IN ({','.join('?' * len(ids))})""",
+                           ids).fetchall()
+
+    def film_page(self, fields, sort, after, limit):
+        # Keyset page of the catalog by id, or by value (best first) with
+        # id breaking ties. `after` is the last row's (value, id) or id.
+        # Returns the cursor so that the caller can stream it.
+        cur = self.db.cursor()
+        select = self.projection(fields, self.FIELDS)
+        if sort == 'value':
+            value, id = after or (2 ** 62, 0)
+            return cur.execute(f"""SELECT {select} FROM films
+            WHERE (films.value, films.id) < (:Value, :Id)
+            ORDER BY films.value DESC, films.id DESC LIMIT :Limit""",
+                               {'Value': value, 'Id': id, 'Limit': limit})
+        return cur.execute(f"""SELECT {select} FROM films
+        WHERE films.id > :Id ORDER BY films.id LIMIT :Limit""",
+                           {'Id': after or 0, 'Limit': limit})
 
     def highest_grossing_movies(self):
+        return leaderboards.get('boxoffice', self.__highest_grossing)
+
+    def __highest_grossing(self):
         cur = self.db.cursor()
-        return cur.execute("""SELECT * FROM films ORDER BY
-                              box_office DESC LIMIT 100""").fetchall()
+        return freeze(cur.execute("""SELECT * FROM films ORDER BY
+                                  box_office DESC LIMIT 100"""))
 
     def write_review(self, body, user_id, film_id):
         cur = self.db.cursor()
-        date = str(datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
         comment = {"User_id": user_id, "Film_id": film_id,
-                   "Body": body, "Date": date}
-        cur.execute("""INSERT INTO reviews (user_id, film_id, body, date)
-                    VALUES(:User_id, :Film_id, :Body, :Date)""", comment)
+                   "Body": body, "Posted": int(time.time())}
+        cur.execute("""INSERT INTO reviews (user_id, film_id, body, date,
+                    posted) VALUES(:User_id, :Film_id, :Body,
+                    datetime(:Posted, 'unixepoch'), :Posted)""", comment)
         self.db.commit()
-
-    def rate(self, id, val):
+        film_details.invalidate(str(film_id))
+        invalidate(f"film:{film_id}")
+        Feed().fan_out()
+
+    # films.rate and films.votes are derived from the per-score vote
+    # histogram plus whatever the catalog import brought with it.
+    REFRESH_RATING = """UPDATE films SET
+    votes = imported_votes + COALESCE((SELECT SUM(votes)
+        FROM films_rates_histogram WHERE film_id = films.id), 0),
+    rate = COALESCE((imported_sum + COALESCE((SELECT SUM(score * votes)
+        FROM films_rates_histogram WHERE film_id = films.id), 0))
+        / NULLIF(imported_votes + COALESCE((SELECT SUM(votes)
+        FROM films_rates_histogram WHERE film_id = films.id), 0), 0), 0)"""
+
+    def rate(self, id, user_id, val):
         if not val.isdigit() or int(val) < 1 or int(val) > 10:
             return None
         val = int(val)
+        # The films_rates triggers keep films_rates_histogram in step.
+        self.write(('rate', user_id, id), user_id, [(
+            """INSERT INTO films_rates (film_id, user_id, rate)
+            SELECT :Id, :User_id, :Val WHERE NOT EXISTS (SELECT 1
+            FROM films_rates WHERE user_id = :User_id AND film_id = :Id)""",
+            {'Id': id, 'User_id': user_id, 'Val': val})],
+            [(f"{self.REFRESH_RATING} WHERE id = ?", (id,))],
+            lambda: film_changed(id))
+        # Queued ratings are fanned out by the next feed read instead.
+        if not writer.enabled:
+            Feed().fan_out()
+        return val
+
+    def delete_rate(self, id, user_id):
+        self.write(('rate', user_id, id), user_id, [(
+            """DELETE FROM films_rates
+            WHERE user_id = ? AND film_id = ?""",
+            (user_id, id))],
+            [(f"{self.REFRESH_RATING} WHERE id = ?", (id,))],
+            lambda: film_changed(id))
+
+    def rating_histogram(self, id):
         cur = self.db.cursor()
-        rate, votes = cur.execute("""SELECT rate, votes FROM films
-        WHERE id = :Id""", {'Id': id}).fetchone()
-        rate = (rate * votes + val) / (votes + 1)
-        to_db = {'Rate': rate,
-                 'Votes': votes + 1,
-                 'Id': id}
-        cur.execute("""UPDATE films SET rate = :Rate,
-                       votes = :Votes WHERE id = :Id""", to_db)
-        self.db.commit()
+        votes = dict(cur.execute("""SELECT score, votes
+        FROM films_rates_histogram WHERE film_id = ?""", (id,)).fetchall())
+        return [votes.get(score, 0) for score in range(1, 11)]
 
-    def delete_rate(self, id, val):
-        val = int(val)
+    def repair_ratings(self):
         cur = self.db.cursor()
-        rate, votes = cur.execute("""SELECT rate, votes FROM films
-        WHERE id = :Id""", {'Id': id}).fetchone()
-        rate = (rate * votes - val) / (votes - 1)
-        to_db = {'Rate': rate,
-                 'Votes': votes - 1,
-                 'Id': id}
-        cur.execute("""UPDATE films SET rate = :Rate,
-                       votes = :Votes WHERE id = :Id""", to_db)
-        self.db.commit()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("DELETE FROM films_rates_histogram")
+            cur.execute("""INSERT INTO films_rates_histogram
+            (film_id, score, votes) SELECT film_id, rate, COUNT(*)
+            FROM films_rates WHERE rate BETWEEN 1 AND 10
+            GROUP BY film_id, rate""")
+            histograms = cur.rowcount
+            cur.execute(self.REFRESH_RATING)
+            films = cur.rowcount
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        leaderboards.bump()
+        film_details.clear()
+        return histograms, films
+
+
+def film_changed(id):
+    leaderboards.bump()
+    film_details.invalidate(str(id))
+    invalidate(f"film:{id}", 'leaderboards')
 
 
 class Person(DataBase):
-    def __init__(self):
-        with app.app_context():
-            self.db = super().get_db()
+    FIELDS = {
+        'id': 'persons.id', 'name': 'persons.name', 'img': 'persons.img',
+        'body': 'persons.body',
+        'jobs': """(SELECT json_group_array(types.type) FROM persons_types
+            JOIN types ON types.id = persons_types.type_id
+            WHERE persons_types.person_id = persons.id)""",
+        'films': """(SELECT json_group_array(json_object('id', films.id,
+            'title', films.title, 'type', films_casts.type))
+            FROM films_casts JOIN films ON films.id = films_casts.film_id
+            WHERE films_casts.person_id = persons.id)"""}
+    JSON_FIELDS = ('jobs', 'films')
 
     def check_person(self, id):
         cur = self.db.cursor()
@@ -181,25 +382,32 @@ class Person(DataBase):
             as_director = None
         return person, as_actor, as_director, jobs
 
+    def persons_by_ids(self, ids, fields):
+        cur = self.db.cursor()
+        return cur.execute(f"""SELECT {self.projection(fields, self.FIELDS)}
+        FROM persons WHERE persons.id IN ({','.join('?' * len(ids))})""",
+                           ids).fetchall()
 
-class User(DataBase):
-    def __init__(self):
-        with app.app_context():
-            self.db = super().get_db()
-
-    def set_password(self, password):
-        return hashlib.pbkdf2_hmac(
-            'sha256', bytes(password, 'utf8'),
-            app.config.get("SALT"), 150000).hex()
 
+class User(DataBase):
     def check_user(self, name, password):
-        password = self.set_password(password)
         cur = self.db.cursor()
-        wpass = {"Name": name, "Pass": password}
-        wpass = cur.execute("""SELECT password FROM users
-                            WHERE name = :Name and password = :Pass LIMIT 1""",
-                            wpass).fetchone()
-        return True if wpass else False
+        user = cur.execute("""SELECT id, password FROM users
+                           WHERE name = :Name LIMIT 1""",
+                           {"Name": name}).fetchone()
+        # Don't keep a pooled connection idle while the hash is computed.
+        self.release_db()
+        if user is None:
+            # Hash anyway so unknown names take as long as wrong passwords.
+            hasher.hash(password)
+            return None
+        ok, upgraded = hasher.verify(password, user['password'])
+        if ok and upgraded:
+            cur = self.db.cursor()
+            cur.execute("UPDATE users SET password = ? WHERE id = ?",
+                        (upgraded, user['id']))
+            self.db.commit()
+        return user['id'] if ok else None
 
     def validate_name(self, name):
         name = {"Name": name}
@@ -216,8 +424,9 @@ class User(DataBase):
         return False if mail else True
 
     def insert_user(self, name, email, password):
+        self.release_db()
+        password = hasher.hash(password)
         cur = self.db.cursor()
-        password = self.set_password(password)
         user = {"Name": name, "Email": email, "Password": password}
         cur.execute("""INSERT INTO users (name, email, password)
                     VALUES(:Name, :Email, :Password)""", user)
@@ -230,105 +439,158 @@ class User(DataBase):
                           'WHERE name = :Name', name).fetchone()
         return res[0] if res else None
 
-    def check_rate(self, film_id):
+    def check_rate(self, user_id, film_id):
         cur = self.db.cursor()
-        id = self.current_user(session['__auth'])
+        writer.wait_for(user_id)
         rate = cur.execute('SELECT rate FROM films_rates '
                            'WHERE user_id = :User_id AND film_id = :Film_id',
-                           {'User_id': id, 'Film_id': film_id}).fetchone()
+                           {'User_id': user_id,
+                            'Film_id': film_id}).fetchone()
         return rate['rate'] if rate else 0
 
-    def rate(self, film_id, val):
+    def follow(self, user_id, foll_id):
         cur = self.db.cursor()
-        if not val.isdigit() or int(val) < 1 or int(val) > 10:
-            return None
-        user_id = self.current_user(session['__auth'])
-        cur.execute("""INSERT INTO films_rates (film_id, user_id, rate)
-                    VALUES(?, ?, ?)""", (film_id, user_id, val))
-        self.db.commit()
-
-    def delete_rate(self, film_id):
-        cur = self.db.cursor()
-        user_id = self.current_user(session['__auth'])
-        rate = cur.execute(
-            'SELECT rate FROM films_rates WHERE '
-            'user_id = ? AND film_id = ?', (user_id, film_id)).fetchone()[0]
-        cur.execute("""DELETE FROM films_rates WHERE
-                       user_id = ? AND film_id = ?""", (user_id, film_id))
-        self.db.commit()
-        return rate
-
-    def follow(self, following):
-        if self.is_following(following):
-            return None
-        cur = self.db.cursor()
-        user_id = self.current_user(session['__auth'])
-        foll_id = self.current_user(following)
         cur.execute("""INSERT INTO followed (is_following, following)
-                       VALUES(?, ?)""", (user_id, foll_id))
+                       SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM followed
+                       WHERE is_following = ? AND following = ?)""",
+                    (user_id, foll_id, user_id, foll_id))
+        if cur.rowcount:
+            Feed().backfill(user_id, foll_id)
         self.db.commit()
+        social_graph.update(user_id, foll_id, True)
 
-    def unfollow(self, following):
-        if not self.is_following(following):
-            return None
+    def unfollow(self, user_id, foll_id):
         cur = self.db.cursor()
-        user_id = self.current_user(session['__auth'])
-        foll_id = self.current_user(following)
         cur.execute("""DELETE FROM followed WHERE
                     is_following=? AND following=?""", (user_id, foll_id))
+        cur.execute("""DELETE FROM timelines WHERE user_id = ? AND
+                    activity_id IN (SELECT id FROM activities
+                    WHERE user_id = ?)""", (user_id, foll_id))
         self.db.commit()
+        social_graph.update(user_id, foll_id, False)
 
-    def followers(self, username):
-        user_id = self.current_user(username)
+    def followers(self, user_id):
         cur = self.db.cursor()
         foll_names = cur.execute("""SELECT users.name FROM followed LEFT JOIN
                                  users ON users.id = followed.is_following
                                  WHERE following=?""", (user_id,)).fetchall()
         return foll_names if foll_names else []
 
-    def followings(self, username):
-        user_id = self.current_user(username)
+    def followings(self, user_id):
         cur = self.db.cursor()
         foll_names = cur.execute("""SELECT users.name FROM followed LEFT JOIN
                                  users ON users.id = followed.following WHERE
                                  is_following=?""", (user_id,)).fetchall()
         return foll_names if foll_names else []
 
-    def is_following(self, following):
+    def follow_counts(self, user_id):
         cur = self.db.cursor()
-        user_id = self.current_user(session['__auth'])
-        foll_id = self.current_user(following)
-        res = cur.execute("""SELECT id FROM followed WHERE
-                          is_following = ? and
-                          following = ?""", (user_id, foll_id)).fetchone()
-        return True if res else False
-
-    def get_reviews(self, id, page):
+        return cur.execute("""SELECT followers_count, following_count
+                           FROM users WHERE id = ?""", (user_id,)).fetchone()
+
+    # Denormalized counters and the statement that recomputes each one.
+    COUNTERS = {
+        'users.followers_count':
+            "SELECT COUNT(*) FROM followed WHERE following = users.id",
+        'users.following_count':
+            "SELECT COUNT(*) FROM followed WHERE is_following = users.id",
+        'users.reviews_count':
+            "SELECT COUNT(*) FROM reviews WHERE user_id = users.id",
+        'films.reviews_count':
+            "SELECT COUNT(*) FROM reviews WHERE film_id = films.id",
+        'users.timeline_size':
+            "SELECT COUNT(*) FROM timelines WHERE user_id = users.id",
+    }
+
+    def check_counters(self, repair=False):
+        # Returns {counter: rows whose stored value is off}; with repair
+        # the rows are fixed in the same transaction.
         cur = self.db.cursor()
-        id = {"Id": id}
-        reviews = []
-        if not page.isdigit() or page == '0':
-            page = '1'
-        page = int(page) - 1
-        reviews_count = cur.execute("""SELECT COUNT(id) FROM reviews
-        WHERE user_id = :Id""", id).fetchone()[0]
-        if page * app.config['REVIEWS_PER_PAGE'] > reviews_count:
-            page = 0
-
-        start_reviews = cur.execute(f"""SELECT films.id, films.title, films.rate,
-        films.img, reviews.body, reviews.date FROM films LEFT JOIN reviews ON
-        films.id = reviews.film_id WHERE user_id = :Id ORDER BY date DESC
-        LIMIT {app.config['REVIEWS_PER_PAGE']} OFFSET
-        {app.config['REVIEWS_PER_PAGE'] * page}""", id).fetchall()
-
-        all_pages = ceil(len(start_reviews) / app.config['REVIEWS_PER_PAGE'])
-
-        for review in start_reviews:
-            date = super().get_time_after_posting(review['date'])
-            reviews.append({'id': review['id'], 'name': review['title'],
-                            'body': review['body'], 'date': date,
-                            'rate': review['rate'], 'img': review['img']})
-        return reviews, page+1, all_pages
+        cur.execute("BEGIN IMMEDIATE" if repair else "BEGIN")
+        try:
+            drift = {}
+            for counter, query in self.COUNTERS.items():
+                table, column = counter.split('.')
+                where = f"{column} != ({query})"
+                drift[counter] = cur.execute(
+                    f"SELECT COUNT(*) FROM {table} WHERE {where}"
+                ).fetchone()[0]
+                if repair and drift[counter]:
+                    cur.execute(f"UPDATE {table} SET {column} = ({query}) "
+                                f"WHERE {where}")
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        return drift
+
+    def is_following(self, user_id, foll_id):
+        # Read from followed rather than the social graph, which can lag
+        # behind follows made through other processes.
+        cur = self.db.cursor()
+        return cur.execute("""SELECT 1 FROM followed
+                           WHERE is_following = ? AND following = ?""",
+                           (user_id, foll_id)).fetchone() is not None
+
+    def followed_by_followings(self, user_id, id):
+        # How many of the people user_id follows also follow id, from the
+        # social graph.
+        graph = social_graph.refresh(self.db)
+        return len(graph.following_of(user_id) & graph.followers_of(id))
+
+    def suggestions(self, user_id):
+        graph = social_graph.refresh(self.db)
+        ranked = graph.suggestions(user_id, app.config['SUGGESTIONS_LIMIT'])
+        if not ranked:
+            return []
+        cur = self.db.cursor()
+        names = dict(cur.execute(f"""SELECT id, name FROM users WHERE id IN
+                                 ({','.join('?' * len(ranked))})""",
+                                 [id for id, _ in ranked]).fetchall())
+        return [{'name': names[id], 'shared': shared}
+                for id, shared in ranked if id in names]
+
+    def recommendations(self, user_id):
+        # Neighbours of the user's latest well-rated films (weighted by how
+        # far above 5 the rating is) and favorites, minus films they have
+        # already rated or favorited.
+        cur = self.db.cursor()
+        return freeze(cur.execute("""SELECT films.id, films.title, films.img,
+        films.rate, films.genres FROM (SELECT films_similar.similar_id AS id,
+            SUM(films_similar.score * seeds.weight) AS score
+            FROM (SELECT film_id, weight FROM (SELECT film_id,
+                    rate - 5 AS weight FROM films_rates
+                    WHERE user_id = :User AND rate > 5
+                    ORDER BY id DESC LIMIT :Seeds)
+                  UNION ALL SELECT film_id, 5 FROM users_favorites
+                    WHERE user_id = :User) AS seeds
+            JOIN films_similar ON films_similar.film_id = seeds.film_id
+            WHERE films_similar.similar_id NOT IN (SELECT film_id
+                FROM films_rates WHERE user_id = :User)
+            AND films_similar.similar_id NOT IN (SELECT film_id
+                FROM users_favorites WHERE user_id = :User)
+            GROUP BY films_similar.similar_id
+            ORDER BY score DESC LIMIT :Limit) AS picks
+        JOIN films ON films.id = picks.id ORDER BY picks.score DESC""",
+            {"User": user_id, "Seeds": app.config['RECOMMENDATION_SEEDS'],
+             "Limit": app.config['RECOMMENDATIONS_LIMIT']}))
+
+    def get_reviews(self, id, cursor=None):
+        cur = self.db.cursor()
+        total = cur.execute("SELECT reviews_count FROM users WHERE id = ?",
+                            (id,)).fetchone()[0]
+        start_reviews, pager = super().seek_reviews("""SELECT films.id,
+        films.title, films.rate, films.img, reviews.id AS review_id,
+        reviews.body, reviews.posted FROM reviews
+        JOIN films ON films.id = reviews.film_id
+        WHERE reviews.user_id = :Id AND {seek} ORDER BY {order}
+        LIMIT :Limit""", {"Id": id}, cursor, total)
+        dates = time_since([review['posted'] for review in start_reviews])
+        reviews = [{'id': review['id'], 'name': review['title'],
+                    'body': review['body'], 'date': date,
+                    'rate': review['rate'], 'img': review['img']}
+                   for review, date in zip(start_reviews, dates)]
+        return reviews, pager
 
 
 class Watchlist(User):
@@ -359,6 +621,7 @@ class Watchlist(User):
         cur.execute("""INSERT INTO watchlists (username, name, body) \
                            VALUES(?,?,?)""", (username, list_name, body))
         self.db.commit()
+        Feed().fan_out()
 
     def get_list_id(self, guest, username, list_name):  # update
         cur = self.db.cursor()
@@ -404,6 +667,19 @@ class Watchlist(User):
                                 (list_id,)).fetchone()
         return films, watchlist
 
+    def film_page(self, list_id, fields, after, limit):
+        # Films of a list in the order they were added, keyed by the
+        # watchlists_films row (`entry`), as a cursor to stream.
+        cur = self.db.cursor()
+        return cur.execute(f"""SELECT watchlists_films.id AS entry,
+        {self.projection(fields, Film.FIELDS)} FROM watchlists_films
+        JOIN films ON films.id = watchlists_films.film_id
+        WHERE watchlists_films.watchlist_id = :List
+        AND watchlists_films.id > :After
+        ORDER BY watchlists_films.id LIMIT :Limit""",
+                           {'List': list_id, 'After': after or 0,
+                            'Limit': limit})
+
     def watchlist_names(self, username):
         cur = self.db.cursor()
         return cur.execute("""SELECT id, name FROM watchlists
@@ -451,6 +727,7 @@ class Watchlater(User):
         super().__init__()
 
     def watch_later(self, user_id):
+        writer.wait_for(user_id)
         cur = self.db.cursor()
         films = cur.execute("""SELECT * FROM films LEFT JOIN users_watchlater \
                               on film_id=films.id WHERE user_id=? \
@@ -459,12 +736,14 @@ class Watchlater(User):
         return films
 
     def add_watch_later(self, user_id, film_id):
-        cur = self.db.cursor()
-        cur.execute("""INSERT INTO users_watchlater (user_id, film_id)
-                    VALUES(?,?)""", (user_id, film_id))
-        self.db.commit()
+        self.write(('watchlater', user_id, film_id), user_id, [(
+            """INSERT INTO users_watchlater (user_id, film_id)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM users_watchlater
+            WHERE user_id = ? AND film_id = ?)""",
+            (user_id, film_id, user_id, film_id))])
 
     def check_duplicate(self, user_id, film_id):
+        writer.wait_for(user_id)
         cur = self.db.cursor()
         watchlater = cur.execute("""SELECT * FROM users_watchlater \
                                  WHERE user_id=? and film_id=?""",
@@ -472,10 +751,10 @@ class Watchlater(User):
         return bool(watchlater)
 
     def delete_watchlater(self, user_id, film_id):
-        cur = self.db.cursor()
-        cur.execute("""DELETE  FROM users_watchlater \
-                       WHERE user_id=? and film_id=?""", (user_id, film_id))
-        self.db.commit()
+        self.write(('watchlater', user_id, film_id), user_id, [(
+            """DELETE FROM users_watchlater
+            WHERE user_id = ? AND film_id = ?""",
+            (user_id, film_id))])
 
 
 class Favorites(User):
@@ -483,6 +762,7 @@ class Favorites(User):
         super().__init__()
 
     def favorites(self, user_id):
+        writer.wait_for(user_id)
         cur = self.db.cursor()
         films = cur.execute("""SELECT * FROM films LEFT JOIN users_favorites \
                             on film_id=films.id WHERE user_id=? \
@@ -491,12 +771,14 @@ class Favorites(User):
         return films
 
     def add_favorites(self, user_id, film_id):
-        cur = self.db.cursor()
-        cur.execute("""INSERT INTO users_favorites (user_id, film_id)
-                    VALUES(?,?)""", (user_id, film_id))
-        self.db.commit()
+        self.write(('favorite', user_id, film_id), user_id, [(
+            """INSERT INTO users_favorites (user_id, film_id)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM users_favorites
+            WHERE user_id = ? AND film_id = ?)""",
+            (user_id, film_id, user_id, film_id))])
 
     def check_duplicate(self, user_id, film_id):
+        writer.wait_for(user_id)
         cur = self.db.cursor()
         favorites = cur.execute("""SELECT * FROM users_favorites \
                                 WHERE user_id=? and film_id=?""",
@@ -504,112 +786,249 @@ class Favorites(User):
         return bool(favorites)
 
     def delete_favorites(self, user_id, film_id):
+        self.write(('favorite', user_id, film_id), user_id, [(
+            """DELETE FROM users_favorites
+            WHERE user_id = ? AND film_id = ?""",
+            (user_id, film_id))])
+
+
+class Feed(DataBase):
+    # Reviews, ratings and new flows become activities through triggers.
+    # fan_out copies them into the timelines of the author's followers,
+    # except for authors with FEED_CELEBRITY_FOLLOWERS or more followers,
+    # whose activities are merged in when a feed is read. Timelines are
+    # trimmed back to FEED_TIMELINE_SIZE once they outgrow it by a tenth.
+    ACTIVITY = """SELECT activities.id, activities.kind,
+    activities.created, activities.rate, activities.film_id, users.name,
+    films.title, films.img, reviews.body, watchlists.name AS flow
+    FROM {source}
+    JOIN users ON users.id = activities.user_id
+    LEFT JOIN films ON films.id = activities.film_id
+    LEFT JOIN reviews ON reviews.id = activities.review_id
+    LEFT JOIN watchlists ON watchlists.id = activities.watchlist_id
+    WHERE {where} AND (activities.kind != 'flow' OR watchlists.private = 0)
+    ORDER BY {order} DESC LIMIT :Limit"""
+    FANNED_OUT = "SELECT fanned_out FROM feed_state WHERE id = 1"
+
+    def fan_out(self):
         cur = self.db.cursor()
-        cur.execute("""DELETE  FROM users_favorites \
-                       WHERE user_id=? and film_id=?""", (user_id, film_id))
-        self.db.commit()
+        done = cur.execute(self.FANNED_OUT).fetchone()[0]
+        latest = cur.execute("SELECT MAX(id) FROM activities").fetchone()[0]
+        if not latest or latest <= done:
+            return 0
+        size = app.config['FEED_TIMELINE_SIZE']
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            done = cur.execute(self.FANNED_OUT).fetchone()[0]
+            params = {'Done': done,
+                      'Upto': min(latest, done
+                                  + app.config['FEED_FANOUT_BATCH']),
+                      'Celebrity': app.config['FEED_CELEBRITY_FOLLOWERS'],
+                      'Size': size, 'Overflow': size + size // 10}
+            cur.execute("""INSERT OR IGNORE INTO timelines
+            (user_id, activity_id) SELECT followed.is_following,
+            activities.id FROM activities
+            JOIN users ON users.id = activities.user_id
+            JOIN followed ON followed.following = activities.user_id
+            WHERE activities.id > :Done AND activities.id <= :Upto
+            AND users.followers_count < :Celebrity""", params)
+            fanned = cur.rowcount
+            full = cur.execute("""SELECT DISTINCT users.id FROM activities
+            JOIN users AS author ON author.id = activities.user_id
+            JOIN followed ON followed.following = activities.user_id
+            JOIN users ON users.id = followed.is_following
+            WHERE activities.id > :Done AND activities.id <= :Upto
+            AND author.followers_count < :Celebrity
+            AND users.timeline_size > :Overflow""", params).fetchall()
+            cur.executemany("""DELETE FROM timelines WHERE user_id = :Id
+            AND activity_id <= (SELECT activity_id FROM timelines
+            WHERE user_id = :Id ORDER BY activity_id DESC
+            LIMIT 1 OFFSET :Size)""",
+                            [{'Id': row['id'], 'Size': size} for row in full])
+            cur.execute("""UPDATE feed_state SET fanned_out = :Upto
+                        WHERE id = 1""", params)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        return fanned
+
+    def backfill(self, user_id, foll_id):
+        # Runs inside the follow's transaction: seed the timeline with the
+        # newly followed user's recent, already fanned out activities.
+        cur = self.db.cursor()
+        cur.execute("""INSERT OR IGNORE INTO timelines (user_id, activity_id)
+        SELECT :User, activities.id FROM activities
+        JOIN users ON users.id = activities.user_id
+        WHERE activities.user_id = :Foll
+        AND activities.id <= (SELECT fanned_out FROM feed_state
+                              WHERE id = 1)
+        AND users.followers_count < :Celebrity
+        ORDER BY activities.id DESC LIMIT :Size""", {
+            'User': user_id, 'Foll': foll_id,
+            'Celebrity': app.config['FEED_CELEBRITY_FOLLOWERS'],
+            'Size': app.config['FEED_TIMELINE_SIZE']})
+
+    def decode_before(self, cursor):
+        return int(cursor) if cursor and cursor.isdigit() else None
+
+    def timeline(self, user_id, cursor=None):
+        # Returns (activities, cursor of the next page or None).
+        self.fan_out()
+        cur = self.db.cursor()
+        per_page = app.config['FEED_PER_PAGE']
+        before = self.decode_before(cursor)
+        params = {'User': user_id, 'Before': before or 2 ** 62,
+                  'Limit': per_page + 1,
+                  'Celebrity': app.config['FEED_CELEBRITY_FOLLOWERS']}
+        rows = cur.execute(self.ACTIVITY.format(
+            source="""timelines JOIN activities
+            ON activities.id = timelines.activity_id""",
+            where="""timelines.user_id = :User
+            AND timelines.activity_id < :Before""",
+            order='timelines.activity_id'), params).fetchall()
+        # One backwards range scan per followed celebrity, so none of
+        # them has to sort a celebrity's whole history.
+        celebrities = cur.execute("""SELECT followed.following FROM followed
+        JOIN users ON users.id = followed.following
+        WHERE followed.is_following = :User
+        AND users.followers_count >= :Celebrity""", params).fetchall()
+        for celebrity in celebrities:
+            rows += cur.execute(self.ACTIVITY.format(
+                source='activities',
+                where="""activities.user_id = :Author
+                AND activities.id < :Before""",
+                order='activities.id'),
+                dict(params, Author=celebrity[0])).fetchall()
+        rows = sorted({row['id']: row for row in rows}.values(),
+                      key=lambda row: row['id'], reverse=True)
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        dates = time_since([row['created'] for row in rows])
+        activities = [{'kind': row['kind'], 'name': row['name'],
+                       'film_id': row['film_id'], 'title': row['title'],
+                       'img': row['img'], 'body': row['body'],
+                       'rate': row['rate'], 'flow': row['flow'],
+                       'date': date} for row, date in zip(rows, dates)]
+        return activities, (str(rows[-1]['id']) if more else None)
 
 
 class Search(DataBase):
-    def __init__(self):
-        with app.app_context():
-            self.db = super().get_db()
-
     def search__user(self, name):
         cur = self.db.cursor()
         name = name.replace('"', "")
         name = name.replace("%", "")
         if name == '':
             return list()
-        usernames = cur.execute(f"""SELECT name, id, SUM(cis_following) as
-        followings, SUM(cfollowing) as followers FROM(SELECT users.name,
-        users.id, COUNT(followed.following) as cis_following, 0 as cfollowing
-        FROM users LEFT JOIN followed ON followed.is_following=users.id
-        WHERE upper(users.name) LIKE "{name}%" GROUP by users.name
-        UNION ALL
-        SELECT users.name, users.id, 0, COUNT(followed.following) as cfollowing
-        FROM users LEFT JOIN followed ON followed.following=users.id WHERE
-        upper(users.name) LIKE "{name}%" GROUP by users.name) as res_tab
-        GROUP by res_tab.id ORDER by SUM(cfollowing) DESC
-        LIMIT {app.config['USERS_SEARCH_LIMIT']}""").fetchall()
+        prefix = re.sub(r'([\\_])', r'\\\1', name) + '%'
+        usernames = cur.execute("""SELECT name, id,
+        following_count AS followings, followers_count AS followers
+        FROM users WHERE name LIKE :Prefix ESCAPE '\\'
+        ORDER BY followers_count DESC LIMIT :Limit""", {
+            'Prefix': prefix,
+            'Limit': app.config['USERS_SEARCH_LIMIT']}).fetchall()
         return usernames
 
+    def __match_query(self, text):
+        # Every word of the input must prefix-match a token, e.g.
+        # 'dark kni' -> '"dark"* "kni"*'.
+        words = re.findall(r'\w+', text)
+        return ' '.join(f'"{word}"*' for word in words)
+
     def search_film(self, title, page):
         cur = self.db.cursor()
         if not page.isdigit() or page == '0':
             page = '1'
         page = int(page) - 1
-        title = title.replace('"', "")
-        title = title.replace("%", "")
-        if title == '':
+        match = self.__match_query(title)
+        if not match:
             return list(), 1, 0
-        films_number = cur.execute(f"""SELECT COUNT(id) FROM films
-                                    WHERE upper(title) LIKE
-                                    "{title.upper()}%" """).fetchone()[0]
-        if page * app.config['ITEMS_PER_PAGE'] > films_number:
+        query = f"""SELECT films.*, COUNT(*) OVER () AS total
+        FROM films_fts JOIN films ON films.id = films_fts.rowid
+        WHERE films_fts MATCH :Match
+        ORDER BY films_fts.rank, films.year DESC, films.value DESC
+        LIMIT {app.config['ITEMS_PER_PAGE']} OFFSET :Offset"""
+        films = cur.execute(query, {
+            'Match': match,
+            'Offset': app.config['ITEMS_PER_PAGE'] * page}).fetchall()
+        if not films and page:
             page = 0
-        films = cur.execute(
-                            f"""SELECT * FROM films WHERE upper(title)
-                            LIKE "{title.upper()}%" ORDER BY year DESC,
-                            value DESC LIMIT {app.config['ITEMS_PER_PAGE']}
-                            OFFSET {app.config['ITEMS_PER_PAGE'] * page}"""
-                            ).fetchall()
+            films = cur.execute(query, {'Match': match,
+                                        'Offset': 0}).fetchall()
+        films_number = films[0]['total'] if films else 0
         return films, page+1, films_number
 
+    def film_matches(self, title, fields, offset, limit):
+        # Title matches by relevance as a cursor to stream, or None when
+        # the input has no words.
+        match = self.__match_query(title)
+        if not match:
+            return None
+        cur = self.db.cursor()
+        return cur.execute(f"""SELECT {self.projection(fields, Film.FIELDS)}
+        FROM films_fts JOIN films ON films.id = films_fts.rowid
+        WHERE films_fts MATCH :Match
+        ORDER BY films_fts.rank, films.year DESC, films.value DESC
+        LIMIT :Limit OFFSET :Offset""",
+                           {'Match': match, 'Limit': limit,
+                            'Offset': offset})
+
     def search_person(self, name, page, types):
         cur = self.db.cursor()
         if not page.isdigit() or page == '0':
             page = '1'
         page = int(page) - 1
-        name = name.replace('"', "")
-        name = name.replace("%", "")
-        if name == '':
+        match = self.__match_query(name)
+        if not match:
             return list(), 1, 0
-        persons_number = cur.execute(f"""SELECT COUNT(id) FROM persons
-                                    WHERE upper(name) LIKE
-                                    "{name.upper()}%" """).fetchone()[0]
-        if page * app.config['ITEMS_PER_PAGE'] > persons_number:
+        types = ','.join(str(int(id)) for id in types)
+        query = f"""SELECT persons.id, persons.img, persons.name,
+        COUNT(*) OVER () AS total
+        FROM persons_fts JOIN persons ON persons.id = persons_fts.rowid
+        WHERE persons_fts MATCH :Match AND EXISTS (SELECT 1 FROM
+        persons_types WHERE persons_types.person_id = persons.id
+        AND persons_types.type_id IN ({types}))
+        ORDER BY persons_fts.rank, persons.name
+        LIMIT {app.config['ITEMS_PER_PAGE']} OFFSET :Offset"""
+        persons = cur.execute(query, {
+            'Match': match,
+            'Offset': app.config['ITEMS_PER_PAGE'] * page}).fetchall()
+        if not persons and page:
             page = 0
-        query_mask = """SELECT persons.id, persons.img, persons.name FROM
-        persons LEFT JOIN persons_types ON persons.id = persons_types.person_id
-        WHERE upper(persons.name) LIKE "{}%" AND persons_types.type_id= {}"""
-        query = " UNION ".join([query_mask.format(name, id) for id in types])
-        persons = cur.execute(f"""{query} ORDER BY persons.name LIMIT
-        {app.config['ITEMS_PER_PAGE']} OFFSET
-        {app.config['ITEMS_PER_PAGE'] * page}""").fetchall()
+            persons = cur.execute(query, {'Match': match,
+                                          'Offset': 0}).fetchall()
+        persons_number = persons[0]['total'] if persons else 0
         return persons, page+1, persons_number
 
-    def __get_genres_ids(self, genres):
-        cur = self.db.cursor()
-        genres = "({})".format((','.join(f'"{genre}"' for genre in genres)))
-        return cur.execute(f"""SELECT id FROM genres WHERE \
-                               LOWER(genre) IN {genres}""").fetchall()
-
     def films_by_genres(self, genres, page):
-        cur = self.db.cursor()
-        ids = self.__get_genres_ids(genres)
+        bitmaps = genre_index.refresh(self.db)
+        ids = bitmaps.genre_ids(genres)
         if not ids:
-            return [], 1, 1, 0
+            return [], 1, 1, 0, []
         if not page.isdigit() or page == '0':
             page = '1'
         page = int(page) - 1
-        query_mask = """SELECT film_id FROM films_genres \
-                        WHERE genre_id = {}"""
-        query = " INTERSECT ".join([query_mask.format(id['id']) for id in ids])
-        films_number = cur.execute(f"""SELECT COUNT(*) FROM
-                                       ({query})""").fetchone()[0]
+        matching = bitmaps.matching(ids)
+        films_number = matching.bit_count()
         if page * app.config['ITEMS_PER_PAGE'] > films_number:
             page = 0
-        query_mask = """SELECT films.title, films.img, films.rate, films.value,
-                        films.year, films.id FROM films LEFT JOIN films_genres
-                        ON films.id = films_genres.film_id
-                        WHERE genre_id = {}"""
-        query = " INTERSECT ".join([query_mask.format(id['id']) for id in ids])
-        films = cur.execute(f"""{query} ORDER by year DESC, value DESC LIMIT {app.config['ITEMS_PER_PAGE']}
-        OFFSET {app.config['ITEMS_PER_PAGE'] * page}""").fetchall()
+        film_ids = bitmaps.page(matching, page * app.config['ITEMS_PER_PAGE'],
+                                app.config['ITEMS_PER_PAGE'])
+        cur = self.db.cursor()
+        rows = cur.execute(f"""SELECT title, img, rate, value, year, id
+                           FROM films WHERE id IN
+                           ({','.join('?' * len(film_ids))})""",
+                           film_ids).fetchall()
+        by_id = {row['id']: row for row in rows}
+        films = [by_id[id] for id in film_ids if id in by_id]
         return (films, page+1,
                 ceil(films_number / app.config['ITEMS_PER_PAGE']),
-                films_number)
+                films_number, bitmaps.facets(matching))
+
+
+@app.teardown_appcontext
+def teardown_db(exception):
+    DataBase().release_db()
 
 
 def login_required(func):
@@ -0,0 +1,77 @@
+from functools import wraps
+from urllib.parse import urlencode
+from flask import g, request, make_response
+from markupsafe import Markup
+from app import app, pages, fragments
+
+
+def page_key():
+    # Path plus the non-empty query arguments in a fixed order, so that
+    # ?a=1&b=2, ?b=2&a=1 and ?a=1&b=2&c= share an entry.
+    args = sorted((name, value)
+                  for name, value in request.args.items(multi=True) if value)
+    return f"{request.path}?{urlencode(args)}"
+
+
+def cached_page(*tags):
+    # Serves anonymous GETs from the page cache. `tags` name the entities
+    # the page is built from and are formatted with the view's arguments,
+    # e.g. 'film:{film_id}'. Cookies are never stored or replayed, and
+    # neither is a page holding a CSRF token. Each entry carries a dict
+    # the compression hook fills with the body in each content encoding.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if g.user_id or request.method != 'GET':
+                return view(**kwargs)
+            key = page_key()
+            cached, token = pages.lookup(key)
+            if cached is not None:
+                status, headers, body, encoded = cached
+                response = app.response_class(body, status, headers)
+                response.encoded = encoded
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            try:
+                response = make_response(view(**kwargs))
+            except Exception:
+                pages.abandon(key)
+                raise
+            # A CSRF token is tied to the session it was rendered for.
+            if (response.status_code != 200 or response.is_streamed
+                    or app.config.get('WTF_CSRF_FIELD_NAME',
+                                      'csrf_token') in g):
+                pages.abandon(key)
+            else:
+                body = response.get_data()
+                headers = [(name, value) for name, value in response.headers
+                           if name.lower() != 'set-cookie']
+                response.encoded = {}
+                pages.store(key, (200, headers, body, response.encoded),
+                            len(body), [tag.format(**kwargs) for tag in tags],
+                            token)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+@app.template_global()
+def fragment(key, *tags, caller):
+    # {% call fragment('movie-cast:' ~ film['id'], 'film:' ~ film['id']) %}
+    # caches the block's HTML for pages that also render per-user parts.
+    cached, token = fragments.lookup(key)
+    if cached is None:
+        try:
+            cached = Markup(caller())
+        except Exception:
+            fragments.abandon(key)
+            raise
+        fragments.store(key, cached, len(cached), tags, token)
+    return cached
+
+
+def invalidate(*tags):
+    for tag in tags:
+        pages.invalidate(tag)
+        fragments.invalidate(tag)
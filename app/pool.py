@@ -0,0 +1,94 @@
+import sqlite3
+import threading
+import time
+from queue import LifoQueue, Empty
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, path, size=8, timeout=5.0, pragmas=None,
+                 factory=sqlite3.Connection):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas or {}
+        self.factory = factory
+        self._idle = LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {'hits': 0, 'misses': 0, 'waits': 0,
+                       'wait_time': 0.0, 'timeouts': 0, 'released': 0}
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False,
+                             factory=self.factory)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode = WAL")
+        for name, value in self.pragmas.items():
+            db.execute(f"PRAGMA {name} = {value}")
+        return db
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self._stats[stat] += value
+
+    def acquire(self):
+        try:
+            db = self._idle.get_nowait()
+            self._count('hits')
+            return db
+        except Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+                self._stats['misses'] += 1
+        if can_create:
+            try:
+                return self._connect()
+            except sqlite3.Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+        start = time.perf_counter()
+        try:
+            db = self._idle.get(timeout=self.timeout)
+        except Empty:
+            self._count('timeouts')
+            raise PoolTimeout(f"no free connection to {self.path} "
+                              f"after {self.timeout}s")
+        with self._lock:
+            self._stats['waits'] += 1
+            self._stats['wait_time'] += time.perf_counter() - start
+        return db
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        self._count('released')
+        self._idle.put_nowait(db)
+
+    def discard(self, db):
+        db.close()
+        with self._lock:
+            self._created -= 1
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self._idle.get_nowait())
+            except Empty:
+                break
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['open'] = self._created
+        stats['idle'] = self._idle.qsize()
+        stats['in_use'] = stats['open'] - stats['idle']
+        return stats
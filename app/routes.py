@@ -1,16 +1,26 @@
+import asyncio
 import sqlite3
 import hashlib
 from flask import (render_template, g, request,
                    redirect, url_for, session,
-                   flash)
-from app import app
+                   flash, jsonify, abort)
+from app import (app, pool, leaderboards, film_details, writer,
+                 hasher, genre_index, social_graph, pages, fragments,
+                 tracer)
 from app.forms import (LoginForm, RegisterForm,
                        ReviewForm, WatchlistForm,
                        UpdateList)
+from app.hashing import HasherBusy
+from app.identity import user_id, sign_in, sign_out
+from app.pagecache import cached_page
+from app.etags import conditional
+from app.compression import compressor
+from app.metrics import metrics
+from app.aio import AsyncFilm, AsyncUser, AsyncWatchlist
 from app.models import (DataBase, Film, User,
                         login_required, Search, Person,
                         Favorites, Watchlater, Watchlist,
-                        logout_required)
+                        Feed, logout_required)
 from datetime import timedelta
 from math import ceil
 
@@ -18,10 +28,37 @@ from math import ceil
 @app.route('/')
 @app.route('/index')
 def index():
-    return render_template('index.html', title='Home')
+    feed, more, recommended = [], None, ()
+    if g.user_id:
+        feed, more = Feed().timeline(g.user_id, request.args.get('before'))
+        recommended = User().recommendations(g.user_id)
+    return render_template('index.html', title='Home', feed=feed,
+                           more=more, recommended=recommended)
+
+
+@app.route('/stats')
+def stats():
+    # Pool, queue and cache internals; off unless MOVIEFLOW_STATS=1.
+    if not app.config['STATS_ENDPOINT']:
+        abort(404)
+    return jsonify(db_pool=pool.stats(), leaderboards=leaderboards.stats(),
+                   film_details=film_details.stats(),
+                   write_behind=writer.stats(), hasher=hasher.stats(),
+                   genre_index=genre_index.stats(),
+                   social_graph=social_graph.stats(),
+                   pages=pages.stats(), fragments=fragments.stats(),
+                   compression=compressor.stats(), sql=tracer.stats())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return app.response_class(metrics.render(),
+                              mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/top')
+@conditional('leaderboards')
+@cached_page('leaderboards')
 def top_rated():
     db = Film()
     films = db.get_top_movies()
@@ -29,6 +66,8 @@ def top_rated():
 
 
 @app.route('/highest-grossing')
+@conditional('leaderboards')
+@cached_page('leaderboards')
 def boxoffice():
     db = Film()
     films = db.highest_grossing_movies()
@@ -36,34 +75,59 @@ def boxoffice():
 
 
 @app.route('/popular')
+@conditional('leaderboards')
+@cached_page('leaderboards')
 def popular():
     db = Film()
     films = db.get_popular_movies()
     return render_template('popular.html', films=films)
 
 
+def movie_lookups(film_id, cursor, username, user_id):
+    db = Film()
+    # Checked first so a queued vote lands before the film is read.
+    rate = User().check_rate(user_id, film_id) if username else 0
+    detail = db.get_film(film_id, cursor)
+    if detail is None:
+        return rate, None, [], []
+    similar = db.similar_films(detail[0]['id'])
+    list_names = Watchlist().watchlist_names(username) if username else []
+    return rate, detail, similar, list_names
+
+
+async def movie_lookups_async(film_id, cursor, username, user_id):
+    # Once the vote has landed, the film, its neighbours and the user's
+    # lists are independent and read concurrently.
+    rate = await AsyncUser().check_rate(user_id, film_id) if username else 0
+    lookups = [AsyncFilm().get_film(film_id, cursor),
+               AsyncFilm().similar_films(film_id)]
+    if username:
+        lookups.append(AsyncWatchlist().watchlist_names(username))
+    detail, similar, *list_names = await asyncio.gather(*lookups)
+    return rate, detail, similar, list_names[0] if list_names else []
+
+
 @app.route('/movie/<film_id>')
+@conditional('film:{film_id}')
+@cached_page('film:{film_id}')
 def movie(film_id):
     form = ReviewForm()
-    db = Film()
-    db_w = Watchlist()
-    db_user = User()
-    page = request.args.get('page', '1')
-    if not db.check_film(film_id):
-        return render_template('404.html')
-    (film, directors, actors, genres,
-     reviews, page, pageCount) = db.get_film(film_id, page)
-    if session.get("__auth"):
-        list_names = db_w.watchlist_names(session["__auth"])
-        rate = db_user.check_rate(film_id)
+    args = (request.args.get('cursor'), session.get("__auth"), g.user_id)
+    if app.config['ASYNC_LOOKUPS'] and film_id.isdigit():
+        # The lookups bring their own connections.
+        DataBase().release_db()
+        lookups = app.ensure_sync(movie_lookups_async)(int(film_id), *args)
     else:
-        list_names = []
-        rate = 0
+        lookups = movie_lookups(film_id, *args)
+    rate, detail, similar, list_names = lookups
+    if detail is None:
+        return render_template('404.html')
+    film, directors, actors, genres, reviews, pager = detail
     return render_template('movie.html', form=form, film=film,
                            directors=directors, actors=actors,
                            genres=genres, reviews=reviews,
                            list_names=list_names, rate=rate,
-                           page=page, pageCount=pageCount)
+                           pager=pager, similar=similar)
 
 
 @app.route('/movie/<film_id>', methods=['POST'])
@@ -73,10 +137,8 @@ def write_review(film_id):
     if not form.validate_on_submit():
         return redirect(url_for('movie', film_id=film_id))
     film = Film()
-    user = User()
     body = form.review.data
-    user_id = user.current_user(session['__auth'])
-    film.write_review(body=body, user_id=user_id, film_id=film_id)
+    film.write_review(body=body, user_id=g.user_id, film_id=film_id)
     return redirect(url_for('movie', film_id=film_id))
 
 
@@ -92,9 +154,13 @@ def register_post():
     form = RegisterForm()
     if form.validate_on_submit():
         user = User()
-        user.insert_user(name=form.username.data,
-                         email=form.email.data,
-                         password=form.password.data)
+        try:
+            user.insert_user(name=form.username.data,
+                             email=form.email.data,
+                             password=form.password.data)
+        except HasherBusy:
+            flash('Too many sign-ups right now, please try again.')
+            return render_template('register.html', form=form), 503
         return redirect(url_for('login_get'))
     return render_template('register.html', form=form)
 
@@ -111,15 +177,15 @@ def login_post():
     if form.validate_on_submit():
         username = form.username.data
         password = form.password.data
-        user = User().check_user(name=username,
-                                 password=password)
-        if user:
-            if form.remember_me.data:
-                session.permanent = True
-                session['__auth'] = username
-            else:
-                session.permanent = False
-                session['__auth'] = username
+        try:
+            id = User().check_user(name=username,
+                                   password=password)
+        except HasherBusy:
+            flash('Too many sign-ins right now, please try again.')
+            return render_template('login.html', title='Sign In',
+                                   form=form), 503
+        if id:
+            sign_in(username, id, remember=form.remember_me.data)
             return redirect('/index')
         flash('Incorect Username or Password')
     return render_template('login.html', title='Sign In', form=form)
@@ -128,35 +194,48 @@ def login_post():
 @app.route('/logout')
 @login_required
 def logout():
-    del session['__auth']
+    sign_out()
     return redirect('/index')
 
 
 @app.route('/<username>/profile')
 @login_required
+@conditional('user:{username}')
 def profile(username):
-    page = request.args.get('page', '1')
+    cursor = request.args.get('cursor')
     user = User()
-    id = user.current_user(username)
+    id = user_id(username)
     if not id:
         return render_template('404.html')
-    followers = user.followers(username)
-    followings = user.followings(username)
-    is_following = user.is_following(username)
-    reviews, page, pageCount = user.get_reviews(id, page)
+    counts = user.follow_counts(id)
+    # Only the owner gets the lists; everyone else sees the counts.
+    followers, followings, suggestions = [], [], []
+    is_following, followed_by = False, 0
+    if id == g.user_id:
+        followers = user.followers(id)
+        followings = user.followings(id)
+        suggestions = user.suggestions(id)
+    elif g.user_id:
+        is_following = user.is_following(g.user_id, id)
+        followed_by = user.followed_by_followings(g.user_id, id)
+    reviews, pager = user.get_reviews(id, cursor)
     return render_template('profile.html', username=username,
                            followings=followings, followers=followers,
-                           reviews=reviews, page=page,
-                           pageCount=pageCount, is_following=is_following)
+                           followers_count=counts['followers_count'],
+                           followings_count=counts['following_count'],
+                           suggestions=suggestions, followed_by=followed_by,
+                           reviews=reviews, pager=pager,
+                           is_following=is_following)
 
 
 @app.route('/follow/<username>')
 @login_required
 def follow(username):
     user = User()
-    if not user.current_user(username):
+    id = user_id(username)
+    if not id:
         return redirect('/index')
-    user.follow(username)
+    user.follow(g.user_id, id)
     return redirect(url_for('profile', username=username))
 
 
@@ -164,9 +243,10 @@ def follow(username):
 @login_required
 def unfollow(username):
     user = User()
-    if not user.current_user(username):
+    id = user_id(username)
+    if not id:
         return redirect('/index')
-    user.unfollow(username)
+    user.unfollow(g.user_id, id)
     return redirect(url_for('profile', username=username))
 
 
@@ -195,6 +275,8 @@ def search():
 
 
 @app.route('/person/<person_id>')
+@conditional('person:{person_id}')
+@cached_page('person:{person_id}')
 def persons(person_id):
     db = Person()
     if person_id.isdigit() and db.check_person(person_id):
@@ -209,8 +291,7 @@ def persons(person_id):
 @login_required
 def watch_later_list():
     db = Watchlater()
-    user_id = db.current_user(session['__auth'])
-    films = db.watch_later(user_id)
+    films = db.watch_later(g.user_id)
     return render_template('watchlater.html', films=films)
 
 
@@ -221,9 +302,8 @@ def watch_later(film_id):
     if not db_f.check_film(film_id):
         return render_template('404.html')
     db = Watchlater()
-    user_id = db.current_user(session['__auth'])
-    if not db.check_duplicate(user_id, film_id):
-        db.add_watch_later(user_id, film_id)
+    if not db.check_duplicate(g.user_id, film_id):
+        db.add_watch_later(g.user_id, film_id)
     return redirect(url_for('movie', film_id=film_id))
 
 
@@ -231,9 +311,8 @@ def watch_later(film_id):
 @login_required
 def del_watch_later(film_id):
     db = Watchlater()
-    user_id = db.current_user(session['__auth'])
-    if db.check_duplicate(user_id, film_id):
-        db.delete_watchlater(user_id, film_id)
+    if db.check_duplicate(g.user_id, film_id):
+        db.delete_watchlater(g.user_id, film_id)
         return redirect(url_for('movie', film_id=film_id))
     return render_template('404.html')
 
@@ -242,8 +321,7 @@ def del_watch_later(film_id):
 @login_required
 def favorites_list():
     db = Favorites()
-    user_id = db.current_user(session['__auth'])
-    films = db.favorites(user_id)
+    films = db.favorites(g.user_id)
     return render_template('favorites.html', films=films)
 
 
@@ -254,9 +332,8 @@ def favorite(film_id):
     if not db_f.check_film(film_id):
         return render_template('404.html')
     db = Favorites()
-    user_id = db.current_user(session['__auth'])
-    if not db.check_duplicate(user_id, film_id):
-        db.add_favorites(user_id, film_id)
+    if not db.check_duplicate(g.user_id, film_id):
+        db.add_favorites(g.user_id, film_id)
     return redirect(url_for('movie', film_id=film_id))
 
 
@@ -264,9 +341,8 @@ def favorite(film_id):
 @login_required
 def del_favorites(film_id):
     db = Favorites()
-    user_id = db.current_user(session['__auth'])
-    if db.check_duplicate(user_id, film_id):
-        db.delete_favorites(user_id, film_id)
+    if db.check_duplicate(g.user_id, film_id):
+        db.delete_favorites(g.user_id, film_id)
         return redirect(url_for('movie', film_id=film_id))
     return render_template('404.html')
 
@@ -276,22 +352,20 @@ def genres():
     genres = tuple(request.args.getlist('gen'))
     page = request.args.get('page', '1')
     search = Search()
-    films, page, pageCount, filmsCount = search.films_by_genres(genres, page)
+    films, page, pageCount, filmsCount, facets = search.films_by_genres(
+        genres, page)
     return render_template('genres.html', films=films, page=page,
                            pageCount=pageCount, filmsCount=filmsCount,
-                           genres=genres)
+                           genres=genres, facets=facets)
 
 
 @app.route('/rate/<film_id>/<val>')
 @login_required
 def rate_movie(film_id, val):
     film = Film()
-    user = User()
     if not film.check_film(film_id):
         return render_template("404.html")
-    if not user.check_rate(film_id):
-        user.rate(film_id, val)
-        film.rate(film_id, val)
+    film.rate(film_id, g.user_id, val)
     return redirect(url_for('movie', film_id=film_id))
 
 
@@ -299,12 +373,9 @@ def rate_movie(film_id, val):
 @login_required
 def delete_rate(film_id):
     film = Film()
-    user = User()
     if not film.check_film(film_id):
         return render_template("404.html")
-    if user.check_rate(film_id):
-        val = user.delete_rate(film_id)
-        film.delete_rate(film_id, val)
+    film.delete_rate(film_id, g.user_id)
     return redirect(url_for('movie', film_id=film_id))
 
 
@@ -358,8 +429,7 @@ def add_filmInList(list_name, film_id):
 @login_required
 def watchlists(username):
     db = Watchlist()
-    user = User()
-    id = user.current_user(username)
+    id = user_id(username)
     if not id:
         return render_template('404.html')
     watchlists = db.watchlists(session['__auth'], username)
@@ -391,6 +461,7 @@ def public_list(list_name):
 
 @app.route('/<username>/flow/<list_name>')  # update
 @login_required
+@conditional('list:{username}/{list_name}')
 def list_films(username, list_name):
     db = Watchlist()
     list_id = db.get_list_id(session['__auth'], username, list_name)
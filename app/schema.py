@@ -0,0 +1,791 @@
+import sqlite3
+
+
+BASE_TABLES = """
+CREATE TABLE IF NOT EXISTS films (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    original_title TEXT,
+    year INTEGER,
+    premdate TEXT,
+    genres TEXT,
+    body TEXT,
+    img TEXT,
+    trailer TEXT,
+    rate REAL NOT NULL DEFAULT 0,
+    votes INTEGER NOT NULL DEFAULT 0,
+    value REAL NOT NULL DEFAULT 0,
+    box_office INTEGER
+);
+CREATE TABLE IF NOT EXISTS persons (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    img TEXT,
+    body TEXT
+);
+CREATE TABLE IF NOT EXISTS types (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS persons_types (
+    id INTEGER PRIMARY KEY,
+    person_id INTEGER NOT NULL REFERENCES persons(id),
+    type_id INTEGER NOT NULL REFERENCES types(id)
+);
+CREATE TABLE IF NOT EXISTS films_casts (
+    id INTEGER PRIMARY KEY,
+    film_id INTEGER NOT NULL REFERENCES films(id),
+    person_id INTEGER NOT NULL REFERENCES persons(id),
+    type INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS genres (
+    id INTEGER PRIMARY KEY,
+    genre TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS films_genres (
+    id INTEGER PRIMARY KEY,
+    film_id INTEGER NOT NULL REFERENCES films(id),
+    genre_id INTEGER NOT NULL REFERENCES genres(id)
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    email TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    film_id INTEGER NOT NULL REFERENCES films(id),
+    body TEXT NOT NULL,
+    date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS films_rates (
+    id INTEGER PRIMARY KEY,
+    film_id INTEGER NOT NULL REFERENCES films(id),
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    rate INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS followed (
+    id INTEGER PRIMARY KEY,
+    is_following INTEGER NOT NULL REFERENCES users(id),
+    following INTEGER NOT NULL REFERENCES users(id)
+);
+CREATE TABLE IF NOT EXISTS watchlists (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    name TEXT NOT NULL,
+    body TEXT,
+    private INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS watchlists_films (
+    id INTEGER PRIMARY KEY,
+    watchlist_id INTEGER NOT NULL REFERENCES watchlists(id),
+    film_id INTEGER NOT NULL REFERENCES films(id)
+);
+CREATE TABLE IF NOT EXISTS users_watchlater (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    film_id INTEGER NOT NULL REFERENCES films(id)
+);
+CREATE TABLE IF NOT EXISTS users_favorites (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    film_id INTEGER NOT NULL REFERENCES films(id)
+);
+"""
+
+HOT_INDEXES = """
+CREATE INDEX IF NOT EXISTS films_casts_film_type
+    ON films_casts (film_id, type);
+CREATE INDEX IF NOT EXISTS films_casts_person_type
+    ON films_casts (person_id, type);
+CREATE INDEX IF NOT EXISTS films_genres_genre_film
+    ON films_genres (genre_id, film_id);
+CREATE INDEX IF NOT EXISTS films_genres_film_genre
+    ON films_genres (film_id, genre_id);
+CREATE INDEX IF NOT EXISTS persons_types_person
+    ON persons_types (person_id, type_id);
+CREATE INDEX IF NOT EXISTS reviews_film_date ON reviews (film_id, date);
+CREATE INDEX IF NOT EXISTS reviews_user_date ON reviews (user_id, date);
+CREATE INDEX IF NOT EXISTS films_rates_user_film
+    ON films_rates (user_id, film_id);
+CREATE INDEX IF NOT EXISTS followed_pair ON followed (is_following, following);
+CREATE INDEX IF NOT EXISTS followed_following
+    ON followed (following, is_following);
+CREATE INDEX IF NOT EXISTS watchlists_username_name
+    ON watchlists (username, name);
+CREATE INDEX IF NOT EXISTS watchlists_username ON watchlists (username);
+CREATE INDEX IF NOT EXISTS watchlists_films_list
+    ON watchlists_films (watchlist_id);
+CREATE INDEX IF NOT EXISTS users_watchlater_user
+    ON users_watchlater (user_id);
+CREATE INDEX IF NOT EXISTS users_favorites_user
+    ON users_favorites (user_id);
+CREATE INDEX IF NOT EXISTS films_value ON films (value);
+CREATE INDEX IF NOT EXISTS films_box_office ON films (box_office);
+CREATE INDEX IF NOT EXISTS films_year_value ON films (year, value);
+"""
+
+SEARCH_INDEX = """
+CREATE VIRTUAL TABLE IF NOT EXISTS films_fts USING fts5(
+    title, original_title, year,
+    content='films', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS films_fts_insert AFTER INSERT ON films BEGIN
+    INSERT INTO films_fts (rowid, title, original_title, year)
+    VALUES (new.id, new.title, new.original_title, new.year);
+END;
+CREATE TRIGGER IF NOT EXISTS films_fts_delete AFTER DELETE ON films BEGIN
+    INSERT INTO films_fts (films_fts, rowid, title, original_title, year)
+    VALUES ('delete', old.id, old.title, old.original_title, old.year);
+END;
+CREATE TRIGGER IF NOT EXISTS films_fts_update
+AFTER UPDATE OF title, original_title, year ON films BEGIN
+    INSERT INTO films_fts (films_fts, rowid, title, original_title, year)
+    VALUES ('delete', old.id, old.title, old.original_title, old.year);
+    INSERT INTO films_fts (rowid, title, original_title, year)
+    VALUES (new.id, new.title, new.original_title, new.year);
+END;
+INSERT INTO films_fts (films_fts) VALUES ('rebuild');
+
+CREATE VIRTUAL TABLE IF NOT EXISTS persons_fts USING fts5(
+    name,
+    content='persons', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS persons_fts_insert AFTER INSERT ON persons BEGIN
+    INSERT INTO persons_fts (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS persons_fts_delete AFTER DELETE ON persons BEGIN
+    INSERT INTO persons_fts (persons_fts, rowid, name)
+    VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS persons_fts_update
+AFTER UPDATE OF name ON persons BEGIN
+    INSERT INTO persons_fts (persons_fts, rowid, name)
+    VALUES ('delete', old.id, old.name);
+    INSERT INTO persons_fts (rowid, name) VALUES (new.id, new.name);
+END;
+INSERT INTO persons_fts (persons_fts) VALUES ('rebuild');
+"""
+
+REVIEW_COUNTERS = """
+ALTER TABLE films ADD COLUMN reviews_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN reviews_count INTEGER NOT NULL DEFAULT 0;
+UPDATE films SET reviews_count =
+    (SELECT COUNT(*) FROM reviews WHERE reviews.film_id = films.id);
+UPDATE users SET reviews_count =
+    (SELECT COUNT(*) FROM reviews WHERE reviews.user_id = users.id);
+CREATE TRIGGER IF NOT EXISTS reviews_count_insert AFTER INSERT ON reviews
+BEGIN
+    UPDATE films SET reviews_count = reviews_count + 1
+    WHERE id = new.film_id;
+    UPDATE users SET reviews_count = reviews_count + 1
+    WHERE id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS reviews_count_delete AFTER DELETE ON reviews
+BEGIN
+    UPDATE films SET reviews_count = reviews_count - 1
+    WHERE id = old.film_id;
+    UPDATE users SET reviews_count = reviews_count - 1
+    WHERE id = old.user_id;
+END;
+"""
+
+RATING_HISTOGRAM = """
+CREATE TABLE IF NOT EXISTS films_rates_histogram (
+    film_id INTEGER NOT NULL REFERENCES films(id),
+    score INTEGER NOT NULL CHECK (score BETWEEN 1 AND 10),
+    votes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (film_id, score)
+) WITHOUT ROWID;
+INSERT INTO films_rates_histogram (film_id, score, votes)
+    SELECT film_id, rate, COUNT(*) FROM films_rates
+    WHERE rate BETWEEN 1 AND 10 GROUP BY film_id, rate;
+ALTER TABLE films ADD COLUMN imported_votes INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE films ADD COLUMN imported_sum REAL NOT NULL DEFAULT 0;
+UPDATE films SET
+    imported_votes = MAX(votes - COALESCE((SELECT SUM(votes)
+        FROM films_rates_histogram WHERE film_id = films.id), 0), 0),
+    imported_sum = MAX(rate * votes - COALESCE((SELECT SUM(score * votes)
+        FROM films_rates_histogram WHERE film_id = films.id), 0), 0);
+"""
+
+RATING_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS films_rates_histogram_insert
+AFTER INSERT ON films_rates BEGIN
+    INSERT INTO films_rates_histogram (film_id, score, votes)
+    VALUES (new.film_id, new.rate, 1)
+    ON CONFLICT (film_id, score) DO UPDATE SET votes = votes + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS films_rates_histogram_delete
+AFTER DELETE ON films_rates BEGIN
+    UPDATE films_rates_histogram SET votes = votes - 1
+    WHERE film_id = old.film_id AND score = old.rate AND votes > 0;
+END;
+"""
+
+REVIEW_EPOCH = """
+ALTER TABLE reviews ADD COLUMN posted INTEGER NOT NULL DEFAULT 0;
+UPDATE reviews SET posted = COALESCE(CAST(strftime('%s', date) AS INTEGER), 0);
+DROP INDEX IF EXISTS reviews_film_date;
+DROP INDEX IF EXISTS reviews_user_date;
+CREATE INDEX IF NOT EXISTS reviews_film_posted ON reviews (film_id, posted);
+CREATE INDEX IF NOT EXISTS reviews_user_posted ON reviews (user_id, posted);
+CREATE TRIGGER IF NOT EXISTS reviews_posted_default AFTER INSERT ON reviews
+WHEN new.posted = 0 BEGIN
+    UPDATE reviews SET
+        posted = COALESCE(CAST(strftime('%s', new.date) AS INTEGER), 0)
+    WHERE id = new.id;
+END;
+"""
+
+GENRE_INDEX_LOG = """
+CREATE TABLE IF NOT EXISTS genre_index_log (
+    seq INTEGER PRIMARY KEY,
+    film_id INTEGER,
+    genre_id INTEGER,
+    added INTEGER
+);
+CREATE TRIGGER IF NOT EXISTS films_genres_log_insert
+AFTER INSERT ON films_genres BEGIN
+    INSERT INTO genre_index_log (film_id, genre_id, added)
+    VALUES (new.film_id, new.genre_id, 1);
+END;
+CREATE TRIGGER IF NOT EXISTS films_genres_log_delete
+AFTER DELETE ON films_genres BEGIN
+    INSERT INTO genre_index_log (film_id, genre_id, added)
+    VALUES (old.film_id, old.genre_id, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS films_genres_log_update
+AFTER UPDATE OF film_id, genre_id ON films_genres BEGIN
+    INSERT INTO genre_index_log (film_id, genre_id, added)
+    VALUES (old.film_id, old.genre_id, 0), (new.film_id, new.genre_id, 1);
+END;
+CREATE TRIGGER IF NOT EXISTS films_log_insert AFTER INSERT ON films BEGIN
+    INSERT INTO genre_index_log (film_id) VALUES (new.id);
+END;
+CREATE TRIGGER IF NOT EXISTS films_log_delete AFTER DELETE ON films BEGIN
+    INSERT INTO genre_index_log (film_id) VALUES (old.id);
+END;
+CREATE TRIGGER IF NOT EXISTS films_log_order
+AFTER UPDATE OF year, value ON films BEGIN
+    INSERT INTO genre_index_log (film_id) VALUES (new.id);
+END;
+CREATE TRIGGER IF NOT EXISTS genres_log_insert AFTER INSERT ON genres BEGIN
+    INSERT INTO genre_index_log (genre_id) VALUES (new.id);
+END;
+"""
+
+FOLLOW_COUNTERS = """
+ALTER TABLE users ADD COLUMN followers_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN following_count INTEGER NOT NULL DEFAULT 0;
+UPDATE users SET
+    followers_count =
+        (SELECT COUNT(*) FROM followed WHERE following = users.id),
+    following_count =
+        (SELECT COUNT(*) FROM followed WHERE is_following = users.id);
+CREATE INDEX IF NOT EXISTS users_name_followers
+    ON users (name COLLATE NOCASE, followers_count, following_count);
+CREATE TRIGGER IF NOT EXISTS followed_count_insert AFTER INSERT ON followed
+BEGIN
+    UPDATE users SET followers_count = followers_count + 1
+    WHERE id = new.following;
+    UPDATE users SET following_count = following_count + 1
+    WHERE id = new.is_following;
+END;
+CREATE TRIGGER IF NOT EXISTS followed_count_delete AFTER DELETE ON followed
+BEGIN
+    UPDATE users SET followers_count = followers_count - 1
+    WHERE id = old.following;
+    UPDATE users SET following_count = following_count - 1
+    WHERE id = old.is_following;
+END;
+"""
+
+ACTIVITY_FEED = """
+-- AUTOINCREMENT: ids must never be reused, feed_state.fanned_out and
+-- feed cursors are positions in this sequence.
+CREATE TABLE IF NOT EXISTS activities (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    kind TEXT NOT NULL,
+    film_id INTEGER,
+    review_id INTEGER,
+    watchlist_id INTEGER,
+    rate INTEGER,
+    created INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activities_user ON activities (user_id, id);
+CREATE TABLE IF NOT EXISTS timelines (
+    user_id INTEGER NOT NULL,
+    activity_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, activity_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS feed_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    fanned_out INTEGER NOT NULL
+);
+INSERT INTO feed_state (id, fanned_out) VALUES (1, 0);
+ALTER TABLE users ADD COLUMN timeline_size INTEGER NOT NULL DEFAULT 0;
+CREATE TRIGGER IF NOT EXISTS timelines_size_insert AFTER INSERT ON timelines
+BEGIN
+    UPDATE users SET timeline_size = timeline_size + 1
+    WHERE id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS timelines_size_delete AFTER DELETE ON timelines
+BEGIN
+    UPDATE users SET timeline_size = timeline_size - 1
+    WHERE id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS reviews_activity AFTER INSERT ON reviews
+BEGIN
+    INSERT INTO activities (user_id, kind, film_id, review_id, created)
+    VALUES (new.user_id, 'review', new.film_id, new.id,
+            CAST(strftime('%s', 'now') AS INTEGER));
+END;
+CREATE TRIGGER IF NOT EXISTS reviews_activity_delete AFTER DELETE ON reviews
+BEGIN
+    DELETE FROM activities WHERE user_id = old.user_id
+    AND kind = 'review' AND review_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS films_rates_activity AFTER INSERT ON films_rates
+BEGIN
+    INSERT INTO activities (user_id, kind, film_id, rate, created)
+    VALUES (new.user_id, 'rate', new.film_id, new.rate,
+            CAST(strftime('%s', 'now') AS INTEGER));
+END;
+CREATE TRIGGER IF NOT EXISTS films_rates_activity_delete
+AFTER DELETE ON films_rates BEGIN
+    DELETE FROM activities WHERE user_id = old.user_id
+    AND kind = 'rate' AND film_id = old.film_id;
+END;
+CREATE TRIGGER IF NOT EXISTS watchlists_activity AFTER INSERT ON watchlists
+WHEN NOT EXISTS (SELECT 1 FROM activities WHERE kind = 'flow'
+    AND user_id = (SELECT id FROM users WHERE name = new.username)
+    AND watchlist_id = new.id)
+BEGIN
+    INSERT INTO activities (user_id, kind, watchlist_id, created)
+    SELECT id, 'flow', new.id, CAST(strftime('%s', 'now') AS INTEGER)
+    FROM users WHERE name = new.username;
+END;
+"""
+
+FILM_SIMILARITY = """
+-- Filled by `flask build-similar`; rank 0 is the closest neighbour.
+CREATE TABLE IF NOT EXISTS films_similar (
+    film_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    similar_id INTEGER NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (film_id, rank)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS films_similar_similar
+    ON films_similar (similar_id, film_id);
+-- AUTOINCREMENT: built logs are deleted, seq must keep growing past
+-- similarity_state.built_seq.
+CREATE TABLE IF NOT EXISTS similarity_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    film_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS similarity_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    built_seq INTEGER NOT NULL
+);
+INSERT INTO similarity_state (id, built_seq) VALUES (1, -1);
+CREATE TRIGGER IF NOT EXISTS films_rates_similarity_insert
+AFTER INSERT ON films_rates BEGIN
+    INSERT INTO similarity_log (film_id) VALUES (new.film_id);
+END;
+CREATE TRIGGER IF NOT EXISTS films_rates_similarity_delete
+AFTER DELETE ON films_rates BEGIN
+    INSERT INTO similarity_log (film_id) VALUES (old.film_id);
+END;
+CREATE TRIGGER IF NOT EXISTS films_rates_similarity_update
+AFTER UPDATE OF film_id, rate ON films_rates BEGIN
+    INSERT INTO similarity_log (film_id)
+    VALUES (old.film_id), (new.film_id);
+END;
+"""
+
+ENTITY_VERSIONS = """
+-- One row per page-level entity ('film:<id>', 'person:<id>',
+-- 'user:<name>', 'list:<owner>/<name>', 'leaderboards'), bumped by the
+-- triggers below whenever something shown on its pages changes. ETags
+-- are built from these versions.
+CREATE TABLE IF NOT EXISTS entity_versions (
+    entity TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    modified INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS films_version_insert
+AFTER INSERT ON films BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || new.id AS entity
+        UNION ALL SELECT 'leaderboards')
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_version_update
+AFTER UPDATE ON films BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || new.id AS entity
+        UNION ALL SELECT 'leaderboards')
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_version_delete
+AFTER DELETE ON films BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || old.id AS entity
+        UNION ALL SELECT 'leaderboards')
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS reviews_version_insert
+AFTER INSERT ON reviews BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || new.film_id AS entity
+        UNION ALL SELECT 'user:' || name FROM users WHERE id = new.user_id)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS reviews_version_delete
+AFTER DELETE ON reviews BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || old.film_id AS entity
+        UNION ALL SELECT 'user:' || name FROM users WHERE id = old.user_id)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_rates_version_insert
+AFTER INSERT ON films_rates BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || new.film_id AS entity)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_rates_version_update
+AFTER UPDATE ON films_rates BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || old.film_id AS entity
+        UNION ALL SELECT 'film:' || new.film_id)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_rates_version_delete
+AFTER DELETE ON films_rates BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || old.film_id AS entity)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_casts_version_insert
+AFTER INSERT ON films_casts BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || new.film_id AS entity
+        UNION ALL SELECT 'person:' || new.person_id)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_casts_version_delete
+AFTER DELETE ON films_casts BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || old.film_id AS entity
+        UNION ALL SELECT 'person:' || old.person_id)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_genres_version_insert
+AFTER INSERT ON films_genres BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || new.film_id AS entity)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS films_genres_version_delete
+AFTER DELETE ON films_genres BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'film:' || old.film_id AS entity)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS persons_version_update
+AFTER UPDATE ON persons BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'person:' || new.id AS entity)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS persons_types_version_insert
+AFTER INSERT ON persons_types BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'person:' || new.person_id AS entity)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS persons_types_version_delete
+AFTER DELETE ON persons_types BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'person:' || old.person_id AS entity)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS followed_version_insert
+AFTER INSERT ON followed BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'user:' || name AS entity FROM users
+            WHERE id IN (new.is_following, new.following))
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS followed_version_delete
+AFTER DELETE ON followed BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'user:' || name AS entity FROM users
+            WHERE id IN (old.is_following, old.following))
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS watchlists_version_insert
+AFTER INSERT ON watchlists BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'user:' || new.username AS entity
+        UNION ALL SELECT 'list:' || new.username || '/' || new.name)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS watchlists_version_update
+AFTER UPDATE ON watchlists BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'user:' || new.username AS entity
+        UNION ALL SELECT 'list:' || old.username || '/' || old.name
+        UNION ALL SELECT 'list:' || new.username || '/' || new.name)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS watchlists_version_delete
+AFTER DELETE ON watchlists BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'user:' || old.username AS entity
+        UNION ALL SELECT 'list:' || old.username || '/' || old.name)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS watchlists_films_version_insert
+AFTER INSERT ON watchlists_films BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'list:' || username || '/' || name AS entity FROM watchlists
+            WHERE id = new.watchlist_id)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+CREATE TRIGGER IF NOT EXISTS watchlists_films_version_delete
+AFTER DELETE ON watchlists_films BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        SELECT 'list:' || username || '/' || name AS entity FROM watchlists
+            WHERE id = old.watchlist_id)
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;
+"""
+
+# Upstream keys for `flask import-catalog`, which upserts by them (rows
+# entered by hand have no source_id), and the indexes and triggers it
+# has dropped for a bulk load, kept until they are created again so that
+# an interrupted load can be finished by the next one.
+CATALOG_KEYS = """
+CREATE UNIQUE INDEX IF NOT EXISTS films_source
+    ON films (source_id) WHERE source_id IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS persons_source
+    ON persons (source_id) WHERE source_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS deferred_schema (
+    name TEXT PRIMARY KEY,
+    sql TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def catalog_keys(db):
+    # The source_id columns are only added where missing: databases
+    # created by an earlier BASE_TABLES already have them.
+    for table in ('films', 'persons'):
+        columns = {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+        if 'source_id' not in columns:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN source_id TEXT")
+    for statement in CATALOG_KEYS.split(';'):
+        if statement.strip():
+            db.execute(statement)
+
+
+# Timeline rows go with their activity, for deleted reviews and ratings.
+# Only followers of the author can hold one (unfollowing drops them), so
+# each is found through the primary key without an index on activity_id.
+# Rows left behind by earlier deletes are cleared once.
+TIMELINE_CLEANUP = """
+CREATE TRIGGER IF NOT EXISTS activities_timelines_delete
+AFTER DELETE ON activities BEGIN
+    DELETE FROM timelines WHERE activity_id = old.id AND user_id IN
+        (SELECT is_following FROM followed WHERE following = old.user_id);
+END;
+DELETE FROM timelines WHERE NOT EXISTS (SELECT 1 FROM activities
+    WHERE activities.id = timelines.activity_id);
+"""
+
+# What bumps entity_versions: (trigger name prefix, table, events, the
+# columns whose updates show on the pages, SELECTs of the entities with
+# {row} standing for new or old). Updates of other columns, such as the
+# review counters and vote totals, and updates that leave the columns as
+# they were, bump nothing.
+FILM_PAGE = ('title', 'year', 'premdate', 'genres', 'body', 'img',
+             'trailer', 'rate')
+LEADERBOARD = ('title', 'year', 'genres', 'img', 'rate', 'value',
+               'box_office')
+VERSIONED = [
+    ('films_version', 'films', ('insert', 'update', 'delete'), FILM_PAGE,
+     ["SELECT 'film:' || {row}.id AS entity"]),
+    ('films_leaderboards_version', 'films', ('insert', 'update', 'delete'),
+     LEADERBOARD, ["SELECT 'leaderboards' AS entity"]),
+    ('reviews_version', 'reviews', ('insert', 'delete'), (),
+     ["SELECT 'film:' || {row}.film_id AS entity",
+      "SELECT 'user:' || name AS entity FROM users "
+      "WHERE id = {row}.user_id"]),
+    ('films_rates_version', 'films_rates', ('insert', 'update', 'delete'),
+     ('film_id', 'rate'), ["SELECT 'film:' || {row}.film_id AS entity"]),
+    ('films_casts_version', 'films_casts', ('insert', 'delete'), (),
+     ["SELECT 'film:' || {row}.film_id AS entity",
+      "SELECT 'person:' || {row}.person_id AS entity"]),
+    ('films_genres_version', 'films_genres', ('insert', 'delete'), (),
+     ["SELECT 'film:' || {row}.film_id AS entity"]),
+    ('persons_version', 'persons', ('update',), ('name', 'img', 'body'),
+     ["SELECT 'person:' || {row}.id AS entity"]),
+    ('persons_types_version', 'persons_types', ('insert', 'delete'), (),
+     ["SELECT 'person:' || {row}.person_id AS entity"]),
+    ('followed_version', 'followed', ('insert', 'delete'), (),
+     ["SELECT 'user:' || name AS entity FROM users "
+      "WHERE id IN ({row}.is_following, {row}.following)"]),
+    ('watchlists_version', 'watchlists', ('insert', 'update', 'delete'),
+     ('username', 'name', 'body', 'private'),
+     ["SELECT 'user:' || {row}.username AS entity",
+      "SELECT 'list:' || {row}.username || '/' || {row}.name AS entity"]),
+    ('watchlists_films_version', 'watchlists_films', ('insert', 'delete'),
+     (), ["SELECT 'list:' || username || '/' || name AS entity "
+          "FROM watchlists WHERE id = {row}.watchlist_id"]),
+]
+
+
+def version_triggers(versioned):
+    script = []
+    for prefix, table, events, columns, entities in versioned:
+        for event in ('insert', 'update', 'delete'):
+            script.append(f"DROP TRIGGER IF EXISTS {prefix}_{event};")
+        for event in events:
+            rows = {'insert': ['new'], 'update': ['old', 'new'],
+                    'delete': ['old']}[event]
+            selects = dict.fromkeys(entity.format(row=row)
+                                    for entity in entities for row in rows)
+            clause = f"AFTER {event.upper()}"
+            if event == 'update':
+                changed = ' OR\n    '.join(f"old.{column} IS NOT new.{column}"
+                                           for column in columns)
+                clause += (f" OF {', '.join(columns)} ON {table}\n"
+                           f"WHEN {changed}")
+            else:
+                clause += f" ON {table}"
+            union = '\n        UNION '.join(selects)
+            script.append(f"""CREATE TRIGGER {prefix}_{event}
+{clause} BEGIN
+    INSERT INTO entity_versions (entity, version, modified)
+    SELECT entity, 1, strftime('%s', 'now') FROM (
+        {union})
+    WHERE true ON CONFLICT (entity) DO UPDATE
+    SET version = version + 1, modified = excluded.modified;
+END;""")
+    return '\n'.join(script) + '\n'
+
+
+# Created from VERSIONED, replacing the triggers ENTITY_VERSIONS created,
+# which bumped every entity on any update of their rows.
+VERSION_TRIGGERS = version_triggers(VERSIONED)
+
+# The same bump for versions changed outside a trigger, such as the
+# films_similar rows written by `flask build-similar`.
+BUMP_VERSION = """INSERT INTO entity_versions (entity, version, modified)
+VALUES (?, 1, strftime('%s', 'now')) ON CONFLICT (entity) DO UPDATE
+SET version = version + 1, modified = excluded.modified"""
+
+# Each entry upgrades the database from version N to N + 1, where N is
+# the entry's position. The current version lives in PRAGMA user_version.
+# An entry is either an SQL script or a function taking the connection,
+# for steps that need to backfill data.
+MIGRATIONS = [
+    BASE_TABLES,
+    HOT_INDEXES,
+    SEARCH_INDEX,
+    REVIEW_COUNTERS,
+    RATING_HISTOGRAM,
+    RATING_TRIGGERS,
+    REVIEW_EPOCH,
+    GENRE_INDEX_LOG,
+    FOLLOW_COUNTERS,
+    ACTIVITY_FEED,
+    FILM_SIMILARITY,
+    ENTITY_VERSIONS,
+    catalog_keys,
+    TIMELINE_CLEANUP,
+    VERSION_TRIGGERS,
+]
+
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db, target=None):
+    target = len(MIGRATIONS) if target is None else target
+    version = schema_version(db)
+    applied = []
+    while version < target:
+        step = MIGRATIONS[version]
+        try:
+            if callable(step):
+                db.execute("BEGIN")
+                step(db)
+                db.execute(f"PRAGMA user_version = {version + 1}")
+                db.execute("COMMIT")
+            else:
+                db.executescript(f"BEGIN; {step} PRAGMA user_version = "
+                                 f"{version + 1}; COMMIT;")
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        version += 1
+        applied.append(version)
+    if applied:
+        db.execute("ANALYZE")
+    return applied
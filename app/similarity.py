@@ -0,0 +1,192 @@
+import sqlite3
+import time
+from array import array
+from app.schema import BUMP_VERSION
+
+
+# Offline item-item neighbours for films_similar. Each film is the column
+# of a users x films matrix of ratings centred on the user's mean rating
+# (adjusted cosine), scaled to unit length; a block of films times the
+# whole matrix gives their similarity to every other film. Only `chunk`
+# films are multiplied at a time, so memory is bounded by the ratings
+# plus one block. Scores are shrunk by co-raters / (co-raters + shrink)
+# so pairs rated together by one or two users don't top the lists.
+#
+# Incremental refreshes recompute the films whose ratings changed since
+# the last build (from similarity_log), the films that listed them and
+# the films they now rank above the last neighbour. Other films whose
+# raters' mean ratings moved are left alone until the next full build.
+
+LAST_LOGGED = "SELECT MAX(seq) FROM similarity_log"
+BUILT = "SELECT built_seq FROM similarity_state WHERE id = 1"
+
+
+def load_ratings(db, batch=50000):
+    import numpy as np
+    from scipy import sparse
+
+    users, films, rates = array('i'), array('i'), array('f')
+    cur = db.execute("SELECT user_id, film_id, rate FROM films_rates")
+    while True:
+        rows = cur.fetchmany(batch)
+        if not rows:
+            break
+        user, film, rate = zip(*rows)
+        users.extend(user)
+        films.extend(film)
+        rates.extend(rate)
+    size = db.execute("SELECT MAX(id) FROM films").fetchone()[0] or 0
+    users = np.frombuffer(users, dtype=np.int32)
+    films = np.frombuffer(films, dtype=np.int32)
+    rates = np.frombuffer(rates, dtype=np.float32).copy()
+    shape = (int(users.max(initial=0)) + 1, max(size, int(films.max(
+        initial=0))) + 1)
+    ratings = sparse.csr_matrix((rates, (users, films)), shape=shape)
+    ratings.sum_duplicates()
+    counts = np.diff(ratings.indptr)
+    means = np.asarray(ratings.sum(axis=1)).ravel() / np.maximum(counts, 1)
+    rated = ratings.copy()
+    rated.data[:] = 1
+    ratings.data -= np.repeat(means, counts).astype(np.float32)
+    ratings = ratings.tocsc()
+    norms = np.sqrt(np.asarray(ratings.multiply(ratings).sum(axis=0)))
+    norms = norms.ravel()
+    scale = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+    ratings = ratings @ sparse.diags(scale.astype(np.float32))
+    return ratings.tocsc(), rated.tocsc()
+
+
+class Neighbours:
+    def __init__(self, db, k=20, chunk=256, shrink=10.0):
+        self.db = db
+        self.k = k
+        self.chunk = chunk
+        self.shrink = shrink
+        self.ratings, self.rated = load_ratings(db)
+        self.rows = self.ratings.T.tocsr()
+        self.rated_rows = self.rated.T.tocsr()
+        self.films = self.ratings.shape[1]
+
+    def scores(self, films):
+        # Shrunk similarity of `films` (a row selection) to every film.
+        block = self.rows[films] @ self.ratings
+        overlap = self.rated_rows[films] @ self.rated
+        overlap.data = overlap.data / (overlap.data + self.shrink)
+        block = block.multiply(overlap).tocsr()
+        block.eliminate_zeros()
+        return block
+
+    def top(self, block, films):
+        import numpy as np
+
+        lists = []
+        for i, film in enumerate(films):
+            lo, hi = block.indptr[i], block.indptr[i + 1]
+            ids, scores = block.indices[lo:hi], block.data[lo:hi]
+            keep = (scores > 0) & (ids != film)
+            ids, scores = ids[keep], scores[keep]
+            if len(ids) > self.k:
+                part = np.argpartition(-scores, self.k)[:self.k]
+                ids, scores = ids[part], scores[part]
+            order = np.lexsort((ids, -scores))
+            lists.append((int(film), [(int(ids[j]), round(float(scores[j]), 5))
+                                      for j in order]))
+        return lists
+
+    def save(self, lists, delete):
+        cur = self.db.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            delete(cur)
+            cur.executemany("""INSERT INTO films_similar
+                (film_id, rank, similar_id, score) VALUES (?, ?, ?, ?)""",
+                [(film, rank, similar, score) for film, neighbours in lists
+                 for rank, (similar, score) in enumerate(neighbours)])
+            cur.executemany(BUMP_VERSION, [(f"film:{film}",)
+                                           for film, _ in lists])
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        return sum(len(neighbours) for _, neighbours in lists)
+
+    def build_all(self):
+        # Every chunk replaces its id range in one transaction, so readers
+        # see either the old or the new lists, never none.
+        import numpy as np
+
+        pairs = 0
+        for start in range(0, self.films, self.chunk):
+            films = np.arange(start, min(start + self.chunk, self.films))
+            lists = self.top(self.scores(films), films)
+            pairs += self.save(lists, lambda cur: cur.execute(
+                """DELETE FROM films_similar
+                WHERE film_id >= ? AND film_id < ?""",
+                (start, start + self.chunk)))
+        self.db.execute("""DELETE FROM films_similar
+                        WHERE film_id >= ?""", (self.films,))
+        self.db.commit()
+        return self.films, pairs
+
+    def affected(self, dirty):
+        # `dirty` plus films listing one of them, plus films one of them
+        # now beats the last neighbour of.
+        import numpy as np
+
+        films = set(int(film) for film in dirty)
+        for start in range(0, len(dirty), 500):
+            ids = [int(film) for film in dirty[start:start + 500]]
+            marks = ','.join('?' * len(ids))
+            films.update(row[0] for row in self.db.execute(
+                f"""SELECT DISTINCT film_id FROM films_similar
+                WHERE similar_id IN ({marks})""", ids))
+        last = np.zeros(self.films, dtype=np.float32)
+        for film, score in self.db.execute("""SELECT film_id, score
+                FROM films_similar WHERE rank = ?""", (self.k - 1,)):
+            if film < self.films:
+                last[film] = score
+        for start in range(0, len(dirty), self.chunk):
+            block = self.scores(dirty[start:start + self.chunk]).tocoo()
+            beats = block.data > last[block.col]
+            films.update(int(film) for film in block.col[beats])
+        return np.array(sorted(f for f in films if f < self.films),
+                        dtype=np.int64)
+
+    def build_changed(self, dirty):
+        pairs = 0
+        films = self.affected(dirty)
+        for start in range(0, len(films), self.chunk):
+            chunk = films[start:start + self.chunk]
+            ids = [(int(film),) for film in chunk]
+            lists = self.top(self.scores(chunk), chunk)
+            pairs += self.save(lists, lambda cur: cur.executemany(
+                "DELETE FROM films_similar WHERE film_id = ?", ids))
+        return len(films), pairs
+
+
+def refresh(db, full=False, k=20, chunk=256, shrink=10.0, max_dirty=0.1):
+    # Returns (mode, films recomputed, pairs written, seconds).
+    import numpy as np
+
+    start = time.perf_counter()
+    upto = db.execute(LAST_LOGGED).fetchone()[0] or 0
+    built = db.execute(BUILT).fetchone()[0]
+    dirty = np.array([row[0] for row in db.execute(
+        """SELECT DISTINCT film_id FROM similarity_log
+        WHERE seq > ? AND seq <= ?""", (built, upto))], dtype=np.int64)
+    if built < 0:
+        full = True
+    neighbours = Neighbours(db, k=k, chunk=chunk, shrink=shrink)
+    if not full and len(dirty) > max_dirty * neighbours.films:
+        full = True
+    if full:
+        films, pairs = neighbours.build_all()
+    else:
+        dirty = dirty[dirty < neighbours.films]
+        films, pairs = neighbours.build_changed(dirty)
+    db.execute("UPDATE similarity_state SET built_seq = ? WHERE id = 1",
+               (upto,))
+    db.execute("DELETE FROM similarity_log WHERE seq <= ?", (upto,))
+    db.commit()
+    return ('full' if full else 'incremental', films, pairs,
+            time.perf_counter() - start)
@@ -0,0 +1,39 @@
+import time
+from calendar import monthrange
+from datetime import date
+
+
+UNITS = ((86400, 'd'), (3600, 'hr'), (60, 'min'), (1, 'sec'))
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def time_since(stamps, now=None):
+    # Labels such as "3 d" or "2 mo" for a page of epoch timestamps, with
+    # the largest unit of relativedelta(now, stamp): whole months are
+    # counted forward from the stamp, its day clipped to the month's
+    # length, so Jan 31 -> Feb 28 is already "1 mo" and Feb 28 -> Apr 29
+    # "2 mo". Nothing is parsed per row.
+    now = int(time.time()) if now is None else int(now)
+    today = date.fromordinal(EPOCH + now // 86400)
+    month_days = monthrange(today.year, today.month)[1]
+    clock = now % 86400
+    labels = []
+    for stamp in stamps:
+        delta = now - stamp
+        if delta <= 0:
+            labels.append("0 sec")
+            continue
+        day = date.fromordinal(EPOCH + stamp // 86400)
+        months = (today.year - day.year) * 12 + today.month - day.month
+        if (min(day.day, month_days), stamp % 86400) > (today.day, clock):
+            months -= 1
+        if months >= 12:
+            labels.append(f"{months // 12} yr")
+        elif months:
+            labels.append(f"{months} mo")
+        else:
+            for seconds, unit in UNITS:
+                if delta >= seconds:
+                    labels.append(f"{delta // seconds} {unit}")
+                    break
+    return labels
@@ -0,0 +1,215 @@
+import contextvars
+import logging
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache, partial
+
+
+log = logging.getLogger(__name__)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_SPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def normalize(sql):
+    # One line per statement shape: literals become ?, lists of
+    # placeholders (ids=1,2,3 lookups) collapse to "?, ...".
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _LIST.sub('?, ...', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class Recorder:
+    # Statements run while one request is handled, possibly from several
+    # threads (app.aio).
+    __slots__ = ('count', 'seconds', 'statements', '_lock')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def add(self, sql, seconds, executed):
+        with self._lock:
+            self.seconds += seconds
+            entry = self.statements.get(sql)
+            if entry is None:
+                entry = self.statements[sql] = [0, 0.0]
+            if executed:
+                self.count += 1
+                entry[0] += 1
+            entry[1] += seconds
+
+    def top(self, n):
+        # [(normalized sql, executions, seconds)], slowest first.
+        totals = {}
+        with self._lock:
+            statements = list(self.statements.items())
+        for sql, (count, seconds) in statements:
+            shape = totals.setdefault(normalize(sql), [0, 0.0])
+            shape[0] += count
+            shape[1] += seconds
+        return sorted(((sql, count, seconds)
+                       for sql, (count, seconds) in totals.items()),
+                      key=lambda item: -item[2])[:n]
+
+
+class QueryTracer:
+    # Times every statement on connections made by factory(), including
+    # the fetches, and adds it to the Recorder of the current request,
+    # if any. A statement that took slow_ms or more by the time its
+    # cursor is done is logged with its EXPLAIN QUERY PLAN.
+    def __init__(self, slow_ms=100):
+        self.slow = slow_ms / 1000
+        self.current = contextvars.ContextVar('sql_recorder', default=None)
+        self._lock = threading.Lock()
+        self._stats = {'slow': 0}
+
+    def factory(self):
+        return partial(TracedConnection, tracer=self)
+
+    def start(self):
+        recorder = Recorder()
+        return recorder, self.current.set(recorder)
+
+    def stop(self, token):
+        self.current.reset(token)
+
+    def slow_query(self, db, sql, params, seconds):
+        with self._lock:
+            self._stats['slow'] += 1
+        try:
+            plan = sqlite3.Cursor(db).execute(
+                f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        except sqlite3.Error as error:
+            plan = [(0, 0, 0, f"no plan: {error}")]
+        log.warning("slow query (%.1f ms): %s\nparameters: %r\n%s",
+                    seconds * 1000, _SPACE.sub(' ', sql).strip(), params,
+                    '\n'.join(f"  {row[3]}" for row in plan))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['slow_ms'] = self.slow * 1000
+        return stats
+
+
+class TracedCursor(sqlite3.Cursor):
+    _sql = ''
+    _params = ()
+    _elapsed = 0.0
+
+    def _record(self, seconds, executed=False):
+        recorder = self.connection.tracer.current.get()
+        if recorder is not None:
+            recorder.add(self._sql, seconds, executed)
+        self._elapsed += seconds
+
+    def _finish(self):
+        # Runs when the rows run out, on the next execute or on close.
+        tracer = self.connection.tracer
+        if self._elapsed >= tracer.slow:
+            tracer.slow_query(self.connection, self._sql, self._params,
+                              self._elapsed)
+        self._elapsed = 0.0
+
+    def _start(self, sql, params):
+        self._finish()
+        self._sql, self._params = sql, params
+
+    def execute(self, sql, params=()):
+        self._start(sql, params)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._record(time.perf_counter() - start, executed=True)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        self._start(sql, seq_of_params[0] if seq_of_params else ())
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self._record(time.perf_counter() - start, executed=True)
+
+    def executescript(self, script):
+        self._start(script, ())
+        start = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            self._record(time.perf_counter() - start, executed=True)
+            self._finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._record(time.perf_counter() - start)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._record(time.perf_counter() - start)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._record(time.perf_counter() - start)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._record(time.perf_counter() - start)
+            self._finish()
+            raise
+        self._record(time.perf_counter() - start)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Cursors read with a single fetchone() are finished here.
+        if self._elapsed:
+            self._finish()
+
+
+class TracedConnection(sqlite3.Connection):
+    # sqlite3.Connection.execute does not go through cursor(), so the
+    # shortcuts are redone here on top of it.
+    def __init__(self, *args, tracer, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracer = tracer
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from queue import Queue, Empty
+
+
+log = logging.getLogger(__name__)
+
+
+class WriteOp:
+    __slots__ = ('key', 'user_id', 'statements', 'finalizers', 'on_commit')
+
+    def __init__(self, key, user_id, statements, finalizers, on_commit):
+        self.key = key
+        self.user_id = user_id
+        self.statements = statements
+        self.finalizers = finalizers
+        self.on_commit = on_commit
+
+
+class WriteBehind:
+    # Collects small user mutations (ratings, favorites, watch-later) and
+    # applies them from a single thread, one transaction per batch.
+    # Statements of a batch are grouped by SQL text and run with
+    # executemany; finalizers (idempotent recomputations such as a film's
+    # average) run once per distinct parameter set at the end.
+    def __init__(self, pool, interval=0.005, max_batch=500):
+        self.pool = pool
+        self.interval = interval
+        self.max_batch = max_batch
+        self.enabled = False
+        self._queue = Queue()
+        self._pending = defaultdict(int)
+        self._settled = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._stats = {'ops': 0, 'batches': 0, 'last_batch': 0,
+                       'max_batch': 0, 'failed_ops': 0, 'commit_time': 0.0}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.enabled = True
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='write-behind')
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        if self._thread is None:
+            return
+        self._running = False
+        self._thread.join(timeout)
+        self._thread = None
+        self.enabled = False
+
+    def submit(self, key, user_id, statements, finalizers=(),
+               on_commit=None):
+        with self._settled:
+            self._pending[user_id] += 1
+        self._queue.put(WriteOp(key, user_id, statements, finalizers,
+                                on_commit))
+
+    def wait_for(self, user_id, timeout=2.0):
+        # Read-your-writes: block until this user's queued writes commit.
+        with self._settled:
+            return self._settled.wait_for(
+                lambda: not self._pending.get(user_id), timeout)
+
+    def flush(self, timeout=10.0):
+        with self._settled:
+            return self._settled.wait_for(
+                lambda: not any(self._pending.values()), timeout)
+
+    def _run(self):
+        while self._running or not self._queue.empty():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except Empty:
+                continue
+            time.sleep(self.interval)
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            self._apply(batch)
+
+    def _segments(self, batch):
+        # Ops on different keys commute, so they may be regrouped by
+        # statement. A repeated key (e.g. favorite then unfavorite of the
+        # same film) starts a new segment to keep their order.
+        segment, keys = [], set()
+        for op in batch:
+            if op.key in keys:
+                yield segment
+                segment, keys = [], set()
+            segment.append(op)
+            keys.add(op.key)
+        if segment:
+            yield segment
+
+    def _execute(self, db, ops):
+        for segment in self._segments(ops):
+            grouped = defaultdict(list)
+            for op in segment:
+                for sql, params in op.statements:
+                    grouped[sql].append(params)
+            for sql, rows in grouped.items():
+                db.executemany(sql, rows)
+        finalizers = defaultdict(set)
+        for op in ops:
+            for sql, params in op.finalizers:
+                finalizers[sql].add(tuple(params))
+        for sql, rows in finalizers.items():
+            db.executemany(sql, list(rows))
+
+    def _commit(self, ops):
+        db = self.pool.acquire()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            self._execute(db, ops)
+            db.commit()
+        except Exception:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        finally:
+            self.pool.release(db)
+
+    def _apply(self, batch):
+        start = time.perf_counter()
+        try:
+            self._commit(batch)
+            committed = batch
+        except Exception:
+            log.exception("write-behind batch of %d failed, retrying "
+                          "one by one", len(batch))
+            committed = []
+            for op in batch:
+                try:
+                    self._commit([op])
+                    committed.append(op)
+                except Exception:
+                    log.exception("write-behind op %r dropped", op.key)
+                    self._stats['failed_ops'] += 1
+        elapsed = time.perf_counter() - start
+        for op in committed:
+            if op.on_commit is not None:
+                try:
+                    op.on_commit()
+                except Exception:
+                    log.exception("write-behind callback failed")
+        self._stats['ops'] += len(batch)
+        self._stats['batches'] += 1
+        self._stats['last_batch'] = len(batch)
+        self._stats['max_batch'] = max(self._stats['max_batch'], len(batch))
+        self._stats['commit_time'] += elapsed
+        with self._settled:
+            for op in batch:
+                self._pending[op.user_id] -= 1
+                if not self._pending[op.user_id]:
+                    del self._pending[op.user_id]
+            self._settled.notify_all()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['enabled'] = self.enabled
+        stats['queue_depth'] = self._queue.qsize()
+        stats['avg_batch'] = (stats['ops'] / stats['batches']
+                              if stats['batches'] else 0.0)
+        return stats
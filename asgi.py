@@ -0,0 +1,12 @@
+"""ASGI entry point (needs asgiref and an ASGI server):
+
+    uvicorn asgi:application --port 5000 --no-access-log
+
+Set MOVIEFLOW_ASYNC_LOOKUPS=1 for /movie/<id> to run its lookups
+concurrently.
+"""
+from app import app
+from app.aio import asgi
+
+
+application = asgi(app, app.config['ASGI_WORKERS'])
@@ -0,0 +1,134 @@
+"""Activity feed reads with fan-out timelines versus pulling at read time.
+
+Builds a temporary database with --users users following each other
+with a skewed popularity (so a few accounts pass the celebrity
+threshold), has users write reviews (half of the authors picked by the
+same popularity), fans them out and then reads the first feed page of
+random users two ways: Feed.timeline and a pull query over the
+activities of everyone the user follows.
+
+    python benchmarks/feed.py --users 100000 --follows 20 --activities 20000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ['MOVIEFLOW_DB'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from app import app, pool  # noqa: E402
+from app.models import Feed  # noqa: E402
+from app.schema import migrate  # noqa: E402
+
+PULL = """SELECT activities.id, activities.kind, activities.created,
+activities.rate, activities.film_id, users.name, films.title, films.img,
+reviews.body FROM activities
+JOIN users ON users.id = activities.user_id
+LEFT JOIN films ON films.id = activities.film_id
+LEFT JOIN reviews ON reviews.id = activities.review_id
+WHERE activities.user_id IN (SELECT following FROM followed
+WHERE is_following = ?)
+ORDER BY activities.id DESC LIMIT 21"""
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def popular(users):
+    # Pareto-distributed user ids: low ids are far more popular, both as
+    # accounts to follow and as authors.
+    return min(users, int(random.paretovariate(0.6)))
+
+
+def setup(users, follows, films=1000):
+    db = pool.acquire()
+    migrate(db)
+    db.executemany("INSERT INTO films (id, title, img) VALUES (?, ?, '')",
+                   [(i, f"Film {i}") for i in range(1, films + 1)])
+    db.executemany("""INSERT INTO users (id, name, email, password)
+                   VALUES (?, ?, ?, '')""",
+                   [(i, f"user{i}", f"user{i}@example.com")
+                    for i in range(1, users + 1)])
+    start = time.perf_counter()
+    for user in range(1, users + 1):
+        targets = {popular(users) for _ in range(follows)}
+        targets.discard(user)
+        db.executemany("""INSERT INTO followed (is_following, following)
+                       VALUES (?, ?)""", [(user, t) for t in targets])
+    db.commit()
+    celebrities = db.execute("SELECT COUNT(*) FROM users WHERE "
+                             "followers_count >= ?",
+                             (app.config['FEED_CELEBRITY_FOLLOWERS'],)
+                             ).fetchone()[0]
+    edges = db.execute("SELECT COUNT(*) FROM followed").fetchone()[0]
+    print(f"{users} users, {edges} follows, {celebrities} celebrities "
+          f"(built in {time.perf_counter() - start:.1f} s)")
+    pool.release(db)
+    return films
+
+
+def write(users, films, activities):
+    db = pool.acquire()
+    fanned = 0
+    start = time.perf_counter()
+    with app.app_context():
+        for i in range(activities):
+            author = popular(users) if i % 2 else random.randint(1, users)
+            db.execute("""INSERT INTO reviews (user_id, film_id, body, date,
+                       posted) VALUES (?, ?, 'review', '', ?)""",
+                       (author, random.randint(1, films), int(time.time())))
+            db.commit()
+            if i % 100 == 99:
+                fanned += Feed().fan_out()
+        fanned += Feed().fan_out()
+    elapsed = time.perf_counter() - start
+    print(f"{activities} activities written and fanned out in "
+          f"{elapsed:.1f} s, {fanned} timeline rows "
+          f"({fanned / elapsed:.0f} rows/s)")
+    pool.release(db)
+
+
+def read(users, samples):
+    readers = random.sample(range(1, users + 1), samples)
+    db = pool.acquire()
+    pulled = []
+    for user in readers:
+        start = time.perf_counter()
+        db.execute(PULL, (user,)).fetchall()
+        pulled.append((time.perf_counter() - start) * 1000)
+    pool.release(db)
+    timelines = []
+    with app.app_context():
+        for user in readers:
+            start = time.perf_counter()
+            Feed().timeline(user)
+            timelines.append((time.perf_counter() - start) * 1000)
+    for label, values in (('pull at read', pulled),
+                          ('fan-out timeline', timelines)):
+        print(f"{label:<18} p50 {percentile(values, 50):7.2f} ms  "
+              f"p95 {percentile(values, 95):7.2f} ms  "
+              f"p99 {percentile(values, 99):7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=20)
+    parser.add_argument('--activities', type=int, default=20000)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    films = setup(args.users, args.follows)
+    write(args.users, films, args.activities)
+    read(args.users, args.samples)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Build a synthetic MovieFlow database of a given size.
+
+Writes to MOVIEFLOW_DB (app.db when unset), which must not exist yet.
+The same --seed always gives the same rows. Popularity is skewed: low
+film, person and user ids get most of the ratings, reviews, casts and
+followers, as on a real site. Every user's password is 'password'.
+
+Triggers and secondary indexes are dropped for the load and created
+again afterwards. The counters, rating histograms and averages that
+the triggers would have kept are then rebuilt with `flask
+repair-ratings` and `flask check-counters --repair`. The search index
+is rebuilt in one pass. The newest --activities reviews become
+activities and are fanned out to timelines as the site would have.
+
+    MOVIEFLOW_DB=app.db python benchmarks/generate.py --films 500000 \\
+        --persons 400000 --casts 4 --users 1000000 --ratings 10000000 \\
+        --reviews 5000000 --follows 40
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from itertools import islice
+from math import ceil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from app import app, pool, hasher  # noqa: E402
+from app.models import Feed, Film, User  # noqa: E402
+from app.schema import migrate  # noqa: E402
+
+GENRES = ('Drama', 'Comedy', 'Action', 'Adventure', 'Thriller', 'Crime',
+          'Romance', 'Horror', 'Sci-Fi', 'Fantasy', 'Animation', 'Family',
+          'Mystery', 'Documentary', 'War', 'History', 'Music', 'Western',
+          'Biography', 'Sport')
+WORDS = ('dark', 'night', 'love', 'city', 'last', 'war', 'star', 'dream',
+         'king', 'girl', 'house', 'river', 'blood', 'shadow', 'summer',
+         'ghost', 'road', 'fire', 'secret', 'island', 'winter', 'storm',
+         'heart', 'stone', 'silent', 'golden', 'lost', 'wild', 'iron',
+         'black', 'red', 'moon', 'sea', 'glass', 'empire', 'garden')
+NAMES = ('Anna', 'Ben', 'Clara', 'David', 'Eva', 'Frank', 'Grace', 'Hugo',
+         'Ines', 'Jack', 'Kate', 'Leo', 'Mia', 'Noah', 'Olga', 'Paul')
+SURNAMES = ('Adams', 'Brown', 'Costa', 'Dubois', 'Evans', 'Fischer',
+            'Garcia', 'Hughes', 'Ivanov', 'Jones', 'Kim', 'Lopez',
+            'Moreau', 'Novak', 'Otto', 'Petrov', 'Quinn', 'Rossi')
+DIRECTORS = 10  # every tenth person directs
+BATCH = 50000
+START = 1577836800  # reviews are spread over the three years from 2020
+
+
+def skewed(rng, n):
+    # 1..n, with low ids far more likely than high ones.
+    return int(n * rng.random() ** 3) + 1
+
+
+def films(rng, count):
+    for id in range(1, count + 1):
+        words = rng.sample(WORDS, rng.randint(1, 3))
+        title = ' '.join(words).title() + (f" {id}" if id % 7 == 0 else '')
+        votes = int(rng.paretovariate(1.2) * 50) if id % 3 else 0
+        rate = rng.uniform(3, 9)
+        genres = rng.sample(GENRES, rng.randint(1, 3))
+        year = 1950 + int(75 * rng.random() ** 0.5)
+        yield (id, f"gen{id}", title, title, year, ', '.join(genres),
+               f"{title}. " * 20, f"films/{id}.jpg",
+               round(rng.random() * 10, 3), rng.randint(0, 2 * 10 ** 9),
+               votes, rate * votes)
+
+
+def persons(rng, count):
+    for id in range(1, count + 1):
+        name = f"{rng.choice(NAMES)} {rng.choice(SURNAMES)} {id}"
+        yield id, f"p{id}", name, f"persons/{id}.jpg", f"{name}." * 10
+
+
+def users(rng, count, password):
+    for id in range(1, count + 1):
+        yield id, f"user{id}", f"user{id}@example.com", password
+
+
+def casts(rng, films, persons, per_film):
+    directors = max(persons // DIRECTORS, 1)
+    for film in range(1, films + 1):
+        yield film, skewed(rng, directors) * DIRECTORS, 1
+        for person in {skewed(rng, persons) for _ in range(per_film - 1)}:
+            yield film, person, 2
+
+
+def films_genres(seed, count):
+    # Replays films() from the same seed so the two agree.
+    names = {name: id for id, name in enumerate(GENRES, 1)}
+    for film in films(random.Random(seed), count):
+        for genre in film[5].split(', '):
+            yield film[0], names[genre]
+
+
+def ratings(rng, users, films, count):
+    per_user = max(count // users, 1)
+    for user in range(1, users + 1):
+        for film in {skewed(rng, films) for _ in range(rng.randint(
+                1, 2 * per_user - 1))}:
+            yield film, user, rng.randint(1, 10)
+
+
+def reviews(rng, users, films, count):
+    span = 3 * 365 * 86400
+    for _ in range(count):
+        posted = START + rng.randrange(span)
+        yield (skewed(rng, users), skewed(rng, films),
+               ' '.join(rng.choices(WORDS, k=rng.randint(10, 60))),
+               posted, posted)
+
+
+def follows(rng, users, per_user):
+    for user in range(1, users + 1):
+        targets = {skewed(rng, users) for _ in range(per_user)}
+        targets.discard(user)
+        for target in sorted(targets):
+            yield user, target
+
+
+def saved_films(rng, users, films, per_user):
+    for user in range(1, users + 1):
+        for film in sorted({skewed(rng, films) for _ in range(per_user)}):
+            yield user, film
+
+
+def defer_schema(db):
+    # Drops every trigger and secondary index, returning their SQL.
+    saved = db.execute("""SELECT type, name, sql FROM sqlite_master
+                       WHERE type IN ('trigger', 'index')
+                       AND sql IS NOT NULL""").fetchall()
+    for type, name, _ in saved:
+        db.execute(f"DROP {type.upper()} IF EXISTS {name}")
+    db.commit()
+    return [sql for _, _, sql in saved]
+
+
+def populate(db, seed=1, films_count=20000, persons_count=30000,
+             casts_per_film=4, users_count=20000, ratings_count=200000,
+             reviews_count=50000, follows_per_user=20, lists_count=2000,
+             saved_per_user=5, activities_count=2000):
+    def step(label, sql, rows):
+        start = time.perf_counter()
+        count = 0
+        for batch in iter(lambda: list(islice(rows, BATCH)), []):
+            db.executemany(sql, batch)
+            count += len(batch)
+        db.commit()
+        print(f"{label:<16} {count:>10} rows in "
+              f"{time.perf_counter() - start:6.1f} s")
+
+    rng = random.Random(seed)
+    password = hasher.hash('password')
+    saved = defer_schema(db)
+    db.execute("PRAGMA synchronous = OFF")
+    db.executemany("INSERT INTO genres (id, genre) VALUES (?, ?)",
+                   list(enumerate(GENRES, 1)))
+    db.executemany("INSERT INTO types (id, type) VALUES (?, ?)",
+                   [(1, 'Director'), (2, 'Actor')])
+    step('films', """INSERT INTO films (id, source_id, title,
+         original_title, year, genres, body, img, value, box_office,
+         imported_votes, imported_sum) VALUES
+         (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+         films(random.Random(seed), films_count))
+    step('films_genres', """INSERT INTO films_genres (film_id, genre_id)
+         VALUES (?, ?)""", films_genres(seed, films_count))
+    step('persons', """INSERT INTO persons (id, source_id, name, img, body)
+         VALUES (?, ?, ?, ?, ?)""", persons(rng, persons_count))
+    step('persons_types', """INSERT INTO persons_types (person_id, type_id)
+         VALUES (?, ?)""", ((id, 1 if id % DIRECTORS == 0 else 2)
+                            for id in range(1, persons_count + 1)))
+    step('films_casts', """INSERT INTO films_casts (film_id, person_id, type)
+         VALUES (?, ?, ?)""", casts(rng, films_count, persons_count,
+                                    casts_per_film))
+    step('users', """INSERT INTO users (id, name, email, password)
+         VALUES (?, ?, ?, ?)""", users(rng, users_count, password))
+    step('films_rates', """INSERT INTO films_rates (film_id, user_id, rate)
+         VALUES (?, ?, ?)""", ratings(rng, users_count, films_count,
+                                      ratings_count))
+    step('reviews', """INSERT INTO reviews (user_id, film_id, body, date,
+         posted) VALUES (?, ?, ?, datetime(?, 'unixepoch'), ?)""",
+         reviews(rng, users_count, films_count, reviews_count))
+    step('followed', """INSERT INTO followed (is_following, following)
+         VALUES (?, ?)""", follows(rng, users_count, follows_per_user))
+    step('watchlists', """INSERT INTO watchlists (id, username, name, body,
+         private) VALUES (?, ?, ?, ?, ?)""",
+         ((id, f"user{skewed(rng, users_count)}", f"list{id}",
+           'A list.', int(id % 5 == 0)) for id in range(1, lists_count + 1)))
+    step('watchlists_films', """INSERT INTO watchlists_films
+         (watchlist_id, film_id) VALUES (?, ?)""",
+         ((list, film) for list in range(1, lists_count + 1)
+          for film in {skewed(rng, films_count) for _ in range(10)}))
+    step('users_watchlater', """INSERT INTO users_watchlater (user_id,
+         film_id) VALUES (?, ?)""", saved_films(rng, users_count,
+                                                films_count, saved_per_user))
+    step('users_favorites', """INSERT INTO users_favorites (user_id,
+         film_id) VALUES (?, ?)""", saved_films(rng, users_count,
+                                                films_count, saved_per_user))
+    start = time.perf_counter()
+    for sql in saved:
+        db.execute(sql)
+    db.execute("INSERT INTO films_fts (films_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO persons_fts (persons_fts) VALUES ('rebuild')")
+    db.commit()
+    print(f"indexes, triggers and search rebuilt in "
+          f"{time.perf_counter() - start:.1f} s")
+    start = time.perf_counter()
+    db.execute("""INSERT INTO activities (user_id, kind, film_id, review_id,
+               created) SELECT * FROM (SELECT user_id, 'review', film_id, id,
+               posted AS created FROM reviews ORDER BY posted DESC
+               LIMIT ?) ORDER BY created""", (activities_count,))
+    db.commit()
+    fanned = 0
+    with app.app_context():
+        for _ in range(ceil(activities_count
+                            / app.config['FEED_FANOUT_BATCH'])):
+            fanned += Feed().fan_out()
+        Film().repair_ratings()
+        User().check_counters(repair=True)
+    db.execute("ANALYZE")
+    db.execute("PRAGMA synchronous = NORMAL")
+    print(f"{fanned} timeline rows, ratings and counters derived in "
+          f"{time.perf_counter() - start:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--films', type=int, default=20000)
+    parser.add_argument('--persons', type=int, default=30000)
+    parser.add_argument('--casts', type=int, default=4,
+                        help='cast rows per film')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--ratings', type=int, default=200000)
+    parser.add_argument('--reviews', type=int, default=50000)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='follows per user')
+    parser.add_argument('--lists', type=int, default=2000)
+    parser.add_argument('--saved', type=int, default=5,
+                        help='watch-later and favorite films per user')
+    parser.add_argument('--activities', type=int, default=2000,
+                        help='newest reviews fanned out to timelines')
+    args = parser.parse_args()
+    path = app.config['DATABASE']
+    if os.path.exists(path):
+        sys.exit(f"{path} already exists")
+    db = pool.acquire()
+    migrate(db)
+    start = time.perf_counter()
+    populate(db, args.seed, args.films, args.persons, args.casts,
+             args.users, args.ratings, args.reviews, args.follows,
+             args.lists, args.saved, args.activities)
+    pool.release(db)
+    print(f"{path}: {os.path.getsize(path) / 1e6:.0f} MB in "
+          f"{time.perf_counter() - start:.0f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Throughput, latency and server footprint of sync and ASGI serving.
+
+Starts the app as a separate process once per mode: 'sync' is the
+threaded Werkzeug server that movie_flow.py runs (one thread per client
+connection), 'asgi' is uvicorn with asgi.py (needs asgiref and uvicorn),
+and 'asgi+lookups' is the same with MOVIEFLOW_ASYNC_LOOKUPS=1. For each
+--clients level it opens that many keep-alive connections, each sending
+one request after another for --seconds, and reports requests/s, latency
+percentiles, errors and the server's peak memory and thread count.
+
+Uses MOVIEFLOW_DB when it is set (a database from generate.py), otherwise
+a small generated one. Clients also --think ms between requests, which
+keeps idle connections open the way browsers do.
+
+    python benchmarks/load.py --clients 10,100,500 --seconds 10 --think 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+if 'MOVIEFLOW_DB' not in os.environ:
+    os.environ['MOVIEFLOW_DB'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from app import app, pool  # noqa: E402
+from app.schema import migrate  # noqa: E402
+from generate import populate, skewed  # noqa: E402
+from routes import SMALL, percentile  # noqa: E402
+
+SERVERS = {
+    'sync': [sys.executable, '-c',
+             "import sys; from app import app; "
+             "app.run(port=int(sys.argv[1]), threaded=True)"],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:application',
+             '--log-level', 'warning', '--no-access-log', '--port'],
+}
+MODES = {'sync': ('sync', {}), 'asgi': ('asgi', {}),
+         'asgi+lookups': ('asgi', {'MOVIEFLOW_ASYNC_LOOKUPS': '1'})}
+
+
+def prepare():
+    db = pool.acquire()
+    migrate(db)
+    if not db.execute("SELECT 1 FROM films LIMIT 1").fetchone():
+        print(f"generating a small database in {app.config['DATABASE']}")
+        populate(db, **SMALL)
+    films, persons = db.execute("""SELECT (SELECT MAX(id) FROM films),
+                                (SELECT MAX(id) FROM persons)""").fetchone()
+    pool.release(db)
+    return films, persons
+
+
+def paths(rng, films, persons):
+    # Film pages dominate, as on the site.
+    pick = rng.random()
+    if pick < 0.6:
+        return f"/movie/{skewed(rng, films)}"
+    if pick < 0.75:
+        return f"/person/{skewed(rng, persons)}"
+    if pick < 0.9:
+        ids = ','.join(str(skewed(rng, films)) for _ in range(20))
+        return f"/api/v1/films?ids={ids}"
+    return rng.choice(('/top', '/popular', '/highest-grossing'))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start(mode, port):
+    server, env = MODES[mode]
+    process = subprocess.Popen(SERVERS[server] + [str(port)], cwd=ROOT,
+                               env={**os.environ, **env},
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                sys.exit(f"{mode} server exited; is uvicorn installed?")
+            time.sleep(0.1)
+    process.kill()
+    sys.exit(f"{mode} server did not start")
+
+
+def footprint(pid):
+    # (anonymous RSS in MB, threads) from /proc, zeros where there is no
+    # /proc. The mmap'ed database file is left out.
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            fields = dict(line.split(':', 1) for line in file)
+    except OSError:
+        return 0.0, 0
+    return (int(fields['RssAnon'].split()[0]) / 1024,
+            int(fields['Threads']))
+
+
+async def fetch(reader, writer, path):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n"
+                 f"Accept-Encoding: gzip\r\n\r\n".encode())
+    status = int((await reader.readline()).split()[1])
+    length, chunked, close = 0, False, False
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding':
+            chunked = 'chunked' in value
+        elif name == 'connection':
+            close = 'close' in value.lower()
+    if not chunked:
+        await reader.readexactly(length)
+        return status, close
+    while size := int((await reader.readline()).split(b';')[0], 16):
+        await reader.readexactly(size + 2)
+    await reader.readline()
+    return status, close
+
+
+async def client(port, seed, deadline, think, sizes, latencies, errors):
+    rng = random.Random(seed)
+    connection = None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+            status, close = await asyncio.wait_for(
+                fetch(*connection, paths(rng, *sizes)), 30)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if status >= 500:
+                errors.append(status)
+            if close:
+                # The Werkzeug server answers each request on a
+                # connection of its own.
+                connection[1].close()
+                connection = None
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ValueError, IndexError):
+            errors.append('connection')
+            connection = None
+            await asyncio.sleep(0.05)
+        if think:
+            await asyncio.sleep(rng.expovariate(1000 / think))
+    if connection is not None:
+        connection[1].close()
+
+
+async def level(port, pid, clients, seconds, think, sizes):
+    latencies, errors, peak = [], [], [0.0, 0]
+    deadline = time.perf_counter() + seconds
+
+    async def sample():
+        while time.perf_counter() < deadline:
+            rss, threads = footprint(pid)
+            peak[0], peak[1] = max(peak[0], rss), max(peak[1], threads)
+            await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    await asyncio.gather(sample(), *(
+        client(port, seed, deadline, think, sizes, latencies, errors)
+        for seed in range(clients)))
+    elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, latencies, errors, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default='sync,asgi',
+                        help=f"comma-separated, of {', '.join(MODES)}")
+    parser.add_argument('--clients', default='10,100,500',
+                        help='comma-separated concurrent connections')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean ms between a client\'s requests')
+    args = parser.parse_args()
+    sizes = prepare()
+    for mode in args.modes.split(','):
+        port = free_port()
+        process = start(mode, port)
+        try:
+            for clients in map(int, args.clients.split(',')):
+                rate, latencies, errors, (rss, threads) = asyncio.run(
+                    level(port, process.pid, clients, args.seconds,
+                          args.think, sizes))
+                if not latencies:
+                    print(f"{mode:<13} {clients:>5} clients  no responses, "
+                          f"{len(errors)} errors")
+                    continue
+                print(f"{mode:<13} {clients:>5} clients {rate:8.0f} req/s  "
+                      f"p50 {percentile(latencies, 50):7.1f}  "
+                      f"p95 {percentile(latencies, 95):7.1f}  "
+                      f"p99 {percentile(latencies, 99):7.1f} ms  "
+                      f"{len(errors):>5} errors  {rss:6.1f} MB  "
+                      f"{threads:>4} threads")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
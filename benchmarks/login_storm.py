@@ -0,0 +1,100 @@
+"""Browse latency while a burst of logins hashes passwords.
+
+Runs /top and /movie/<id> requests from one thread and measures their
+latency three times: with no logins, during a login storm with the
+bounded hasher from config, and during the same storm with the hasher
+widened to one worker per login thread (the old behaviour, where every
+login hashed on its own request thread).
+
+    python benchmarks/login_storm.py --logins 16 --seconds 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ['MOVIEFLOW_DB'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from app import app, pool, hasher  # noqa: E402
+from app.hashing import Hasher  # noqa: E402
+from app.schema import migrate  # noqa: E402
+
+
+def setup():
+    db = pool.acquire()
+    migrate(db)
+    db.executemany("""INSERT INTO films (id, title, year, value, rate, img)
+                   VALUES (?, ?, ?, ?, 7, '')""",
+                   [(i, f"Film {i}", 2000 + i % 20, i % 97)
+                    for i in range(1, 201)])
+    db.execute("INSERT INTO users (name, email, password) VALUES (?, ?, ?)",
+               ('storm', 'storm@example.com', hasher.hash('secret')))
+    db.commit()
+    pool.release(db)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def browse(stop, latencies):
+    client = app.test_client()
+    i = 0
+    while not stop.is_set():
+        url = '/top' if i % 2 else f'/movie/{i % 200 + 1}'
+        start = time.perf_counter()
+        client.get(url)
+        latencies.append((time.perf_counter() - start) * 1000)
+        i += 1
+
+
+def login(stop, counts):
+    client = app.test_client()
+    while not stop.is_set():
+        response = client.post('/login', data={'username': 'storm',
+                                               'password': 'secret'})
+        counts[response.status_code] = counts.get(response.status_code,
+                                                  0) + 1
+
+
+def run(label, logins, seconds):
+    stop = threading.Event()
+    latencies, counts = [], {}
+    threads = [threading.Thread(target=browse, args=(stop, latencies))]
+    threads += [threading.Thread(target=login, args=(stop, counts))
+                for _ in range(logins)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    print(f"{label:<28} browse p50 {percentile(latencies, 50):7.1f} ms  "
+          f"p95 {percentile(latencies, 95):7.1f} ms  "
+          f"n={len(latencies):<5} logins {counts}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    app.config['WTF_CSRF_ENABLED'] = False
+    setup()
+
+    import app.models as models
+    run('no logins', 0, args.seconds)
+    run('storm, bounded hasher', args.logins, args.seconds)
+    models.hasher = Hasher(workers=args.logins, queue=args.logins,
+                           iterations=hasher.iterations,
+                           legacy_salt=hasher.legacy_salt)
+    run('storm, one hash per thread', args.logins, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
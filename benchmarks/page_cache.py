@@ -0,0 +1,94 @@
+"""CPU per anonymous request with and without the page cache.
+
+Builds a temporary catalog, then requests /top, /popular,
+/highest-grossing, /person/<id> and /movie/<id> as an anonymous visitor
+twice: once clearing the page and fragment caches before every request
+(every hit renders) and once with them warm. Also times a signed-in
+/movie/<id>, which only gets the fragment cache.
+
+    python benchmarks/page_cache.py --films 200 --requests 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ['MOVIEFLOW_DB'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from app import app, pool, hasher, pages, fragments  # noqa: E402
+from app.schema import migrate  # noqa: E402
+
+
+def setup(films):
+    db = pool.acquire()
+    migrate(db)
+    db.executemany("""INSERT INTO films (id, title, year, value, rate, img,
+                   box_office, body, genres)
+                   VALUES (?, ?, ?, ?, 7, '', ?, 'A film.', 'Drama')""",
+                   [(i, f"Film {i}", 2010 + i % 12, i % 97, i * 1000)
+                    for i in range(1, films + 1)])
+    db.executemany("INSERT INTO persons (id, name, img) VALUES (?, ?, '')",
+                   [(i, f"Person {i}") for i in range(1, films + 1)])
+    db.executemany("INSERT INTO types (id, type) VALUES (?, ?)",
+                   [(1, 'Director'), (2, 'Actor')])
+    db.executemany("""INSERT INTO persons_types (person_id, type_id)
+                   VALUES (?, ?)""",
+                   [(i, 1 + i % 2) for i in range(1, films + 1)])
+    db.executemany("""INSERT INTO films_casts (film_id, person_id, type)
+                   VALUES (?, ?, ?)""",
+                   [(f, (f + k) % films + 1, 1 + (k > 0))
+                    for f in range(1, films + 1) for k in range(6)])
+    db.execute("INSERT INTO users (name, email, password) VALUES (?, ?, ?)",
+               ('bench', 'bench@example.com', hasher.hash('secret')))
+    db.commit()
+    pool.release(db)
+
+
+def urls(films, count):
+    fixed = ['/top', '/popular', '/highest-grossing']
+    return [fixed[i % 3] if i % 4 == 0 else
+            f"/person/{i % films + 1}" if i % 4 == 1 else
+            f"/movie/{i % films + 1}" for i in range(count)]
+
+
+def run(label, client, paths, cold):
+    cpu = time.process_time()
+    for path in paths:
+        if cold:
+            pages.clear()
+            fragments.clear()
+        client.get(path)
+    cpu = time.process_time() - cpu
+    print(f"{label:<32} {cpu / len(paths) * 1e6:9.0f} us CPU/request")
+    return cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--films', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+    app.config['WTF_CSRF_ENABLED'] = False
+    setup(args.films)
+    paths = urls(args.films, args.requests)
+
+    anonymous = app.test_client()
+    run('anonymous, warm-up', anonymous, paths, cold=False)
+    cold = run('anonymous, no cache', anonymous, paths, cold=True)
+    warm = run('anonymous, page cache', anonymous, paths, cold=False)
+    print(f"anonymous CPU reduced {cold / warm:.1f}x")
+
+    signed_in = app.test_client()
+    signed_in.post('/login', data={'username': 'bench',
+                                   'password': 'secret'})
+    movies = [path for path in paths if path.startswith('/movie/')]
+    cold = run('signed in, no cache', signed_in, movies, cold=True)
+    warm = run('signed in, fragment cache', signed_in, movies, cold=False)
+    print(f"signed-in /movie CPU reduced {cold / warm:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Latency and query count of every page, against a stored baseline.
+
+Requests each route --requests times through the Flask test client with
+ids drawn the way generate.py skews popularity, after one warm-up pass,
+and prints p50/p95/p99 in ms plus SQL statements per request (statements
+run by triggers are not counted). Anonymous pages, the JSON API and the
+signed-in pages (as user<--user>, password 'password') are all covered;
+a route answering with a redirect or an error stops the run.
+
+Runs against MOVIEFLOW_DB when it is set, so a large database from
+generate.py can be reused; otherwise a small one is generated in a
+temporary directory first. --no-cache clears the page, fragment and
+result caches before every request to measure rendering alone.
+
+    python benchmarks/routes.py --baseline baseline.json --save
+    python benchmarks/routes.py --baseline baseline.json --tolerance 0.2
+
+The second form exits with status 1 if a route's p95 grew by more than
+--tolerance (and --slack ms) or it now runs more queries per request.
+Baselines are only comparable on the same machine and database.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+if 'MOVIEFLOW_DB' not in os.environ:
+    os.environ['MOVIEFLOW_DB'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from app import (app, pool, pages, fragments, film_details,  # noqa: E402
+                 leaderboards)
+from app.models import DataBase  # noqa: E402
+from app.schema import migrate  # noqa: E402
+from generate import GENRES, WORDS, populate, skewed  # noqa: E402
+
+SMALL = {'films_count': 5000, 'persons_count': 8000, 'users_count': 5000,
+         'ratings_count': 50000, 'reviews_count': 20000, 'lists_count': 500,
+         'activities_count': 500}
+
+
+class QueryCounter:
+    # Counts statements on every pooled connection. All of them are
+    # opened up front so none escapes the trace callback.
+    def __init__(self):
+        self.count = 0
+        connections = [pool.acquire() for _ in range(pool.size)]
+        for db in connections:
+            db.set_trace_callback(self.trace)
+        for db in connections:
+            pool.release(db)
+
+    def trace(self, statement):
+        if not statement.startswith('--'):
+            self.count += 1
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def prepare():
+    db = pool.acquire()
+    migrate(db)
+    if not db.execute("SELECT 1 FROM films LIMIT 1").fetchone():
+        print(f"generating a small database in {app.config['DATABASE']}")
+        populate(db, **SMALL)
+    sizes = {table: db.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0]
+             for table in ('films', 'persons', 'users')}
+    # The most reviewed film, and a cursor a few pages into its reviews.
+    film = db.execute("""SELECT id FROM films ORDER BY reviews_count DESC
+                      LIMIT 1""").fetchone()[0]
+    deep = db.execute("""SELECT id AS review_id, posted FROM reviews
+                      WHERE film_id = ? ORDER BY posted DESC, id DESC
+                      LIMIT 1 OFFSET ?""",
+                      (film, 5 * app.config['REVIEWS_PER_PAGE'] - 1)
+                      ).fetchone()
+    lists = db.execute("""SELECT username, name FROM watchlists
+                       WHERE private = 0 LIMIT 1000""").fetchall()
+    pool.release(db)
+    return sizes, film, deep, [tuple(row) for row in lists]
+
+
+def scenarios(sizes, film, deep, lists):
+    # {route: function(rng) -> path}, signed-in routes prefixed with '@'.
+    def user(rng):
+        return f"user{skewed(rng, sizes['users'])}"
+
+    def ids(rng, table, count=20):
+        return ','.join(str(skewed(rng, sizes[table])) for _ in range(count))
+
+    routes = {
+        '/': lambda rng: '/',
+        '/top': lambda rng: '/top',
+        '/popular': lambda rng: '/popular',
+        '/highest-grossing': lambda rng: '/highest-grossing',
+        '/movie/<id>': lambda rng: f"/movie/{skewed(rng, sizes['films'])}",
+        '/person/<id>':
+            lambda rng: f"/person/{skewed(rng, sizes['persons'])}",
+        '/search?type=film':
+            lambda rng: f"/search?type=film&query={rng.choice(WORDS)[:4]}",
+        '/search?type=person':
+            lambda rng: f"/search?type=person&query={rng.choice('ABCDE')}"
+                        f"{rng.choice('aeiou')}",
+        '/search?type=user': lambda rng: f"/search?type=user&query=user"
+                                         f"{rng.randint(1, 99)}",
+        '/genres': lambda rng: '/genres?' + '&'.join(
+            f"gen={genre}" for genre in rng.sample(GENRES, 2))
+            + f"&page={rng.randint(1, 5)}",
+        '/api/v1/films?ids': lambda rng: f"/api/v1/films?ids="
+                                         f"{ids(rng, 'films')}",
+        '/api/v1/films?sort=value': lambda rng: '/api/v1/films?sort=value'
+                                                '&limit=500',
+        '/api/v1/persons?ids': lambda rng: f"/api/v1/persons?ids="
+                                           f"{ids(rng, 'persons')}",
+        '/api/v1/search/films':
+            lambda rng: f"/api/v1/search/films?q={rng.choice(WORDS)}",
+        '@/': lambda rng: '/',
+        '@/movie/<id>': lambda rng: f"/movie/{skewed(rng, sizes['films'])}",
+        '@/watchlater': lambda rng: '/watchlater',
+        '@/favorites': lambda rng: '/favorites',
+        '@/<user>/profile': lambda rng: f"/{user(rng)}/profile",
+        '@/<user>/flows': lambda rng: f"/{user(rng)}/flows",
+    }
+    if deep is not None:
+        cursor = DataBase().encode_cursor('next', deep)
+        routes['/movie/<id>?cursor'] = (
+            lambda rng: f"/movie/{film}?cursor={cursor}")
+    if lists:
+        routes['@/<user>/flow/<list>'] = (
+            lambda rng: '/{}/flow/{}'.format(*rng.choice(lists)))
+        routes['/api/v1/lists/<user>/<list>'] = (
+            lambda rng: '/api/v1/lists/{}/{}'.format(*rng.choice(lists)))
+    return routes
+
+
+def clear():
+    pages.clear()
+    fragments.clear()
+    film_details.clear()
+    leaderboards.bump()
+
+
+def measure(client, counter, path, cold):
+    if cold:
+        clear()
+    counter.count = 0
+    start = time.perf_counter()
+    response = client.get(path)
+    response.get_data()
+    elapsed = (time.perf_counter() - start) * 1000
+    # A redirect (to /login, or away from a missing page) would time
+    # something other than the page.
+    if response.status_code >= 300:
+        sys.exit(f"{path}: {response.status}")
+    return elapsed, counter.count
+
+
+def run(routes, requests, seed, username, cold):
+    app.config['WTF_CSRF_ENABLED'] = False
+    counter = QueryCounter()
+    anonymous = app.test_client()
+    signed_in = app.test_client()
+    response = signed_in.post('/login', data={'username': username,
+                                              'password': 'password'})
+    if response.status_code != 302:
+        sys.exit(f"cannot sign in as {username}")
+    results = {}
+    for route, path in routes.items():
+        client = signed_in if route.startswith('@') else anonymous
+        rng = random.Random(seed)
+        for _ in range(min(requests, 20)):
+            measure(client, counter, path(rng), cold)
+        rng = random.Random(seed)
+        times, queries = [], 0
+        for _ in range(requests):
+            elapsed, count = measure(client, counter, path(rng), cold)
+            times.append(elapsed)
+            queries += count
+        results[route] = {'p50': percentile(times, 50),
+                          'p95': percentile(times, 95),
+                          'p99': percentile(times, 99),
+                          'queries': queries / requests}
+        report(route, results[route])
+    return results
+
+
+def report(route, result, note=''):
+    print(f"{route:<32} p50 {result['p50']:7.2f}  p95 {result['p95']:7.2f}  "
+          f"p99 {result['p99']:7.2f} ms  {result['queries']:5.1f} q/req"
+          f"{note}")
+
+
+def compare(results, baseline, tolerance, slack):
+    regressions = []
+    for route, result in results.items():
+        base = baseline.get(route)
+        if base is None:
+            continue
+        if result['p95'] > base['p95'] * (1 + tolerance) + slack:
+            regressions.append(f"{route}: p95 {base['p95']:.2f} -> "
+                               f"{result['p95']:.2f} ms")
+        if result['queries'] > base['queries'] + 0.05:
+            regressions.append(f"{route}: {base['queries']:.1f} -> "
+                               f"{result['queries']:.1f} queries/request")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per route')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--user', type=int, default=100,
+                        help='signed-in requests are made as user<N>')
+    parser.add_argument('--only', help='substring of the routes to run')
+    parser.add_argument('--no-cache', dest='cold', action='store_true')
+    parser.add_argument('--baseline', help='JSON file to compare with')
+    parser.add_argument('--save', action='store_true',
+                        help='write the results to --baseline instead')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative p95 growth')
+    parser.add_argument('--slack', type=float, default=1.0,
+                        help='allowed absolute p95 growth in ms')
+    args = parser.parse_args()
+    if args.save and not args.baseline:
+        parser.error('--save needs --baseline')
+    routes = scenarios(*prepare())
+    if args.only:
+        routes = {route: path for route, path in routes.items()
+                  if args.only in route}
+    print(f"{args.requests} requests per route, "
+          f"caches {'cleared' if args.cold else 'on'}; "
+          f"'@' routes are signed in as user{args.user}")
+    results = run(routes, args.requests, args.seed, f"user{args.user}",
+                  args.cold)
+    if not args.baseline:
+        return
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+        print(f"baseline written to {args.baseline}")
+        return
+    with open(args.baseline) as file:
+        regressions = compare(results, json.load(file), args.tolerance,
+                              args.slack)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"no regressions against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Cost of the "time since posting" labels for a page of reviews.
+
+Compares the per-row strptime + relativedelta labels reviews used to be
+rendered with against app.timesince.time_since over epoch seconds, and
+reports how many labels differ between the two.
+
+    python benchmarks/time_since.py --rows 12 --pages 20000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+from dateutil import relativedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from app.timesince import time_since  # noqa: E402
+
+
+def get_time_after_posting(date_time, current_time):
+    # The per-row implementation DataBase used before reviews had epochs.
+    delta_values = ('years', 'months', 'days',
+                    'hours', 'minutes', 'seconds')
+    mask = {'years': 'yr', 'months': 'mo', 'days': 'd',
+            'hours': 'hr', 'minutes': 'min', 'seconds': 'sec'}
+    posting_time = datetime.strptime(date_time, "%Y-%m-%d %H:%M:%S")
+    difference = relativedelta.relativedelta(current_time, posting_time)
+    for delta_value in delta_values:
+        res = getattr(difference, delta_value)
+        if res:
+            return f"{res} {mask[delta_value]}"
+    return "0 sec"
+
+
+def utc(stamp):
+    return datetime.fromtimestamp(stamp, timezone.utc).replace(tzinfo=None)
+
+
+def sample(count, now):
+    # Mostly recent reviews with a long tail, like a busy film page.
+    ages = [int(random.expovariate(1 / (86400 * 90))) + 1
+            for _ in range(count)]
+    stamps = [now - age for age in ages]
+    strings = [utc(stamp).strftime("%Y-%m-%d %H:%M:%S")
+               for stamp in stamps]
+    return stamps, strings
+
+
+def timed(label, pages, func):
+    start = time.perf_counter()
+    for page in pages:
+        func(page)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed / len(pages) * 1e6:8.2f} us/page")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=12)
+    parser.add_argument('--pages', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    now = int(time.time())
+    current = utc(now)
+    pages = [sample(args.rows, now) for _ in range(args.pages)]
+
+    old = timed('strptime + relativedelta', [p[1] for p in pages],
+                lambda page: [get_time_after_posting(date, current)
+                              for date in page])
+    new = timed('time_since', [p[0] for p in pages],
+                lambda page: time_since(page, now))
+    print(f"speedup {old / new:.1f}x")
+
+    total = mismatched = 0
+    for stamps, strings in pages:
+        expected = [get_time_after_posting(date, current) for date in strings]
+        for got, want in zip(time_since(stamps, now), expected):
+            total += 1
+            mismatched += got != want
+    print(f"labels differing {mismatched} of {total}")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,4 +7,64 @@ class Config(object):
     ITEMS_PER_PAGE = 20
     REVIEWS_PER_PAGE = 12
     USERS_SEARCH_LIMIT = 20
+    DATABASE = os.environ.get('MOVIEFLOW_DB') or 'app.db'
+    DB_POOL_SIZE = 8
+    DB_POOL_TIMEOUT = 5.0
+    STATS_ENDPOINT = os.environ.get('MOVIEFLOW_STATS') == '1'
+    DB_PRAGMAS = {'synchronous': 'NORMAL',
+                  'busy_timeout': 5000,
+                  'mmap_size': 268435456,
+                  'cache_size': -16000,
+                  'temp_store': 'MEMORY'}
+    LEADERBOARD_TTL = 300
+    FILM_CACHE_SIZE = 2048
+    FILM_CACHE_TTL = 600
+    WRITE_BEHIND = os.environ.get('MOVIEFLOW_WRITE_BEHIND') == '1'
+    WRITE_BEHIND_INTERVAL = 0.005
+    WRITE_BEHIND_MAX_BATCH = 500
+    USER_ID_CACHE_SIZE = 10000
+    SOCIAL_GRAPH_TTL = 900
+    SUGGESTIONS_LIMIT = 5
+    FEED_PER_PAGE = 20
+    FEED_TIMELINE_SIZE = 500
+    FEED_CELEBRITY_FOLLOWERS = 5000
+    FEED_FANOUT_BATCH = 1000
+    SIMILAR_NEIGHBOURS = 20
+    SIMILAR_CHUNK = 256
+    SIMILAR_SHRINK = 10.0
+    SIMILAR_FILMS_LIMIT = 8
+    RECOMMENDATIONS_LIMIT = 12
+    RECOMMENDATION_SEEDS = 200
+    PAGE_CACHE_BYTES = 64 * 1024 * 1024
+    PAGE_CACHE_TTL = 30
+    PAGE_CACHE_STALE = 300
+    FRAGMENT_CACHE_BYTES = 16 * 1024 * 1024
+    FRAGMENT_CACHE_TTL = 600
+    ETAG_WINDOW = 600
+    ASSET_WIDTHS = (480, 960, 1440, 1920)
+    ASSET_FORMATS = ('avif', 'webp')
+    ASSET_QUALITY = 70
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+    COMPRESS_MIMETYPES = ('text/html', 'text/css', 'text/plain',
+                          'text/javascript', 'application/javascript',
+                          'application/json', 'image/svg+xml')
+    IMPORT_BATCH = 5000
+    IMPORT_CACHE_KIB = 262144
+    API_BATCH_LIMIT = 100
+    API_PAGE_SIZE = 100
+    API_MAX_PAGE_SIZE = 1000
+    SQL_SLOW_MS = 100
+    SQL_TOP = 5
+    SQL_DEBUG_HEADER = os.environ.get('MOVIEFLOW_SQL_HEADER') == '1'
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0)
+    ASYNC_LOOKUPS = os.environ.get('MOVIEFLOW_ASYNC_LOOKUPS') == '1'
+    ASYNC_DB_THREADS = 8
+    ASGI_WORKERS = 8
+    PASSWORD_ITERATIONS = 150000
+    HASH_WORKERS = 2
+    HASH_QUEUE = 8
+    HASH_TIMEOUT = 5.0
     # SECRET_KEY
\ No newline at end of file
@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+os.environ['MOVIEFLOW_DB'] = os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ.pop('MOVIEFLOW_WRITE_BEHIND', None)
+
+from flask import g  # noqa: E402
+from app import app, pool  # noqa: E402
+from app.schema import migrate  # noqa: E402
+from generate import populate  # noqa: E402
+
+# Enough rows for every query to find something, with the same skew as
+# the benchmark databases: low ids are the popular ones.
+SIZES = {'films_count': 400, 'persons_count': 600, 'users_count': 300,
+         'ratings_count': 6000, 'reviews_count': 1500,
+         'follows_per_user': 10, 'lists_count': 60, 'activities_count': 300}
+
+
+@pytest.fixture(scope='session')
+def database():
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    db = pool.acquire()
+    migrate(db)
+    populate(db, **SIZES)
+    pool.release(db)
+
+
+@pytest.fixture
+def client(database):
+    return app.test_client()
+
+
+@pytest.fixture
+def context(database):
+    # A request context with nobody signed in, as the views see it.
+    with app.test_request_context():
+        g.user_id = g.username = None
+        yield
+
+
+@pytest.fixture
+def traced(database, monkeypatch):
+    # Every statement run on a pooled connection, in order, with its
+    # parameters bound, while the test runs.
+    statements = []
+    acquire = pool.acquire
+
+    def traced_acquire():
+        db = acquire()
+        db.set_trace_callback(statements.append)
+        return db
+    monkeypatch.setattr(pool, 'acquire', traced_acquire)
+    yield statements
+    for db in list(pool._idle.queue):
+        db.set_trace_callback(None)
+
+
+@pytest.fixture
+def member(client):
+    # A client signed in as user1, the most followed user.
+    with client.session_transaction() as session:
+        session['__auth'] = 'user1'
+        session['__uid'] = 1
+    return client
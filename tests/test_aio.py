@@ -0,0 +1,81 @@
+import asyncio
+import threading
+from app.aio import asgi
+
+
+def call(application, path, method='GET', headers=(), body=b''):
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': b'a=1', 'http_version': '1.1',
+             'headers': list(headers), 'server': ('example.org', 8000),
+             'client': ('10.0.0.1', 5000)}
+    messages = [{'type': 'http.request', 'body': body[:3],
+                 'more_body': True},
+                {'type': 'http.request', 'body': body[3:]}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+    asyncio.run(application(scope, receive, send))
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    assert sent[-1] == {'type': 'http.response.body'}
+    return sent[0], body
+
+
+def test_requests_run_on_own_threads_and_close_output():
+    seen = []
+
+    class Output(list):
+        def close(self):
+            seen.append('closed')
+
+    def wsgi(environ, start_response):
+        seen.append(threading.current_thread().name)
+        start_response('201 Created', [('X-Test', 'yes')])
+        return Output([b'hel', b'', b'lo'])
+    start, body = call(asgi(wsgi, 2), '/')
+    assert start['status'] == 201 and (b'x-test', b'yes') in start['headers']
+    assert body == b'hello'
+    assert seen[0].startswith('asgi') and seen[1] == 'closed'
+
+
+def test_environ_from_scope():
+    seen = {}
+
+    def wsgi(environ, start_response):
+        seen.update(environ, body=environ['wsgi.input'].read())
+        start_response('200 OK', [])
+        return []
+    call(asgi(wsgi, 1), '/movie/1', 'POST',
+         [(b'content-type', b'text/plain'), (b'cookie', b'a=1'),
+          (b'cookie', b'b=2'), (b'accept', b'text/html'),
+          (b'accept', b'*/*')], b'review body')
+    assert seen['body'] == b'review body'
+    assert (seen['REQUEST_METHOD'], seen['PATH_INFO'],
+            seen['QUERY_STRING']) == ('POST', '/movie/1', 'a=1')
+    assert seen['CONTENT_TYPE'] == 'text/plain'
+    assert seen['HTTP_COOKIE'] == 'a=1; b=2'
+    assert seen['HTTP_ACCEPT'] == 'text/html,*/*'
+    assert (seen['SERVER_NAME'], seen['SERVER_PORT'],
+            seen['REMOTE_ADDR']) == ('example.org', '8000', '10.0.0.1')
+
+
+def test_lifespan_is_acknowledged():
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+    asyncio.run(asgi(None, 1)({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+def test_serves_the_app(database):
+    from app import app
+    start, body = call(asgi(app, 2), '/top')
+    assert start['status'] == 200 and b'</html>' in body
@@ -0,0 +1,25 @@
+import json
+from app import pool
+
+
+def test_pages_follow_cursor(client):
+    first = client.get('/api/v1/films?limit=5').get_json()
+    second = client.get('/api/v1/films?limit=5&cursor='
+                        + first['next']).get_json()
+    assert [film['id'] for film in first['data']] == [1, 2, 3, 4, 5]
+    assert [film['id'] for film in second['data']] == [6, 7, 8, 9, 10]
+
+
+def test_empty_page_is_valid_json(client):
+    page = client.get('/api/v1/search/films?q=zzzzqqq').get_json()
+    assert page == {'data': [], 'next': None}
+
+
+def test_page_read_before_connection_is_released(client):
+    # The body is produced after the request has handed its connection
+    # back, by which time another request may be writing on it.
+    response = client.get('/api/v1/films?limit=300', buffered=False)
+    assert pool.stats()['in_use'] == 0
+    pool.close()
+    ids = [film['id'] for film in json.loads(response.get_data())['data']]
+    assert ids == list(range(1, 301))
@@ -0,0 +1,96 @@
+import sqlite3
+import pytest
+from app import pages
+from app.cache import LRUCache, PageCache
+from app.models import Film
+
+
+
+def test_page_store_survives_invalidating_other_tags():
+    cache = PageCache(ttl=60, stale=300)
+    _, token = cache.lookup('/movie/1')
+    cache.invalidate('film:2')
+    cache.invalidate('leaderboards')
+    cache.store('/movie/1', 'page', 4, ['film:1'], token)
+    assert cache.lookup('/movie/1') == ('page', None)
+
+
+def test_page_store_rejected_after_own_tag_invalidated():
+    cache = PageCache(ttl=60, stale=300)
+    _, token = cache.lookup('/movie/1')
+    cache.invalidate('film:1')
+    cache.store('/movie/1', 'page', 4, ['film:1'], token)
+    assert cache.lookup('/movie/1')[0] is None
+
+
+def test_page_stamps_fold_into_floor():
+    cache = PageCache(ttl=60, stale=300)
+    cache._stamps.limit = 3
+    _, token = cache.lookup('/movie/1')
+    for id in range(2, 6):
+        cache.invalidate(f"film:{id}")
+    cache.store('/movie/1', 'page', 4, ['film:1'], token)
+    assert cache.lookup('/movie/1')[0] is None
+    assert len(cache._stamps._stamps) <= 3
+
+
+def stale_entry(cache):
+    _, token = cache.lookup('/top')
+    cache.store('/top', 'old', 3, ['leaderboards'], token)
+    cache._entries['/top']['fresh_until'] = 0
+    value, token = cache.lookup('/top')
+    assert value is None and token is not None
+    # Everyone else gets the stale copy while the refresh runs.
+    assert cache.lookup('/top') == ('old', None)
+    return token
+
+
+def test_abandoned_refresh_is_retried():
+    cache = PageCache(ttl=60, stale=300)
+    stale_entry(cache)
+    cache.abandon('/top')
+    value, token = cache.lookup('/top')
+    assert value is None and token is not None
+
+
+def test_rejected_refresh_is_retried():
+    cache = PageCache(max_bytes=50, ttl=60, stale=300)
+    token = stale_entry(cache)
+    cache.store('/top', 'x' * 100, 100, ['leaderboards'], token)
+    value, token = cache.lookup('/top')
+    assert value is None and token is not None
+
+
+def test_failed_page_refresh_is_retried(client, monkeypatch):
+    client.get('/top')
+    for entry in pages._entries.values():
+        entry['fresh_until'] = 0
+
+    def broken(self):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(Film, 'get_top_movies', broken)
+    with pytest.raises(sqlite3.OperationalError):
+        client.get('/top')
+    monkeypatch.undo()
+    assert client.get('/top').headers['X-Cache'] == 'MISS'
+    assert client.get('/top').headers['X-Cache'] == 'HIT'
+
+
+def test_lru_load_survives_invalidating_other_keys():
+    cache = LRUCache()
+
+    def load():
+        cache.invalidate('2')
+        return 'film 1'
+    assert cache.get('1', load) == 'film 1'
+    assert cache.get('1', lambda: 'reloaded') == 'film 1'
+
+
+def test_lru_load_dropped_after_own_key_invalidated():
+    cache = LRUCache()
+
+    def load():
+        cache.invalidate('1')
+        return 'film 1'
+    cache.get('1', load)
+    assert cache.get('1', lambda: 'reloaded') == 'reloaded'
@@ -0,0 +1,40 @@
+import re
+import pytest
+from flask import g
+from flask_wtf.csrf import generate_csrf
+from app import app
+from app.pagecache import cached_page
+
+TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+@pytest.fixture
+def csrf(database, monkeypatch):
+    monkeypatch.setitem(app.config, 'WTF_CSRF_ENABLED', True)
+
+
+@pytest.mark.parametrize('path', ['/movie/1', '/person/1', '/top', '/login'])
+def test_anonymous_visitors_never_share_a_token(csrf, path):
+    tokens = []
+    for _ in range(2):
+        page = app.test_client().get(path)
+        assert page.status_code == 200
+        tokens += TOKEN.findall(page.get_data(as_text=True))
+    assert len(tokens) == len(set(tokens))
+
+
+def test_pages_with_a_token_are_not_cached(csrf):
+    view = cached_page('film:1')(lambda: generate_csrf())
+    bodies = []
+    for _ in range(2):
+        with app.test_request_context('/csrf-page'):
+            g.user_id = g.username = None
+            response = view()
+            assert response.headers['X-Cache'] == 'MISS'
+            bodies.append(response.get_data())
+    assert bodies[0] != bodies[1]
+
+
+def test_review_form_only_for_members(client, member):
+    assert b'name="review"' in member.get('/movie/1').data
+    assert b'name="review"' not in app.test_client().get('/movie/1').data
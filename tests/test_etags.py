@@ -0,0 +1,24 @@
+import pytest
+from app import writer
+
+
+@pytest.fixture
+def write_behind(database, monkeypatch):
+    # Queued writes that stay queued long enough for the next request to
+    # arrive first.
+    monkeypatch.setattr(writer, 'interval', 0.5)
+    writer.start()
+    yield writer
+    writer.stop()
+
+
+def test_own_queued_rating_changes_etag(member, write_behind):
+    film = 7
+    member.get(f"/delete_rate/{film}")
+    write_behind.flush()
+    etag = member.get(f"/movie/{film}").headers['ETag']
+
+    member.get(f"/rate/{film}/8")
+    page = member.get(f"/movie/{film}", headers={'If-None-Match': etag})
+    assert page.status_code == 200
+    assert page.headers['ETag'] != etag
@@ -0,0 +1,25 @@
+from app.models import DataBase, Feed, Film, User
+
+
+def timeline_rows(db, user_id, film_id):
+    return db.execute("""SELECT COUNT(*) FROM timelines
+    JOIN followed ON followed.is_following = timelines.user_id
+    WHERE followed.following = ? AND timelines.activity_id IN
+    (SELECT id FROM activities WHERE user_id = ? AND film_id = ?)""",
+                      (user_id, user_id, film_id)).fetchone()[0]
+
+
+def test_deleted_rating_leaves_no_timeline_rows(context):
+    db = DataBase().db
+    author, film = 2, 5
+    Film().delete_rate(film, author)
+    Film().rate(film, author, '9')
+    Feed().fan_out()
+    assert timeline_rows(db, author, film) > 0
+
+    Film().delete_rate(film, author)
+    assert timeline_rows(db, author, film) == 0
+    assert db.execute("""SELECT COUNT(*) FROM timelines WHERE NOT EXISTS
+    (SELECT 1 FROM activities WHERE activities.id = timelines.activity_id)
+    """).fetchone()[0] == 0
+    assert User().check_counters()['users.timeline_size'] == 0
@@ -0,0 +1,16 @@
+import re
+from html import unescape
+from urllib.parse import parse_qs, urlsplit
+from flask import render_template
+
+
+def test_facet_and_page_links_keep_genre_names(context):
+    page = render_template(
+        'genres.html', films=[], page=2, pageCount=3, filmsCount=50,
+        genres=('drama', 'r&b #1+'), facets=[('Sci-Fi & Fantasy', 3)])
+    links = [parse_qs(urlsplit(unescape(href)).query)
+             for href in re.findall(r'href="([^"]*)"', page)
+             if 'gen=' in href]
+    assert {'gen': ['drama', 'r&b #1+', 'sci-fi & fantasy']} in links
+    assert {'gen': ['drama', 'r&b #1+'], 'page': ['1']} in links
+    assert {'gen': ['drama', 'r&b #1+'], 'page': ['3']} in links
@@ -0,0 +1,272 @@
+import pytest
+from flask import g
+from app import (app, pool, genre_index, social_graph, leaderboards,
+                 film_details)
+from app.etags import Versions
+from app.importer import CatalogLoader
+from app.models import (DataBase, Film, Person, User, Watchlist, Watchlater,
+                        Favorites, Feed, Search)
+from app.similarity import refresh
+
+# Every query path of the models is run below with the SQL traced, and
+# each statement it issued goes through EXPLAIN QUERY PLAN. A statement
+# that scans a table or sorts into a temporary b-tree fails the test
+# unless a piece of its SQL is listed here with the reason. repair_ratings
+# and check_counters go over whole tables on purpose and are left out.
+
+KNOWN_SLOW = {
+    'SELECT id, genre FROM genres': 'genres is a handful of rows',
+    'SELECT id, type FROM types': 'types is a handful of rows',
+    'FROM films_similar WHERE rank =':
+        'offline job reads every full list once',
+    'SELECT user_id, film_id, rate FROM films_rates':
+        'offline job reads every rating once',
+    "_fts_config'": 'FTS5 reads its settings once per connection',
+}
+
+# Statements that sort only the rows an index lookup already narrowed
+# down, such as full-text matches ordered by relevance.
+SORTED_MATCHES = {
+    'films_fts MATCH': 'matches are ordered by bm25 rank',
+    'persons_fts MATCH': 'matches are ordered by bm25 rank',
+    "WHERE name LIKE": 'name prefix matches are ordered by followers',
+    'SELECT DISTINCT users.id FROM activities':
+        'followers of the batch authors are deduplicated',
+    'SUM(films_similar.score * seeds.weight)':
+        'neighbours of the seed films are summed',
+    'SELECT DISTINCT film_id FROM similarity_log':
+        'changed films are deduplicated',
+    'SELECT DISTINCT film_id FROM films_similar':
+        'listing films are deduplicated',
+    'ORDER BY film_id, id': 'links of one import batch keep their order',
+    'ORDER BY person_id, id': 'links of one import batch keep their order',
+}
+
+STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def allowed(table, sql):
+    return any(fragment in sql for fragment in table)
+
+
+def plan_problems(detail, allow_sort=False, materialized=()):
+    # Scans of a subquery's own result (named ones are MATERIALIZEd or run
+    # as a CO-ROUTINE earlier in the plan) are not table scans.
+    problems = []
+    if (detail.startswith('SCAN ') and ' USING ' not in detail
+            and 'VIRTUAL TABLE' not in detail
+            and not detail.startswith('SCAN (subquery')
+            and detail[5:] not in materialized
+            and detail != 'SCAN CONSTANT ROW'):
+        problems.append(f"full scan: {detail}")
+    if 'USE TEMP B-TREE' in detail and not allow_sort:
+        problems.append(f"temp b-tree: {detail}")
+    return problems
+
+
+def statement_problems(db, sql):
+    if allowed(KNOWN_SLOW, sql):
+        return []
+    problems = []
+    materialized = set()
+    for row in db.execute(f"EXPLAIN QUERY PLAN {sql}"):
+        detail = row[3]
+        if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE ')):
+            materialized.add(detail.split(' ', 1)[1])
+        problems.extend(plan_problems(
+            detail, allowed(SORTED_MATCHES, sql), materialized))
+    return problems
+
+
+def film_reviews():
+    film = Film()
+    _, pager = film.get_film(1)[4:]
+    _, pager = film.get_film(1, pager['next'])[4:]
+    film.get_film(1, pager['prev'])
+
+
+def rate():
+    Film().rate(7, 5, '8')
+    Film().delete_rate(7, 5)
+
+
+def user_reviews():
+    _, pager = User().get_reviews(1)
+    User().get_reviews(1, pager['next'])
+
+
+def follow():
+    User().follow(3, 2)
+    User().unfollow(3, 2)
+
+
+def sign_up():
+    User().insert_user('plans', 'plans@example.com', 'secret')
+    User().check_user('plans', 'secret')
+
+
+def flows():
+    db = Watchlist()
+    db.add_watchlist('user1', 'plans', 'A list.')
+    list_id = db.get_list_id('user1', 'user1', 'plans')
+    db.get_list_id('user2', 'user1', 'plans')
+    db.check_watchlist('user1', 'plans')
+    db.validate_listname('user1', 'plans')
+    db.watchlists('user1', 'user1')
+    db.watchlists('user2', 'user1')
+    db.private_list('user1', 'plans')
+    db.public_list('user1', 'plans')
+    db.add_film(list_id, 1)
+    db.watchlist_films(list_id)
+    list(db.film_page(list_id, ('id', 'title'), None, 10))
+    db.watchlist_names('user1')
+    db.get_list_body('user1', 'plans')
+    db.update_watchlist(list_id, 'plans', 'Changed.', 'user1')
+    db.delete_film(list_id, 1)
+    db.delete_watchlist(list_id)
+
+
+def watch_later():
+    db = Watchlater()
+    db.add_watch_later(5, 3)
+    db.check_duplicate(5, 3)
+    db.watch_later(5)
+    db.delete_watchlater(5, 3)
+
+
+def favorites():
+    db = Favorites()
+    db.add_favorites(5, 3)
+    db.check_duplicate(5, 3)
+    db.favorites(5)
+    db.delete_favorites(5, 3)
+
+
+def timeline():
+    # user1 has the most followers; make them a celebrity whose
+    # activities are merged in on read.
+    celebrity = app.config['FEED_CELEBRITY_FOLLOWERS']
+    app.config['FEED_CELEBRITY_FOLLOWERS'] = 20
+    try:
+        _, more = Feed().timeline(5)
+        Feed().timeline(5, more or '1000')
+    finally:
+        app.config['FEED_CELEBRITY_FOLLOWERS'] = celebrity
+
+
+def fan_out():
+    Film().write_review('A review.', 5, 2)
+
+
+def social():
+    social_graph._graph = None
+    User().is_following(1, 2)
+    User().followed_by_followings(1, 2)
+    User().suggestions(3)
+
+
+def genres():
+    db = DataBase().db
+    genre_index._current = None
+    Search().films_by_genres(['Drama', 'Comedy'], '1')
+    db.execute("DELETE FROM films_genres WHERE film_id = 1 AND genre_id = 1")
+    db.commit()
+    Search().films_by_genres(['Drama'], '1')
+
+
+def genre_rebuild():
+    genre_index._current = None
+    Search().films_by_genres(['Drama'], '1')
+
+
+def similar():
+    db = DataBase().db
+    refresh(db, full=True, k=5, chunk=64)
+    db.execute("INSERT INTO films_rates (film_id, user_id, rate) "
+               "VALUES (3, 299, 9)")
+    db.commit()
+    refresh(db, k=5, chunk=64)
+
+
+def import_persons():
+    loader = CatalogLoader(DataBase().db, batch=10)
+    list(loader.persons([{'source_id': 'p1', 'name': 'Renamed',
+                          'types': ['Actor', 'Director']}]))
+
+
+def import_films():
+    loader = CatalogLoader(DataBase().db, batch=10)
+    list(loader.films([{'source_id': 'gen1', 'title': 'Renamed',
+                        'genres': ['Drama'], 'directors': ['p10'],
+                        'actors': ['p1', 'p2']}]))
+
+
+CALLS = {
+    'Film.check_film': lambda: Film().check_film(1),
+    'Film.get_top_movies': lambda: Film().get_top_movies(),
+    'Film.get_popular_movies': lambda: Film().get_popular_movies(),
+    'Film.highest_grossing_movies': lambda: Film().highest_grossing_movies(),
+    'Film.get_film': film_reviews,
+    'Film.similar_films': lambda: Film().similar_films(1),
+    'Film.rate': rate,
+    'Film.rating_histogram': lambda: Film().rating_histogram(1),
+    'Film.films_by_ids': lambda: Film().films_by_ids(
+        [1, 2, 3], tuple(Film.FIELDS)),
+    'Film.film_page': lambda: list(Film().film_page(
+        ('id', 'title'), 'id', 10, 20)),
+    'Film.film_page value': lambda: list(Film().film_page(
+        ('id', 'value'), 'value', (5.0, 10), 20)),
+    'Person.check_person': lambda: Person().check_person(1),
+    'Person.person_info': lambda: Person().person_info(10),
+    'Person.persons_by_ids': lambda: Person().persons_by_ids(
+        [1, 2, 3], tuple(Person.FIELDS)),
+    'User.insert_user': sign_up,
+    'User.validate_name': lambda: User().validate_name('user1'),
+    'User.validate_email': lambda: User().validate_email('a@example.com'),
+    'User.current_user': lambda: User().current_user('user1'),
+    'User.check_rate': lambda: User().check_rate(1, 1),
+    'User.follow': follow,
+    'User.followers': lambda: User().followers(1),
+    'User.followings': lambda: User().followings(1),
+    'User.follow_counts': lambda: User().follow_counts(1),
+    'User.recommendations': lambda: User().recommendations(1),
+    'User.get_reviews': user_reviews,
+    'SocialGraph.load': social,
+    'Watchlist': flows,
+    'Watchlater': watch_later,
+    'Favorites': favorites,
+    'Feed.timeline': timeline,
+    'Feed.fan_out': fan_out,
+    'Search.search__user': lambda: Search().search__user('user1'),
+    'Search.search_film': lambda: Search().search_film('dark nig', '1'),
+    'Search.film_matches': lambda: list(Search().film_matches(
+        'dark', ('id', 'title'), 0, 20)),
+    'Search.search_person': lambda: Search().search_person(
+        'anna', '1', [1, 2]),
+    'GenreIndex.rebuild': genre_rebuild,
+    'GenreIndex.apply': genres,
+    'Versions.load': lambda: Versions().load(['film:1', 'user:user1']),
+    'similarity.refresh': similar,
+    'CatalogLoader.persons': import_persons,
+    'CatalogLoader.films': import_films,
+}
+
+
+@pytest.mark.parametrize('name', CALLS)
+def test_query_plans(traced, name):
+    leaderboards.bump()
+    film_details.clear()
+    with app.test_request_context():
+        g.user_id = g.username = None
+        CALLS[name]()
+    statements = [sql for sql in dict.fromkeys(
+        ' '.join(sql.split()) for sql in traced)
+        if sql.upper().startswith(STATEMENTS)]
+    assert statements, f"{name} ran no statements"
+    db = pool.acquire()
+    try:
+        failures = [f"{problem}\n  in {sql}" for sql in statements
+                    for problem in statement_problems(db, sql)]
+    finally:
+        pool.release(db)
+    assert not failures, '\n'.join(failures)
@@ -0,0 +1,86 @@
+import sqlite3
+import pytest
+from app.models import Film
+from app.schema import MIGRATIONS, VERSION_TRIGGERS, migrate
+
+
+# films and persons as the app created them before schema migrations,
+# when databases had no user_version.
+BASELINE = """
+CREATE TABLE films (id INTEGER PRIMARY KEY, title TEXT NOT NULL,
+    original_title TEXT, year INTEGER, premdate TEXT, genres TEXT,
+    body TEXT, img TEXT, trailer TEXT, rate REAL NOT NULL DEFAULT 0,
+    votes INTEGER NOT NULL DEFAULT 0, value REAL NOT NULL DEFAULT 0,
+    box_office INTEGER);
+CREATE TABLE persons (id INTEGER PRIMARY KEY, name TEXT NOT NULL,
+    img TEXT, body TEXT);
+INSERT INTO films (id, title) VALUES (1, 'Heat');
+INSERT INTO persons (id, name) VALUES (1, 'Michael Mann');
+"""
+
+
+def versions(db):
+    return dict(db.execute("SELECT entity, version FROM entity_versions"))
+
+
+@pytest.fixture
+def db():
+    db = sqlite3.connect(':memory:')
+    migrate(db)
+    db.execute("INSERT INTO films (id, title, value) VALUES (1, 'Heat', 8)")
+    db.commit()
+    return db
+
+
+def test_counter_and_unchanged_rating_updates_bump_nothing(db):
+    before = versions(db)
+    db.execute("UPDATE films SET reviews_count = reviews_count + 1")
+    db.execute(f"{Film.REFRESH_RATING} WHERE id = 1")
+    assert versions(db) == before
+
+
+def test_displayed_columns_bump_their_pages(db):
+    before = versions(db)
+    db.execute("UPDATE films SET body = 'Bank robbers.'")
+    after = versions(db)
+    assert after['film:1'] == before['film:1'] + 1
+    assert after['leaderboards'] == before['leaderboards']
+
+    db.execute("UPDATE films SET rate = 8.5")
+    later = versions(db)
+    assert later['film:1'] == after['film:1'] + 1
+    assert later['leaderboards'] == after['leaderboards'] + 1
+
+
+def triggers(db):
+    return db.execute("""SELECT name, sql FROM sqlite_master
+    WHERE type = 'trigger' ORDER BY name""").fetchall()
+
+
+def test_upgrade_replaces_catch_all_triggers(db):
+    old = sqlite3.connect(':memory:')
+    migrate(old, MIGRATIONS.index(VERSION_TRIGGERS))
+    old.execute("INSERT INTO films (id, title) VALUES (1, 'Heat')")
+    before = versions(old)
+    old.execute("UPDATE films SET reviews_count = 3")
+    assert versions(old) != before
+
+    migrate(old)
+    before = versions(old)
+    old.execute("UPDATE films SET reviews_count = 4")
+    assert versions(old) == before
+    assert triggers(old) == triggers(db)
+
+
+def test_upgrade_from_baseline_schema():
+    old = sqlite3.connect(':memory:')
+    old.executescript(BASELINE)
+    migrate(old)
+    for table in ('films', 'persons'):
+        columns = [row[1] for row in old.execute(
+            f"PRAGMA table_info({table})")]
+        assert 'source_id' in columns
+    assert old.execute("SELECT title FROM films").fetchall() == [('Heat',)]
+    assert {row[1] for row in old.execute("PRAGMA index_list(films)")} >= {
+        'films_source'}
+    old.execute("UPDATE films SET source_id = 'tt0113277'")
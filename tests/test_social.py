@@ -0,0 +1,30 @@
+import sqlite3
+from app import app
+
+
+def other_worker(sql, params):
+    # A write made by another process, which this one's social graph
+    # only picks up on its next reload.
+    db = sqlite3.connect(app.config['DATABASE'])
+    with db:
+        db.execute(sql, params)
+    db.close()
+
+
+def test_follow_button_sees_follows_from_other_workers(member):
+    db = sqlite3.connect(app.config['DATABASE'])
+    target = db.execute("""SELECT id, name FROM users WHERE id != 1
+                        AND id NOT IN (SELECT following FROM followed
+                        WHERE is_following = 1) LIMIT 1""").fetchone()
+    db.close()
+    unfollow = f"/unfollow/{target[1]}".encode()
+    page = member.get(f"/{target[1]}/profile")
+    assert page.status_code == 200 and unfollow not in page.data
+
+    other_worker("INSERT INTO followed (is_following, following) "
+                 "VALUES (1, ?)", (target[0],))
+    assert unfollow in member.get(f"/{target[1]}/profile").data
+
+    other_worker("DELETE FROM followed WHERE is_following = 1 "
+                 "AND following = ?", (target[0],))
+    assert unfollow not in member.get(f"/{target[1]}/profile").data
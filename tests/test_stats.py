@@ -0,0 +1,11 @@
+from app import app
+
+
+def test_stats_hidden_by_default(client):
+    assert client.get('/stats').status_code == 404
+
+
+def test_stats_when_enabled(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'STATS_ENDPOINT', True)
+    stats = client.get('/stats').get_json()
+    assert 'in_use' in stats['db_pool']
@@ -0,0 +1,39 @@
+import calendar
+from app.timesince import time_since
+from time_since import get_time_after_posting, utc
+
+# Month ends and starts of a leap and a common year, at different times
+# of day, and posts from the two years before each.
+NOWS = [calendar.timegm((year, month, day, hour, 30, 0))
+        for year in (2023, 2024) for month in range(1, 13)
+        for day in (1, 28, 29, 30, 31)
+        if day <= calendar.monthrange(year, month)[1]
+        for hour in (0, 23)]
+
+
+def month_end_stamps(now):
+    year, month = utc(now).year, utc(now).month
+    for back in range(26):
+        y, m = divmod(year * 12 + month - 1 - back, 12)
+        last = calendar.monthrange(y, m + 1)[1]
+        for day in {1, 2, 27, 28, 29, 30, 31}:
+            if day <= last:
+                for hour in (0, 23):
+                    stamp = calendar.timegm((y, m + 1, day, hour, 30, 0))
+                    if stamp < now:
+                        yield stamp
+
+
+def test_labels_match_relativedelta_near_month_ends():
+    mismatches = []
+    for now in NOWS:
+        stamps = list(month_end_stamps(now))
+        expected = [get_time_after_posting(
+            utc(stamp).strftime("%Y-%m-%d %H:%M:%S"), utc(now))
+            for stamp in stamps]
+        for stamp, got, want in zip(stamps, time_since(stamps, now),
+                                    expected):
+            if got != want:
+                mismatches.append((utc(stamp), utc(now), got, want))
+    assert not mismatches[:10]
+